@@ -316,21 +316,7 @@ def parseApertureMacro(s, fid):
 
 
 def addToApertureMacroTable(AM):
-    GAMT = config.GAMT
-
-    # Must sort keys by integer value, not string since 99 comes before 100
-    # as an integer but not a string.
-    keys = sorted(map(int, map(lambda K: K[1:], GAMT.keys())))
-
-    if len(keys):
-        lastCode = keys[-1]
-    else:
-        lastCode = 0
-
-    mcode = 'M%d' % (lastCode + 1)
-    AM.name = mcode
-    GAMT[mcode] = AM
-
+    AM.name = config.GAMT.add(AM)
     return AM
 
 
@@ -11,6 +11,7 @@ Rugged Circuits LLC
 http://ruggedcircuits.com/gerbmerge
 """
 
+import copy
 import sys
 import re
 
@@ -93,32 +94,27 @@ class Aperture(object):
         else:
             return False  # no new aperture needs to be created
 
-    def rotate(self, RevGAMT):
+    def rotate(self):
         if self.apname in ('Macro',):
             # Construct a rotated macro, see if it's in the GAMT, and set self.dimx
             # to its name if so. If not, add the rotated macro to the GAMT and set
-            # self.dimx to the new name. Recall that GAMT maps name to macro
-            # (e.g., GAMT['M9'] = ApertureMacro(...)) while RevGAMT maps hash to
-            # macro name (e.g., RevGAMT[hash] = 'M9')
+            # self.dimx to the new name.
             AMR = config.GAMT[self.dimx].rotated()
-            hash = AMR.hash()
-            try:
-                self.dimx = RevGAMT[hash]
-            except KeyError:
+            self.dimx = config.GAMT.find(AMR)
+            if self.dimx is None:
                 # adds to GAMT and modifies name to global name
-                AMR = amacro.addToApertureMacroTable(AMR)
-                self.dimx = RevGAMT[hash] = AMR.name
+                self.dimx = amacro.addToApertureMacroTable(AMR).name
 
         elif self.dimy is not None:       # Rectangles and Ovals have a dimy setting and need to be rotated
             t = self.dimx
             self.dimx = self.dimy
             self.dimy = t
 
-    def rotated(self, RevGAMT):
+    def rotated(self):
         # deepcopy doesn't work on re patterns for some reason so we copy
         # ourselves manually
         APR = Aperture(self.apname, self.code, self.dimx, self.dimy)
-        APR.rotate(RevGAMT)
+        APR.rotate()
         return APR
 
     def dump(self, fid=sys.stdout):
@@ -185,94 +181,68 @@ def parseAperture(s, knownMacroNames):
 
     return None
 
-# This function returns a dictionary where each key is an
-# aperture code string (e.g., "D11") and the value is the
-# Aperture object that represents it. For example:
+# This function constructs the global aperture table GAT and the global
+# aperture macro table GAMT from the aperture and aperture macro definitions
+# collected by a list of GerberParser objects, then translates each parser's
+# local aperture codes to global ones. For example:
 #
 #    %ADD12R,0.0630X0.0630*%
 #
-# from a Gerber file would result in the dictionary entry:
+# from a Gerber file would result in the global table entry:
 #
-#    "D12": Aperture(ap, 'D10', 0.063, 0.063)
+#    "D10": Aperture(ap, 'D10', 0.063, 0.063)
 #
-# The input fileList is a list of pathnames which will be read to construct the
-# aperture table for a job.  All the files in the given list will be so
-# examined, and a global aperture table will be constructed as a dictionary.
-# Same goes for the global aperture macro table.
+# and every D12 aperture change in that file becoming D10. Identical apertures
+# and macros from different files share the same global code, and codes are
+# assigned in the order the definitions appear in the given list of parsers.
 
 
-tool_pat = re.compile(r'^(?:G54)?D\d+\*$')
-
-
-def constructApertureTable(fileList):
+def mergeApertureTables(parsers):
     # First we construct a dictionary where each key is the
     # string representation of the aperture. Then we go back and assign
     # numbers. For aperture macros, we construct their final version
-    # (i.e., 'M1', 'M2', etc.) right away, as they are parsed. Thus,
-    # we translate from 'THX10N' or whatever to 'M2' right away.
+    # (i.e., 'M1', 'M2', etc.) right away. Thus, we translate from
+    # 'THX10N' or whatever to 'M2' right away.
     GAT = config.GAT      # Global Aperture Table
     GAT.clear()
     GAMT = config.GAMT    # Global Aperture Macro Table
     GAMT.clear()
-    RevGAMT = {}          # Dictionary keyed by aperture macro hash and returning macro name
-
-    AT = {}               # Aperture Table for this file
-    for fname in fileList:
-        # print('Reading apertures from %s ...' % fname)
-
-        knownMacroNames = {}
-
-        fid = open(fname, 'rt')
-        for line in fid:
-            # Get rid of CR
-            line = line.replace('\x0D', '')
-
-            if tool_pat.match(line):
-                break  # When tools start, no more apertures are being defined
-
-            # If this is an aperture macro definition, add its string
-            # representation to the dictionary. It might already exist.
-            # Ignore %AMOC8* from Eagle for now as it uses a macro parameter.
-            if line[:7] == '%AMOC8*':
-                continue
-
-            # parseApertureMacro() sucks up all macro lines up to terminating
-            # '%'
-            AM = amacro.parseApertureMacro(line, fid)
-            if AM:
-                # Has this macro definition already been defined (perhaps by another name
-                # in another layer)?
-                try:
-                    # If this macro has already been encountered anywhere in any job,
-                    # RevGAMT will map the macro hash to the global macro name. Then,
-                    # make the local association
-                    # knownMacroNames[localMacroName] = globalMacroName.
-                    knownMacroNames[AM.name] = RevGAMT[AM.hash()]
-                except KeyError:
-                    # No, so define the global macro and do the translation. Note that
-                    # addToApertureMacroTable() MODIFIES AM.name to the new
-                    # M-name.
-                    localMacroName = AM.name
-                    AM = amacro.addToApertureMacroTable(AM)
-                    knownMacroNames[localMacroName] = AM.name
-                    RevGAMT[AM.hash()] = AM.name
-            else:
-                A = parseAperture(line, knownMacroNames)
-
-                # If this is an aperture definition, add the string representation
-                # to the dictionary. It might already exist.
-                if A:
-                    AT[A.hash()] = A
 
-        fid.close()
+    AT = {}               # Aperture Table for all files
+    localHashes = []      # For each parser, list of (local code, aperture hash)
+    for parser in parsers:
+        for M in parser.macroDefs:
+            # Has this macro definition already been defined (perhaps by another name
+            # in another layer)?
+            name = GAMT.find(M)
+            if name is None:
+                # No, so define the global macro and do the translation. Note that
+                # addToApertureMacroTable() MODIFIES the name to the new M-name,
+                # so the parser's own definition is left alone.
+                name = amacro.addToApertureMacroTable(copy.deepcopy(M)).name
+            parser.apmxlat[M.name] = name
+
+        L = []
+        for A in parser.apertureDefs:
+            # Macro apertures refer to the GLOBAL, permanent macro name (e.g., 'M2')
+            dimx = A.dimx
+            if A.apname in ('Macro',):
+                dimx = parser.apmxlat[dimx]
+
+            A = Aperture(A.apname, A.code, dimx, A.dimy)
+            AT[A.hash()] = A
+            L.append((A.code, A.hash()))
+        localHashes.append(L)
 
     # Now, go through and assign sequential codes to all apertures
-    code = 10
     for val in AT.values():
-        key = 'D%d' % code
-        GAT[key] = val
-        val.code = key
-        code += 1
+        val.code = GAT.add(val)
+
+    # Finally, tell each parser which global code to use for each of its apertures
+    for parser, L in zip(parsers, localHashes):
+        for localCode, hash in L:
+            parser.apxlat[localCode] = GAT.codes[hash]
+        parser.resolveApertures()
 
     if 0:
         keylist = sorted(config.GAT.keys())
@@ -283,36 +253,38 @@ def constructApertureTable(fileList):
         sys.exit(0)
 
 
+def constructApertureTable(fileList):
+    """Parse the given Gerber files and construct the GAT and GAMT from them.
+    Returns the list of GerberParser objects, one per file."""
+    from .gerber import GerberParser
+
+    parsers = []
+    for fname in fileList:
+        G = GerberParser()
+        G.parse(fname)
+        parsers.append(G)
+
+    mergeApertureTables(parsers)
+    return parsers
+
+
 def findHighestApertureCode(keys):
     "Find the highest integer value in a list of aperture codes: ['D10', 'D23', 'D35', ...]"
 
-    # Must sort keys by integer value, not string since 99 comes before 100
+    # Must compare keys by integer value, not string since 99 comes before 100
     # as an integer but not a string.
-    keys = sorted([int(K[1:]) for K in keys])
-
-    return keys[-1]
+    return max([int(K[1:]) for K in keys])
 
 
 def addToApertureTable(AP):
-    GAT = config.GAT
-
-    lastCode = findHighestApertureCode(GAT.keys())
-    code = 'D%d' % (lastCode + 1)
-    GAT[code] = AP
-    AP.code = code
-
-    return code
+    AP.code = config.GAT.add(AP)
+    return AP.code
 
 
 def findInApertureTable(AP):
     """Return 'D10', for example in response to query for an object
        of type Aperture()"""
-    hash = AP.hash()
-    for key, val in config.GAT.items():
-        if hash == val.hash():
-            return key
-
-    return None
+    return config.GAT.find(AP)
 
 
 def findOrAddAperture(AP):
@@ -336,8 +308,7 @@ if __name__ == "__main__":
     for key in keylist:
         print('%s' % config.GAMT[key])
 
-    keylist = config.GAT.keys()
-    keylist.sort()
+    keylist = sorted(config.GAT.keys())
     print('Apertures')
     print('=========')
     for key in keylist:
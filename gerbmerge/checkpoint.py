@@ -0,0 +1,102 @@
+"""
+Save the state of an automatic placement search to a file while it runs,
+so that a search that was interrupted or timed out can be resumed later.
+
+A checkpoint holds the best tiling found so far together with whatever the
+search needs to carry on where it stopped: for the exhaustive search the
+branch of the search tree it was working on, for the random search the state
+of its random number generator. Jobs are stored as indices into the job list,
+so a checkpoint only fits the same jobs on the same panel with the same
+spacing, and this is checked when it is loaded.
+
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+"""
+
+import os
+import pickle
+
+from . import config, tiling
+
+# Increase this whenever the data stored in checkpoints changes
+CHECKPOINT_VERSION = 1
+
+
+def searchKey(name, Jobs, X, Y, cfg=config.Config):
+    """Return a value identifying a search of the given name for Jobs, a list of
+    4-tuples (Xdim,Ydim,job,rjob), on an X-by-Y panel"""
+    return (CHECKPOINT_VERSION, name, X, Y, cfg['xspacing'], cfg['yspacing'],
+            tuple([(Xdim, Ydim, job.name) for Xdim, Ydim, job, rjob in Jobs]))
+
+
+class Checkpoint(object):
+    """Checkpoint file fname of the named search of Jobs on an X-by-Y panel"""
+
+    def __init__(self, fname, name, Jobs, X, Y, cfg=config.Config):
+        self.fname = fname
+        self.name = name
+        self.Jobs = Jobs
+        self.X = X
+        self.Y = Y
+        self.key = searchKey(name, Jobs, X, Y, cfg)
+
+    def load(self):
+        """Return (best, state) as saved by the last call to save(), or
+        (None, None) if there is no checkpoint file yet"""
+        try:
+            with open(self.fname, 'rb') as fid:
+                data = pickle.load(fid)
+        except FileNotFoundError:
+            print("No checkpoint in '%s', starting a new search." % self.fname)
+            return None, None
+        except Exception as e:
+            raise RuntimeError("Cannot read checkpoint file '%s': %s" % (self.fname, e))
+
+        if data.get('key') != self.key:
+            raise RuntimeError("Checkpoint file '%s' is not for this %s search, jobs and panel" %
+                               (self.fname, self.name))
+
+        print("Resuming search from checkpoint in '%s'." % self.fname)
+        return makeTiling(data['best'], self.Jobs, self.X, self.Y), data['state']
+
+    def save(self, best, state):
+        """Write the best tiling so far and the search state to the checkpoint file"""
+        data = {'key': self.key,
+                'best': tilingState(best, self.Jobs),
+                'state': state}
+
+        # Write a new file and move it over the old one, so that an interruption
+        # while writing never leaves a damaged checkpoint behind
+        tmpname = self.fname + '.tmp'
+        with open(tmpname, 'wb') as fid:
+            pickle.dump(data, fid, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, self.fname)
+
+
+def tilingState(T, Jobs):
+    """Return the outline and job placements of tiling T, with each job replaced
+    by an (index, rotated) key into Jobs, or None if T is None"""
+    if T is None:
+        return None
+
+    keys = {}
+    for ix in range(len(Jobs) - 1, -1, -1):
+        Xdim, Ydim, job, rjob = Jobs[ix]
+        keys[id(job)] = (ix, 0)
+        keys[id(rjob)] = (ix, 1)
+
+    return (list(T.points), [(bl, tr, keys[id(job)]) for bl, tr, job in T.jobs])
+
+
+def makeTiling(state, Jobs, X, Y):
+    """Return the X-by-Y tiling saved by tilingState(), or None"""
+    if state is None:
+        return None
+
+    points, placed = state
+    T = tiling.Tiling(X, Y)
+    T.points = points
+    T.jobs = [(bl, tr, Jobs[ix][2 + rotated]) for bl, tr, (ix, rotated) in placed]
+    return T
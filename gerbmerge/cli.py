@@ -34,10 +34,19 @@ searchGroup = parser.add_mutually_exclusive_group(required=True)
 searchGroup.add_argument("layoutfile", help="file containing layout of gerbers defined in config file", nargs='?')
 searchGroup.add_argument("--random-search", help="Automatic placement using random search", action="store_true")
 searchGroup.add_argument("--full-search", help="Automatic placement using exhaustive search", action="store_true")
+searchGroup.add_argument("--anneal-search", help="Automatic placement using simulated annealing", action="store_true")
+searchGroup.add_argument("--pack", help="Automatic placement using fast bin packing, without searching", action="store_true")
 
 parser.add_argument("--place-file", help="Read placement from file")
 parser.add_argument("--rs-fsjobs", help="When using random search, exhaustively search N jobs for each random placement", type=int, default=2)
 parser.add_argument("--search-timeout", help="When using random search, search for T seconds for best random placement", type=int, default=0)
+parser.add_argument("--checkpoint", help="Save the state of the exhaustive or random search to FILE every few seconds", metavar="FILE")
+parser.add_argument("--resume", help="Resume the search saved in the file given with --checkpoint", action="store_true")
+parser.add_argument("--state", help="Keep the trimmed jobs and the last automatic placement in FILE, and reuse them while the files and options they depend on are unchanged", metavar="FILE")
+parser.add_argument("-j", "--jobs", help="Number of worker processes to use for reading job files, random search and writing output files", type=int, default=1)
+parser.add_argument("--no-cache", help="Do not use or update the cache of parsed Gerber and Excellon files", action="store_true")
+parser.add_argument("--cache-dir", help="Directory for the cache of parsed files (default: ~/.cache/gerbmerge)")
+parser.add_argument("--cache-size", help="Maximum size of the cache of parsed files, in megabytes", type=int, default=100)
 parser.add_argument("--no-trim-gerber", help="Do not attempt to trim Gerber data to extents of board", action="store_true")
 parser.add_argument("--no-trim-excellon", help="Do not attempt to trim Excellon data to extents of board", action="store_true")
 parser.add_argument("--octagons", help="Generate octagons in two different styles depending on the value:\n 'rotate' :  0.0 rotation\n 'normal' : 22.5 rotation", choices=['rotate', 'normal'], default='normal')
@@ -11,8 +11,10 @@ Rugged Circuits LLC
 http://ruggedcircuits.com/gerbmerge
 """
 
+import collections.abc
 import sys
 import configparser
+import multiprocessing
 import re
 
 from . import aptable, jobs
@@ -73,12 +75,63 @@ MergeOutputFiles = {
     'toollist': 'merged.toollist.drl'
 }
 
+
+class ApertureRegistry(collections.abc.MutableMapping):
+    """A table of apertures or aperture macros indexed by code (e.g., 'D10' or
+    'M3'). Alongside it the registry keeps the reverse table, from the hash()
+    string of each entry to its code, and the highest code number in use.
+    Both are updated as entries are added or removed, so they never have to
+    be rebuilt."""
+
+    def __init__(self, prefix, first):
+        self.prefix = prefix        # 'D' or 'M'
+        self.first = first          # Number of the first code handed out
+        self.table = {}
+        self.codes = {}             # codes[hash] = code
+        self.highest = first - 1
+
+    def __getitem__(self, code):
+        return self.table[code]
+
+    def __setitem__(self, code, item):
+        if code in self.table:
+            del self[code]
+        self.table[code] = item
+        self.codes.setdefault(item.hash(), code)
+        self.highest = max(self.highest, int(code[len(self.prefix):]))
+
+    def __delitem__(self, code):
+        item = self.table.pop(code)
+        if self.codes.get(item.hash()) == code:
+            del self.codes[item.hash()]
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def __len__(self):
+        return len(self.table)
+
+    def clear(self):
+        self.table.clear()
+        self.codes.clear()
+        self.highest = self.first - 1
+
+    def find(self, item):
+        "Return the code of an entry equal to item, or None if there is none"
+        return self.codes.get(item.hash())
+
+    def add(self, item):
+        "Add item under the next unused code, and return the code"
+        code = '%s%d' % (self.prefix, self.highest + 1)
+        self[code] = item
+        return code
+
+
 # The global aperture table, indexed by aperture code (e.g., 'D10')
-GAT = {}
+GAT = ApertureRegistry('D', 10)
 
-# The global aperture macro table, indexed by macro name (e.g., 'M3',
-# 'M4R' for rotated macros)
-GAMT = {}
+# The global aperture macro table, indexed by macro name (e.g., 'M3')
+GAMT = ApertureRegistry('M', 1)
 
 # The list of all jobs loaded, indexed by job name (e.g., 'PowerBoard')
 Jobs = {}
@@ -109,6 +162,29 @@ TrimGerber = 1
 # This configuration option determines whether trimExcellon() is called
 TrimExcellon = 1
 
+# This configuration option is the number of worker processes to use. With more
+# than one worker, job files are parsed, random placement trials are run and
+# the merged output files are written in parallel.
+Workers = 1
+
+# These configuration options control the on-disk cache of parsed Gerber and
+# Excellon files. ParseCacheDir of None means the per-user default directory,
+# and ParseCacheSize is the size limit of the cache in bytes.
+ParseCache = 1
+ParseCacheDir = None
+ParseCacheSize = 100 * 1024 * 1024
+
+# These configuration options control checkpoints of the automatic placement
+# search. With a CheckpointFile the state of the search is saved to it every
+# few seconds, and with ResumeSearch a saved search is carried on.
+CheckpointFile = None
+ResumeSearch = 0
+
+# This configuration option is the name of the project state file, in which
+# the trimmed jobs and the last automatic placement are kept for the next run
+# (see projectstate.py), or None to compute everything every time.
+StateFile = None
+
 # This configuration option determines the minimum size of feature dimensions for
 # each layer. It is a dictionary indexed by layer name (e.g. '*topsilkscreen') and
 # has a floating point number as the value (in inches).
@@ -122,14 +198,6 @@ MinimumFeatureDimension = {}
 # moved to setting that can be loaded from config file
 # SearchTimeout = 0
 
-# Construct the reverse-GAT/GAMT translation table, keyed by aperture/aperture macro
-# hash string. The value is the aperture code (e.g., 'D10') or macro name
-# (e.g., 'M5').
-
-
-def buildRevDict(D):
-    return {val.hash(): key for key, val in D.items()}
-
 
 def parseStringList(L):
     """Parse something like '*toplayer, *bottomlayer' into a list of names
@@ -219,9 +287,13 @@ def parseToolList(fname):
 #     table, GAT, and the global aperture macro table, GAMT
 #
 #   * read the tool list file and populate the DefaultToolList dictionary
+#
+# With a ProjectState 'state', jobs and aperture tables that have not changed
+# since they were stored in the project state file are taken from it instead,
+# as they were after trimming, and state.jobsRestored is set.
 
 
-def parseConfigFile(fname, Config=Config, Jobs=Jobs):
+def parseConfigFile(fname, Config=Config, Jobs=Jobs, state=None):
     global DefaultToolList
 
     cp = configparser.ConfigParser()
@@ -305,10 +377,7 @@ def parseConfigFile(fname, Config=Config, Jobs=Jobs):
                                         'drills', 'placement', 'toollist'):
                 MergeOutputFiles[opt] = cp.get('MergeOutputFiles', opt)
 
-    # Now, we go through all jobs and collect Gerber layers
-    # so we can construct the Global Aperture Table.
-    apfiles = []
-
+    # Now, we go through all jobs and collect Gerber layer names.
     for jobname in cp.sections():
         if jobname == 'Options':
             continue
@@ -327,24 +396,8 @@ def parseConfigFile(fname, Config=Config, Jobs=Jobs):
                 "Job '%s' does not have a drills layer specified" % jobname)
 
         for layername in cp.options(jobname):
-            if layername[0] == '*' or layername == 'boardoutline':
-                fname = cp.get(jobname, layername)
-                apfiles.append(fname)
-
-                if layername[0] == '*':
-                    LayerList[layername] = 1
-
-    # Now construct global aperture tables, GAT and GAMT. This step actually
-    # reads in the jobs for aperture data but doesn't store Gerber
-    # data yet.
-    aptable.constructApertureTable(apfiles)
-    del apfiles
-
-    if 0:
-        keylist = sorted(GAMT.keys())
-        for key in keylist:
-            print('%s' % GAMT[key])
-        sys.exit(0)
+            if layername[0] == '*':
+                LayerList[layername] = 1
 
     # Parse the tool list
     if Config['toollist']:
@@ -357,11 +410,21 @@ def parseConfigFile(fname, Config=Config, Jobs=Jobs):
 
     Jobs.clear()
 
+    # Every Gerber file is read only once. Aperture codes stay local to each
+    # file until all files have been read, then the global aperture tables
+    # are built from these parsers, in the order the files were read.
+    parsers = []
+
     do_abort = 0
     errstr = 'ERROR'
     if Config['allowmissinglayers']:
         errstr = 'WARNING'
 
+    # First collect the files to read for every job. They are then parsed, in
+    # worker processes if there is more than one worker, and attached to their
+    # jobs in the same order a serial run would use.
+    tasks = []  # list of (Job, layername, kind, filename, argument)
+
     for jobname in cp.sections():
         if jobname == 'Options':
             continue
@@ -403,12 +466,31 @@ def parseConfigFile(fname, Config=Config, Jobs=Jobs):
             fname = cp.get(jobname, layername)
 
             if layername == 'boardoutline':
-                J.parseGerber(fname, layername, updateExtents=1)
+                tasks.append((J, layername, 'gerber', fname, 1))
             elif layername[0] == '*':
-                J.parseGerber(fname, layername, updateExtents=0)
+                tasks.append((J, layername, 'gerber', fname, 0))
             elif layername == 'drills':
-                J.parseExcellon(fname, excellon_decimals)
+                tasks.append((J, layername, 'excellon', fname, excellon_decimals))
+
+        # Store the job in the global Jobs dictionary, keyed by job name
+        Jobs[jobname] = J
+
+    restored = state is not None and state.restoreJobs(tasks, Jobs)
+    if restored:
+        print("\nUsing jobs from project state file '%s'" % state.fname)
+    else:
+        results = parseJobFiles([task[2:] for task in tasks])
 
+        for (J, layername, kind, fname, arg), result in zip(tasks, results):
+            if kind == 'excellon':
+                J.drills = result
+            else:
+                J.addGerber(layername, result, updateExtents=arg)
+                parsers.append(result)
+        del results
+    del tasks
+
+    for jobname, J in Jobs.items():
         # Emit warnings if some layers are missing
         ll = LayerList.copy()
         for layername in J.gerbers.keys():
@@ -424,14 +506,51 @@ def parseConfigFile(fname, Config=Config, Jobs=Jobs):
             for layername in ll.keys():
                 print('  %s' % layername)
 
-        # Store the job in the global Jobs dictionary, keyed by job name
-        Jobs[jobname] = J
+    # Now construct global aperture tables, GAT and GAMT, and switch all
+    # parsed layers over to global aperture codes. Restored jobs already use them.
+    if not restored:
+        aptable.mergeApertureTables(parsers)
+    del parsers
+
+    if 0:
+        keylist = sorted(GAMT.keys())
+        for key in keylist:
+            print('%s' % GAMT[key])
+        sys.exit(0)
 
     if do_abort:
         raise RuntimeError(
             'Exiting since jobs are missing layers. Set AllowMissingLayers=1\nto override.')
 
 
+def _parseJobFile(task):
+    kind, fname, arg = task
+    if kind == 'excellon':
+        return jobs.loadExcellon(fname, arg)
+    else:
+        return jobs.loadGerber(fname, arg)
+
+
+def _initParseWorker(settings):
+    global DefaultToolList, ParseCache, ParseCacheDir, ParseCacheSize
+
+    cfg, DefaultToolList, ParseCache, ParseCacheDir, ParseCacheSize = settings
+    Config.update(cfg)
+
+
+def parseJobFiles(tasks):
+    """Parse a list of (kind, filename, argument) tasks, where kind is 'gerber'
+    (argument is updateExtents) or 'excellon' (argument is the number of decimals).
+    Returns the parsers in the same order as the tasks. With more than one worker
+    the files are parsed in a pool of worker processes."""
+    if Workers <= 1 or len(tasks) <= 1:
+        return [_parseJobFile(task) for task in tasks]
+
+    settings = (Config, DefaultToolList, ParseCache, ParseCacheDir, ParseCacheSize)
+    with multiprocessing.Pool(min(Workers, len(tasks)), _initParseWorker, (settings,)) as pool:
+        return pool.map(_parseJobFile, tasks, chunksize=1)
+
+
 if __name__ == "__main__":
     cp = parseConfigFile(sys.argv[1])
     print(Config)
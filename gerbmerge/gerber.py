@@ -1,6 +1,12 @@
+import array
 import builtins
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from . import amacro, aptable, config, geometry, util
 
 # Patterns for Gerber RS274X file interpretation
@@ -15,6 +21,11 @@ drawY_pat = re.compile(r'Y([+-]?\d+)D0?([123])\*')  # Drawing command, X is impl
 format_pat = re.compile(r'%FS(?P<zeros>L|T|D)?(?P<coord_mode>A|I)(N\d+)?X(?P<x>[0-6][0-6])Y(?P<y>[0-6][0-6])\*%')  # Format statement
 layerpol_pat = re.compile(r'^%LP[CD]\*%')  # Layer polarity (D=dark, C=clear)
 
+# Output format of a draw command, and of a circular interpolation command
+DrawFormat = 'X%07dY%07dD%02d*\n'
+ArcFormat = 'X%07dY%07dI%07dJ%07dD%02d*\n'
+
+
 units_pat = re.compile(r'^%MO(?P<units>IN|MM)\*%')
 
 
@@ -48,12 +59,420 @@ IgnoreList = ( \
     re.compile(r'^%LN.*\*%')       # Layer name
 )
 
+# Tokens that can follow each other on one line, in the order they are tried.
+# Each entry is the token kind, the characters a token of this kind can start
+# with, and its pattern. Patterns on the ignore list can start with anything.
+Tokens = (
+    ('comment', 'G', comment_pat),
+    ('format', '%', format_pat),
+    ('gcode', 'G', gcode_pat),
+    ('tool', 'D', tool_pat),
+    ('drawXY', 'X', drawXY_pat),
+    ('drawX', 'X', drawX_pat),
+    ('drawY', 'Y', drawY_pat),
+    ('cdrawXY', 'X', cdrawXY_pat),
+    ('cdrawX', 'X', cdrawX_pat),
+    ('cdrawY', 'Y', cdrawY_pat),
+) + tuple(('ignore', '', pat) for pat in IgnoreList)
+
+
+def _buildLexer(tokens):
+    """Combine the patterns of the given tokens into a single master pattern of
+    alternatives, tried in order. Returns the pattern and a dictionary that maps
+    the group number of each alternative to its token kind and number of groups."""
+    parts = []
+    kinds = {}
+    group = 1
+    for kind, first, pat in tokens:
+        # Tokens are matched in the middle of a line, so a leading '^' has to go
+        parts.append('(%s)' % pat.pattern.lstrip('^'))
+        kinds[group] = (kind, group, group + pat.groups)
+        group += 1 + pat.groups
+    return re.compile('|'.join(parts)), kinds
+
+
+# Master patterns indexed by the first character of the token. Only tokens that
+# can start with that character are tried, besides the ignore list.
+_Lexers = {}
+for _c in set(''.join(first for kind, first, pat in Tokens)):
+    _Lexers[_c] = _buildLexer([T for T in Tokens if _c in T[1] or not T[1]])
+_DefaultLexer = _buildLexer([T for T in Tokens if not T[1]])
+
+
+def tokenize(line):
+    """Generate (kind, groups, pos) for each token in a line of Gerber data, where
+    groups are the groups of the token's pattern and pos its position in the line.
+    If the rest of the line cannot be interpreted, (None, None, pos) is generated
+    and tokenizing stops."""
+    pos = 0
+    end = len(line)
+    while pos < end:
+        pattern, kinds = _Lexers.get(line[pos], _DefaultLexer)
+        match = pattern.match(line, pos)
+        if match is None:
+            yield None, None, pos
+            return
+
+        kind, first, last = kinds[match.lastindex]
+        yield kind, match.groups()[first:last], pos
+        pos = match.end()
+
+
+class CommandList(object):
+    """Compact storage for the commands of a Gerber layer. Rather than one Python
+    object per command, each command is a row in a set of parallel arrays:
+
+        op   -- 0 for a string command, 1 through 3 for a linear draw command
+                with that D-code, and the D-code plus 3 (unsigned I,J) or plus 6
+                (signed I,J) for a circular interpolation command
+        x, y -- coordinates of draw commands
+        arg  -- index into the string table for string commands, or into the
+                i and j arrays for circular interpolation commands
+
+    Iterating over a CommandList, or indexing it, returns commands in the form
+    described in GerberParser, i.e., strings and (X,Y,D) or (X,Y,I,J,D,s) tuples."""
+
+    def __init__(self, commands=()):
+        self.op = array.array('b')
+        self.x = array.array('d')
+        self.y = array.array('d')
+        self.arg = array.array('i')
+        self.i = array.array('d')
+        self.j = array.array('d')
+
+        # Each distinct string command is stored once
+        self.strings = []
+        self.stringIndex = {}
+
+        # Cached result of runs(), with the op array and its length it is for
+        self._runs = (None, 0, [])
+
+        # Cached result of template(), with the arrays and length it is for
+        self._template = ((), None)
+
+        self.extend(commands)
+
+    def appendString(self, cmd):
+        try:
+            index = self.stringIndex[cmd]
+        except KeyError:
+            index = self.stringIndex[cmd] = len(self.strings)
+            self.strings.append(cmd)
+
+        self.op.append(0)
+        self.x.append(0)
+        self.y.append(0)
+        self.arg.append(index)
+
+    def appendDraw(self, x, y, d):
+        self.op.append(d)
+        self.x.append(x)
+        self.y.append(y)
+        self.arg.append(0)
+
+    def appendArc(self, x, y, I, J, d, signed):
+        self.op.append(d + 6 if signed else d + 3)
+        self.x.append(x)
+        self.y.append(y)
+        self.arg.append(len(self.i))
+        self.i.append(I)
+        self.j.append(J)
+
+    def append(self, cmd):
+        if isinstance(cmd, tuple):
+            if len(cmd) == 3:
+                self.appendDraw(*cmd)
+            else:
+                self.appendArc(*cmd)
+        else:
+            self.appendString(cmd)
+
+    def extend(self, commands):
+        for cmd in commands:
+            self.append(cmd)
+
+    def command(self, op, x, y, arg):
+        "Return the command for one row of the arrays"
+        if op == 0:
+            return self.strings[arg]
+        elif op <= 3:
+            return (x, y, op)
+        elif op <= 6:
+            return (x, y, self.i[arg], self.j[arg], op - 3, False)
+        else:
+            return (x, y, self.i[arg], self.j[arg], op - 6, True)
+
+    def __len__(self):
+        return len(self.op)
+
+    def __getitem__(self, index):
+        return self.command(self.op[index], self.x[index], self.y[index], self.arg[index])
+
+    def __iter__(self):
+        command = self.command
+        for op, x, y, arg in zip(self.op, self.x, self.y, self.arg):
+            yield command(op, x, y, arg)
+
+    def runs(self):
+        """Return the commands as a list of (kind, start, end) runs of consecutive
+        rows of the same kind: 0 for string commands, 1 for linear draw commands
+        and 2 for circular interpolation commands."""
+        op, length, runs = self._runs
+        if op is self.op and length == len(self.op):
+            return runs
+
+        runs = []
+        kind = start = None
+        for row, o in enumerate(self.op):
+            k = 0 if o == 0 else (1 if o <= 3 else 2)
+            if k != kind:
+                if kind is not None:
+                    runs.append((kind, start, row))
+                kind, start = k, row
+        if kind is not None:
+            runs.append((kind, start, len(self.op)))
+
+        self._runs = (self.op, len(self.op), runs)
+        return runs
+
+    def template(self):
+        """Return the commands compiled into a RenderTemplate. The template is
+        kept until the commands change, so a job that is placed many times is
+        only compiled once."""
+        key, template = self._template
+        arrays = (self.op, self.x, self.y, self.strings, self.i, self.j)
+        if (template is not None and len(key) == len(arrays) + 1 and key[-1] == len(self.op)
+                and all(a is b for a, b in zip(key, arrays))):
+            return template
+
+        template = RenderTemplate(self)
+        self._template = (arrays + (len(self.op),), template)
+        return template
+
+    def __getstate__(self):
+        # Templates are rebuilt when needed rather than stored with the commands
+        state = self.__dict__.copy()
+        state['_template'] = ((), None)
+        return state
+
+    def mapStrings(self, func):
+        """Replace every string command 's' with func(s). This works on the string
+        table, so it takes time in proportion to the number of distinct strings.
+        If func changes nothing, the string table and its template are kept."""
+        strings = [func(cmd) for cmd in self.strings]
+        if strings == self.strings:
+            return
+
+        self.strings = strings
+        self.stringIndex = {}
+        for index, cmd in enumerate(self.strings):
+            self.stringIndex.setdefault(cmd, index)
+
+    def shift(self, dx, dy):
+        "Add (dx,dy) to the coordinates of all draw commands"
+        self.x = array.array('d', [x + dx for x in self.x])
+        self.y = array.array('d', [y + dy for y in self.y])
+
+    def apertureChanges(self):
+        "Return the aperture codes (D10 and up) selected by the commands, in order"
+        strings = self.strings
+        isCode = [cmd[0] == 'D' and int(cmd[1:]) >= 10 for cmd in strings]
+        return [strings[arg] for op, arg in zip(self.op, self.arg) if op == 0 and isCode[arg]]
+
+    def transformed(self, a, b, c, d, e, f):
+        """Return a copy of this list with the transform
+
+               X' = a*X + b*Y + e
+               Y' = c*X + d*Y + f
+
+        applied to all draw commands in one pass over the coordinate arrays. The
+        (I,J) offsets of circular interpolation commands are relative, so only
+        a, b, c and d apply to them, and unsigned offsets stay unsigned. Uses
+        NumPy if it is available."""
+        C = CommandList()
+        C.op = array.array('b', self.op)
+        C.arg = array.array('i', self.arg)
+        C.strings = list(self.strings)
+        C.stringIndex = dict(self.stringIndex)
+
+        if numpy is not None:
+            x = numpy.frombuffer(self.x, dtype=numpy.float64)
+            y = numpy.frombuffer(self.y, dtype=numpy.float64)
+            C.x.frombytes((a * x + b * y + e).tobytes())
+            C.y.frombytes((c * x + d * y + f).tobytes())
+
+            I = numpy.frombuffer(self.i, dtype=numpy.float64)
+            J = numpy.frombuffer(self.j, dtype=numpy.float64)
+            op = numpy.frombuffer(self.op, dtype=numpy.int8)
+            arcs = op >= 4
+            signed = numpy.zeros(len(I), dtype=bool)
+            signed[numpy.frombuffer(self.arg, dtype=numpy.int32)[arcs]] = op[arcs] >= 7
+            C.i.frombytes(numpy.where(signed, a * I + b * J, abs(a) * I + abs(b) * J).tobytes())
+            C.j.frombytes(numpy.where(signed, c * I + d * J, abs(c) * I + abs(d) * J).tobytes())
+        else:
+            C.x = array.array('d', [a * x + b * y + e for x, y in zip(self.x, self.y)])
+            C.y = array.array('d', [c * x + d * y + f for x, y in zip(self.x, self.y)])
+
+            signed = [False] * len(self.i)
+            for op, arg in zip(self.op, self.arg):
+                if op >= 7:
+                    signed[arg] = True
+            C.i = array.array('d', [a * I + b * J if s else abs(a) * I + abs(b) * J
+                                    for I, J, s in zip(self.i, self.j, signed)])
+            C.j = array.array('d', [c * I + d * J if s else abs(c) * I + abs(d) * J
+                                    for I, J, s in zip(self.i, self.j, signed)])
+
+        return C
+
+
+_CoordinateTables = None
+
+
+def formatCoordinates(x, y):
+    """Format the X and Y parts of draw commands like DrawFormat, for NumPy
+    integer arrays of X and Y coordinates. Returns an array of characters with
+    a 16 character row "X.......Y......." per command, or None if some
+    coordinate does not fit in 7 digits."""
+    global _CoordinateTables
+    if len(x) and (x.min() < 0 or y.min() < 0 or x.max() > 9999999 or y.max() > 9999999):
+        return None
+
+    # Each coordinate is written as 'X' and its top 3 digits, then its bottom 4
+    # digits, each 4 characters looked up as one 32-bit integer
+    if _CoordinateTables is None:
+        _CoordinateTables = tuple(
+            numpy.frombuffer(b''.join([fmt % n for n in range(count)]), dtype=numpy.uint32)
+            for fmt, count in ((b'X%03d', 1000), (b'Y%03d', 1000), (b'%04d', 10000)))
+    X3, Y3, D4 = _CoordinateTables
+
+    rows = numpy.empty((len(x), 4), dtype=numpy.uint32)
+    high, low = numpy.divmod(x, 10000)
+    rows[:, 0] = X3[high]
+    rows[:, 1] = D4[low]
+    high, low = numpy.divmod(y, 10000)
+    rows[:, 2] = Y3[high]
+    rows[:, 3] = D4[low]
+    return rows.view(numpy.uint8).reshape(len(x), 16)
+
+
+class RenderTemplate(object):
+    """The commands of a CommandList compiled for GerberParser.render(), which is
+    called once for every placed instance of a job. Whatever does not depend on
+    where the job is placed is done once, here: string commands are formatted
+    and runs of them joined, and with NumPy the whole layer is rendered into a
+    byte buffer with the X and Y digits of every draw command left as slots.
+    Rendering an instance then only adds the offset to the coordinates and
+    fills in the slots."""
+
+    def __init__(self, commands):
+        C = commands
+        lines = [cmd + '\n' if cmd[0] == '%' else cmd + '*\n' for cmd in C.strings]
+
+        # (0, text) for a run of string commands, (1, x, y, d) for a run of
+        # linear draw commands and (2, arcs) for a run of circular interpolation
+        # commands, where arcs is a list of (X,Y,I,J,D) tuples
+        self.pieces = []
+        for kind, start, end in C.runs():
+            if kind == 0:
+                self.pieces.append((0, ''.join([lines[arg] for arg in C.arg[start:end]])))
+            elif kind == 1:
+                self.pieces.append((1, C.x[start:end], C.y[start:end], C.op[start:end]))
+            else:
+                arcs = []
+                for op, x, y, arg in zip(C.op[start:end], C.x[start:end], C.y[start:end], C.arg[start:end]):
+                    arcs.append((x, y, C.i[arg], C.j[arg], op - 3 if op <= 6 else op - 6))
+                self.pieces.append((2, arcs))
+
+        # Built by compile() when the template is first rendered with NumPy
+        self.buffer = None
+
+    def compile(self):
+        """Render the commands at offset (0,0) into a byte buffer, and note where
+        the X and Y parts of the draw commands are in the buffer. Runs of linear
+        draw commands are rows of the same width, so they are noted as blocks
+        (buffer position, number of rows, first coordinate); circular
+        interpolation commands are noted by the position of each character."""
+        parts = []
+        self.blocks = []
+        x = []
+        y = []
+        arcSlots = []
+        arcX = []
+        arcY = []
+        pos = drawn = 0
+        for piece in self.pieces:
+            if piece[0] == 0:
+                data = piece[1].encode('utf-8')
+            elif piece[0] == 1:
+                kind, xs, ys, d = piece
+                data = (DrawFormat * len(d) % tuple(v for D in d for v in (0, 0, D))).encode('ascii')
+                self.blocks.append((pos, len(d), drawn))
+                drawn += len(d)
+                x.append(numpy.frombuffer(xs, dtype=numpy.float64))
+                y.append(numpy.frombuffer(ys, dtype=numpy.float64))
+            else:
+                rows = []
+                rowpos = pos
+                for X, Y, I, J, D in piece[1]:
+                    rows.append(ArcFormat % (0, 0, I, J, D))
+                    arcSlots.append(rowpos)
+                    arcX.append(X)
+                    arcY.append(Y)
+                    rowpos += len(rows[-1])
+                data = ''.join(rows).encode('ascii')
+            parts.append(data)
+            pos += len(data)
+
+        self.buffer = numpy.frombuffer(b''.join(parts), dtype=numpy.uint8)
+        self.x = numpy.concatenate(x) if x else numpy.zeros(0)
+        self.y = numpy.concatenate(y) if y else numpy.zeros(0)
+        self.arcSlots = (numpy.array(arcSlots, dtype=numpy.int64)[:, None] + numpy.arange(16)).ravel()
+        self.arcX = numpy.array(arcX, dtype=numpy.float64)
+        self.arcY = numpy.array(arcY, dtype=numpy.float64)
+
+    def render(self, DX, DY):
+        "Return the commands as a string, with (DX,DY) added to all coordinates"
+        if numpy is not None:
+            if self.buffer is None:
+                self.compile()
+
+            # Coordinates as they are formatted by %d, i.e., truncated
+            rows = formatCoordinates((self.x + DX).astype(numpy.int64), (self.y + DY).astype(numpy.int64))
+            arcRows = formatCoordinates((self.arcX + DX).astype(numpy.int64), (self.arcY + DY).astype(numpy.int64))
+            if rows is not None and arcRows is not None:
+                out = self.buffer.copy()
+                width = len(DrawFormat % (0, 0, 0))
+                for pos, count, first in self.blocks:
+                    out[pos:pos + width * count].reshape(count, width)[:, :16] = rows[first:first + count]
+                out[self.arcSlots] = arcRows.ravel()
+                return out.tobytes().decode('utf-8')
+
+        # Without NumPy, or when some coordinate does not fit the format, draw
+        # commands are formatted a run at a time
+        out = []
+        for piece in self.pieces:
+            if piece[0] == 0:
+                out.append(piece[1])
+            elif piece[0] == 1:
+                kind, xs, ys, d = piece
+                values = [0] * (3 * len(d))
+                values[0::3] = [x + DX for x in xs]
+                values[1::3] = [y + DY for y in ys]
+                values[2::3] = d
+                out.append(DrawFormat * len(d) % tuple(values))
+            else:
+                for x, y, I, J, d in piece[1]:
+                    out.append(ArcFormat % (x + DX, y + DY, I, J, d))  # I,J are relative
+
+        return ''.join(out)
+
 
 class GerberParser(object):
     def __init__(self):
         # Aperture translation table relative to GAT. Each value
         # is a dictionary where each key is an aperture in the file.
-        # The value is the key in the GAT. Example:
+        # The value is the key in the GAT. It is filled in by
+        # aptable.mergeApertureTables() once all files have been parsed. Example:
         #       apxlat['D10'] = 'D12'
         #       apxlat['D11'] = 'D15'
         #       apxlat['D10'] = 'D15'
@@ -66,7 +485,13 @@ class GerberParser(object):
         #       apxlat['AND10'] = 'M5'
         self.apmxlat = {}
 
-        # Commands are one of:
+        # Aperture and aperture macro definitions found in the file, in the
+        # order they were defined and with their LOCAL codes and names. These
+        # are merged into the GAT and GAMT by aptable.mergeApertureTables().
+        self.apertureDefs = []
+        self.macroDefs = []
+
+        # Commands are stored in a CommandList. They are one of:
         #     A. strings for:
         #           - aperture changes like "D12"
         #           - G-code commands like "G36"
@@ -79,8 +504,7 @@ class GerberParser(object):
         #        the (I,J) tuple is a SIGNED offset (for multi-quadrant circular interpolation)
         #        else the tuple is unsigned.
         #
-        # This variable is, as for apxlat, a dictionary keyed by layer name.
-        self.commands = []
+        self.commands = CommandList()
 
         # This list stores all GLOBAL apertures actually needed by this
         # layer, i.e., apertures specified prior to draw commands.  Each entry
@@ -88,6 +512,9 @@ class GerberParser(object):
         # minimum number of apertures that need to be written out in the Gerber
         # header of the merged file. Once again, the list of apertures refers to
         # GLOBAL aperture codes in the GAT, not ones local to this layer.
+        #
+        # Until resolveApertures() is called, aperture changes in the commands
+        # and in this list are still the LOCAL codes used in the file.
         self.apertures = []
 
         self.attributes = []
@@ -109,18 +536,17 @@ class GerberParser(object):
         self.minx, self.miny, self.maxx, self.maxy = extents
 
     def parse(self, filename, updateExtents=0):
-        """Do the dirty work. Read the Gerber file given the
-           global aperture table GAT and global aperture macro table GAMT"""
+        """Do the dirty work. Read the Gerber file in a single pass, collecting
+           its aperture and aperture macro definitions along with the commands.
+           Aperture codes are local to the file until resolveApertures() is called."""
 
         self.filename = filename
         self.update_extents = updateExtents
 
-        GAT = config.GAT
-        GAMT = config.GAMT
-        # First construct reverse GAT/GAMT, mapping definition to code
-        RevGAT = config.buildRevDict(GAT)     # RevGAT[hash] = aperturename
-        # RevGAMT[hash] = aperturemacroname
-        RevGAMT = config.buildRevDict(GAMT)
+        # Local aperture codes and macro names defined so far. Macro names
+        # map to themselves as parseAperture() expects a translation table.
+        localCodes = set()
+        localMacros = {}
 
         # print('Reading data from %s ...' % filename)
 
@@ -176,7 +602,7 @@ class GerberParser(object):
             # '%'.
             match = layerpol_pat.match(line)
             if match:
-                self.commands.append(line)
+                self.commands.appendString(line)
                 continue
 
             match = units_pat.match(line)
@@ -198,22 +624,15 @@ class GerberParser(object):
                     raise RuntimeError(
                         "File %s has an aperture definition that comes after drawing commands." % self.filename)
 
-                A = aptable.parseAperture(line, self.apmxlat)
+                A = aptable.parseAperture(line, localMacros)
                 if not A:
                     raise RuntimeError(
                         "Unknown aperture definition in file %s" % self.filename)
 
-                hash = A.hash()
-                if hash not in RevGAT:
-                    # print(line)
-                    # print(self.apmxlat)
-                    # print(RevGAT)
-                    raise RuntimeError(
-                        'File %s has aperture definition "%s" not in global aperture table.' % (self.filename, hash))
-
-                # This says that all draw commands with this aperture code will
-                # be replaced by aperture self.apxlat[code].
-                self.apxlat[A.code] = RevGAT[hash]
+                # The global code for this aperture is assigned when all files
+                # have been read.
+                self.apertureDefs.append(A)
+                localCodes.add(A.code)
                 continue
 
             # Ignore %AMOC8* from Eagle for now as it uses a macro parameter, which
@@ -234,53 +653,44 @@ class GerberParser(object):
                     raise RuntimeError(
                         "File %s has an aperture macro definition that comes after drawing commands." % self.filename)
 
-                hash = M.hash()
-                if hash not in RevGAMT:
-                    raise RuntimeError(
-                        'File %s has aperture macro definition not in global aperture macro table:\n%s' % (self.filename, hash))
-
-                # This says that all aperture definition commands that reference this macro name
-                # will be replaced by aperture macro name
-                # self.apmxlat[macroname].
-                self.apmxlat[M.name] = RevGAMT[hash]
+                self.macroDefs.append(M)
+                localMacros[M.name] = M.name
                 continue
 
-            # From this point on we may have more than one match on this line, e.g.:
+            # From this point on we may have more than one token on this line, e.g.:
             #   G54D11*X22400Y22300D02*X22500Y22200D01*
-            sub_line = line
-            while sub_line:
-                # Handle "comment" G-codes first
-                match = comment_pat.match(sub_line)
-                if match:
-                    sub_line = sub_line[match.end():]
+            for kind, groups, pos in tokenize(line):
+                # If it's none of the tokens we know, and not on our ignore
+                # list either, we have to give up.
+                if kind is None:
+                    raise RuntimeError(
+                        'File %s has uninterpretable line:\n  %s' % (self.filename, line))
+
+                # "Comment" G-codes and anything on the ignore list
+                if kind in ('comment', 'ignore'):
                     continue
 
-                # See if this is a format statement, and if so, map it. In version 1.3 this was moved down
-                # from the line-only parse checks above (see comment) to handle OrCAD lines like
+                # A format statement. In version 1.3 this was moved down from the
+                # line-only parse checks to handle OrCAD lines like
                 # G74*%FSLAN2X34Y34*%
-                # Used to be format_pat.search
-                match = format_pat.match(sub_line)
-                if match:
-                    if match.group('zeros') != "L":
+                if kind == 'format':
+                    zeros, coord_mode, _, x_fmt, y_fmt = groups
+                    if zeros != "L":
                         raise RuntimeError("RS274X only allows Leading Zero mode")
-                    
-                    if match.group('coord_mode') != "A":
+
+                    if coord_mode != "A":
                         raise RuntimeError("RS274X only allows Absolute Coordinates")
 
-                    self.x_fmt = match.group('x')
-                    self.y_fmt = match.group('y')
-                    
-                    self.x_div = 10.0**(-int(match.group('x')[1]))
-                    self.y_div = 10.0**(-int(match.group('y')[1]))
+                    self.x_fmt = x_fmt
+                    self.y_fmt = y_fmt
 
-                    sub_line = sub_line[match.end():]
+                    self.x_div = 10.0**(-int(x_fmt[1]))
+                    self.y_div = 10.0**(-int(y_fmt[1]))
                     continue
 
                 # Parse and interpret G-codes
-                match = gcode_pat.match(sub_line)
-                if match:
-                    sub_line = sub_line[match.end():]
-                    gcode = int(match.group(1))
+                if kind == 'gcode':
+                    gcode = int(groups[0])
 
                     # Determine if this is a G-Code that should be ignored because it has no effect
                     # (e.g., G70 specifies "inches" which is already in effect).
@@ -291,7 +701,7 @@ class GerberParser(object):
                     # Determine if this is a G-Code that we have to emit
                     # because it matters.
                     if gcode in [1, 2, 3, 36, 37, 74, 75]:
-                        self.commands.append("G%02d" % gcode)
+                        self.commands.appendString("G%02d" % gcode)
 
                         # Determine if this is a G-code that sets a new mode
                         if gcode in [1, 36, 37]:
@@ -310,10 +720,8 @@ class GerberParser(object):
                         "G-Code 'G%02d' is not supported" % gcode)
 
                 # See if this is a tool change (aperture change) command
-                match = tool_pat.match(sub_line)
-
-                if match:
-                    currtool = match.group(1)
+                if kind == 'tool':
+                    currtool = groups[0]
 
                     # Diptrace hack
                     # There is a D2* command in board outlines. I believe this should be D02.
@@ -335,145 +743,124 @@ class GerberParser(object):
                     # case.
                     if currtool == 'D01' or (
                             currtool == 'D02' and (last_gmode != 36)):
-                        sub_line = sub_line[match.end():]
                         continue
 
                     if (currtool == 'D03') or (
                             currtool == 'D02' and (last_gmode == 36)):
-                        self.commands.append(currtool)
-                        sub_line = sub_line[match.end():]
+                        self.commands.appendString(currtool)
                         continue
 
-                    # Map it using our translation table
-                    if currtool not in self.apxlat:
+                    # It must be one of the apertures defined in this file. It
+                    # is mapped to its global code by resolveApertures().
+                    if currtool not in localCodes:
                         raise RuntimeError(
                             'File %s has tool change command "%s" with no corresponding translation' % (self.filename, currtool))
 
-                    currtool = self.apxlat[currtool]
-
                     # Add it to the list of things to write out
-                    self.commands.append(currtool)
+                    self.commands.appendString(currtool)
 
                     # Add it to the list of all apertures needed by this layer
                     self.apertures.append(currtool)
-
-                    # Move on to next match, if any
-                    sub_line = sub_line[match.end():]
                     continue
 
-                # Is it a simple draw command?
-                I = J = None  # For circular interpolation drawing commands
-                match = drawXY_pat.match(sub_line)
+                # Otherwise it is a draw command, either a simple one or a
+                # circular interpolation draw command with IJ components.
+                I = J = None
                 isLastShorthand = False    # By default assume we don't make use of last_x and last_y
-                if match:
-                    x, y, d = map(builtins.int, match.groups())
+                if kind == 'drawXY':
+                    x, y, d = map(builtins.int, groups)
+                elif kind == 'drawX':
+                    x, d = map(builtins.int, groups)
+                    y = last_y
+                    isLastShorthand = True  # Indicate we're making use of last_x/last_y
+                elif kind == 'drawY':
+                    y, d = map(builtins.int, groups)
+                    x = last_x
+                    isLastShorthand = True  # Indicate we're making use of last_x/last_y
+                elif kind == 'cdrawXY':
+                    x, y, I, J, d = map(builtins.int, groups)
+                elif kind == 'cdrawX':
+                    x, I, J, d = map(builtins.int, groups)
+                    y = last_y
+                    isLastShorthand = True  # Indicate we're making use of last_x/last_y
                 else:
-                    match = drawX_pat.match(sub_line)
-                    if match:
-                        x, d = map(builtins.int, match.groups())
-                        y = last_y
-                        isLastShorthand = True  # Indicate we're making use of last_x/last_y
-                    else:
-                        match = drawY_pat.match(sub_line)
-                        if match:
-                            y, d = map(builtins.int, match.groups())
-                            x = last_x
-                            isLastShorthand = True  # Indicate we're making use of last_x/last_y
-
-                # Maybe it's a circular interpolation draw command with IJ
-                # components
-                if match is None:
-                    match = cdrawXY_pat.match(sub_line)
-                    if match:
-                        x, y, I, J, d = map(builtins.int, match.groups())
-                    else:
-                        match = cdrawX_pat.match(sub_line)
-                        if match:
-                            x, I, J, d = map(builtins.int, match.groups())
-                            y = last_y
-                            isLastShorthand = True  # Indicate we're making use of last_x/last_y
-                        else:
-                            match = cdrawY_pat.match(sub_line)
-                            if match:
-                                y, I, J, d = map(builtins.int, match.groups())
-                                x = last_x
-                                isLastShorthand = True  # Indicate we're making use of last_x/last_y
-                if match:
-                    if currtool is None:
-                        # It's OK if this is an exposure-off movement command (specified with D02).
-                        # It's also OK if we're in the middle of a G36 polygon fill as we're only defining
-                        # the polygon extents.
-                        if (d != 2) and (last_gmode != 36):
-                            raise RuntimeError(
-                                'File %s has draw command %s with no aperture chosen' % (self.filename, sub_line))
-
-                    # Save last_x/y BEFORE scaling to 2.5 format else subsequent single-ordinate
-                    # flashes (e.g., Y with no X) will be scaled twice!
-                    last_x = x
-                    last_y = y
-
-                    # Corner case: if this is the first flash/draw and we are using shorthand (i.e., missing Xxxx
-                    # or Yxxxxx) then prepend the point X0000Y0000 into the commands as it is actually the starting
-                    # point of our layer. We prepend the command X0000Y0000D02,
-                    # i.e., a move to (0,0) without drawing.
-                    if (isLastShorthand and firstFlash):
-                        self.commands.append((0, 0, 2))
-                        if self.update_extents:
-                            self.minx = min(self.minx, 0)
-                            self.maxx = max(self.maxx, 0)
-                            self.miny = min(self.miny, 0)
-                            self.maxy = max(self.maxy, 0)
-
-                    x = round(x * self.x_div, int(self.x_fmt[1]))
-                    y = round(y * self.y_div, int(self.y_fmt[1]))
-                    if I is not None:
-                        I = round(I * self.x_div, int(self.x_fmt[1]))
-                        J = round(J * self.y_div, int(self.y_fmt[1]))
-                        self.commands.append(
-                            (x, y, I, J, d, circ_signed))
-                    else:
-                        self.commands.append((x, y, d))
-                    firstFlash = False
-
-                    # Update dimensions...this is complicated for circular interpolation commands
-                    # that span more than one quadrant. For now, we ignore this problem since users
-                    # should be using a border layer to indicate extents.
+                    y, I, J, d = map(builtins.int, groups)
+                    x = last_x
+                    isLastShorthand = True  # Indicate we're making use of last_x/last_y
+
+                if currtool is None:
+                    # It's OK if this is an exposure-off movement command (specified with D02).
+                    # It's also OK if we're in the middle of a G36 polygon fill as we're only defining
+                    # the polygon extents.
+                    if (d != 2) and (last_gmode != 36):
+                        raise RuntimeError(
+                            'File %s has draw command %s with no aperture chosen' % (self.filename, line[pos:]))
+
+                # Save last_x/y BEFORE scaling to 2.5 format else subsequent single-ordinate
+                # flashes (e.g., Y with no X) will be scaled twice!
+                last_x = x
+                last_y = y
+
+                # Corner case: if this is the first flash/draw and we are using shorthand (i.e., missing Xxxx
+                # or Yxxxxx) then prepend the point X0000Y0000 into the commands as it is actually the starting
+                # point of our layer. We prepend the command X0000Y0000D02,
+                # i.e., a move to (0,0) without drawing.
+                if (isLastShorthand and firstFlash):
+                    self.commands.appendDraw(0, 0, 2)
                     if self.update_extents:
-                        if x < self.minx:
-                            self.minx = x
-                        if x > self.maxx:
-                            self.maxx = x
-                        if y < self.miny:
-                            self.miny = y
-                        if y > self.maxy:
-                            self.maxy = y
-
-                    # Move on to next match, if any
-                    sub_line = sub_line[match.end():]
-                    continue
-
-                # If it's none of the above, it had better be on our ignore
-                # list.
-                for pat in IgnoreList:
-                    match = pat.match(sub_line)
-                    if match:
-                        break
+                        self.minx = min(self.minx, 0)
+                        self.maxx = max(self.maxx, 0)
+                        self.miny = min(self.miny, 0)
+                        self.maxy = max(self.maxy, 0)
+
+                x = round(x * self.x_div, int(self.x_fmt[1]))
+                y = round(y * self.y_div, int(self.y_fmt[1]))
+                if I is not None:
+                    I = round(I * self.x_div, int(self.x_fmt[1]))
+                    J = round(J * self.y_div, int(self.y_fmt[1]))
+                    self.commands.appendArc(x, y, I, J, d, circ_signed)
                 else:
-                    raise RuntimeError(
-                        'File %s has uninterpretable line:\n  %s' % (self.filename, line))
-
-                sub_line = sub_line[match.end():]
-            # end while still things to match on this line
+                    self.commands.appendDraw(x, y, d)
+                firstFlash = False
+
+                # Update dimensions...this is complicated for circular interpolation commands
+                # that span more than one quadrant. For now, we ignore this problem since users
+                # should be using a border layer to indicate extents.
+                if self.update_extents:
+                    if x < self.minx:
+                        self.minx = x
+                    if x > self.maxx:
+                        self.maxx = x
+                    if y < self.miny:
+                        self.miny = y
+                    if y > self.maxy:
+                        self.maxy = y
+            # end for each token on this line
         # end of for each line in file
 
         fid.close()
         if 0:
             print(self.commands)
 
+    def resolveApertures(self):
+        """Replace the local aperture codes in the commands and aperture list with
+           the global codes in apxlat, as set up by aptable.mergeApertureTables()"""
+        apxlat = self.apxlat
+
+        # D01/D02/D03 commands are stored as strings too but are never aperture changes
+        def translate(cmd):
+            if cmd in apxlat and cmd not in ('D01', 'D02', 'D03'):
+                return apxlat[cmd]
+            return cmd
+
+        self.commands.mapStrings(translate)
+
+        self.apertures = [apxlat[code] for code in self.apertures]
+
     def trim(self):
         "Modify drawing commands that are outside job dimensions"
 
-        newcmds = []
+        newcmds = CommandList()
         lastInBorders = True
         # (minx,miny,exposure off)
         lastx, lasty = self.minx, self.miny
@@ -678,6 +1065,12 @@ class GerberParser(object):
 
         self.commands = newcmds
 
+    def remapApertures(self, remap):
+        """Replace each aperture change to a global aperture code that is a key
+        of remap with a change to the code it maps to"""
+        self.commands.mapStrings(lambda cmd: remap.get(cmd, cmd))
+        self.apertures = [remap.get(code, code) for code in self.apertures]
+
     def makeLocalApertureCode(self, AP):
         "Find or create a layer-specific aperture code to represent the global aperture given"
         if AP.code not in self.apxlat.values():
@@ -688,6 +1081,12 @@ class GerberParser(object):
 
     def write(self, fid, Xoff, Yoff):
         "Write out the data such that the lower-left corner of this job is at the given (X,Y) position, in inches"
+        fid.write(self.render(Xoff, Yoff))
+
+    def render(self, Xoff, Yoff):
+        """Return the data written by write() as a single string. The commands are
+        compiled into a template the first time a job is rendered, so each further
+        instance of the job costs little more than the bytes it writes."""
 
         X = int(round(Xoff / self.x_div))
         Y = int(round(Yoff / self.y_div))
@@ -701,22 +1100,8 @@ class GerberParser(object):
         # (exposure off). This prevents an unintentional draw from the end
         # of one job to the beginning of the next when a layer is repeated
         # due to panelizing.
-        fid.write('X%07dY%07dD02*\n' % (X, Y))
-        for cmd in self.commands:
-            if isinstance(cmd, tuple):
-                if len(cmd) == 3:
-                    x, y, d = cmd
-                    fid.write('X%07dY%07dD%02d*\n' % (x + DX, y + DY, d))
-                else:
-                    x, y, I, J, d, s = cmd
-                    fid.write('X%07dY%07dI%07dJ%07dD%02d*\n' %
-                              (x + DX, y + DY, I, J, d))  # I,J are relative
-            else:
-                # It's an aperture change, G-code, or RS274-X command that begins with '%'. If
-                # it's an aperture code, the aperture has already been translated
-                # to the global aperture table during the parse phase.
-                if cmd[0] == '%':
-                    # The command already has a * in it (e.g., "%LPD*%")
-                    fid.write('%s\n' % cmd)
-                else:
-                    fid.write('%s*\n' % cmd)
+        #
+        # Aperture changes, G-codes and RS274-X commands that begin with '%'
+        # follow as they are. If it's an aperture code, the aperture has already
+        # been translated to the global aperture table during the parse phase.
+        return 'X%07dY%07dD02*\n' % (X, Y) + self.commands.template().render(DX, DY)
@@ -24,11 +24,13 @@ Rugged Circuits LLC
 http://ruggedcircuits.com/gerbmerge
 """
 
+import functools
+import multiprocessing
 import sys
 
 from . import (aptable, config, drillcluster, fabdrawing, jobs, parselayout,
-               placement, schwartz, scoring, strokes, tilesearch1, tilesearch2,
-               util)
+               placement, projectstate, schwartz, scoring, strokes, tilepack,
+               tilesearch1, tilesearch2, tilesearch3, util)
 
 
 VERSION_MAJOR = 1
@@ -37,6 +39,8 @@ VERSION_MINOR = '9b'
 RANDOM_SEARCH = 1
 EXHAUSTIVE_SEARCH = 2
 FROM_FILE = 3
+ANNEAL_SEARCH = 4
+PACK_SEARCH = 5
 config.AutoSearchType = RANDOM_SEARCH
 config.RandomSearchExhaustiveJobs = 2
 config.PlacementFile = None
@@ -44,6 +48,14 @@ config.PlacementFile = None
 # This is a handle to a GUI front end, if any, else None for command-line usage
 GUI = None
 
+# Size in bytes of the write buffer of each merged output file. Jobs are written
+# a whole layer at a time, so a large buffer saves many small writes.
+OutputBufferSize = 1 << 20
+
+# Functions writing the output files, for the worker processes forked by
+# writeOutputFiles()
+_OutputTasks = None
+
 
 # changed these two writeGerberHeader files to take metric units (mm) into
 # account:
@@ -131,6 +143,36 @@ def writeExcellonTool(fid, tool):
     fid.write('%s\n' % tool)
 
 
+def _writeOutputFile(ix):
+    global GUI
+    GUI = None
+    _OutputTasks[ix]()
+
+
+def writeOutputFiles(tasks):
+    """Call each function in tasks, each of which writes one output file. With
+    more than one worker the files are written in a pool of worker processes.
+    The workers are forked so that they share the merged jobs and aperture
+    tables, so where processes cannot be forked the files are written one at
+    a time."""
+    global _OutputTasks
+    if config.Workers <= 1 or len(tasks) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for task in tasks:
+            task()
+        return
+
+    _OutputTasks = tasks
+    try:
+        with multiprocessing.get_context('fork').Pool(min(config.Workers, len(tasks))) as pool:
+            result = pool.map_async(_writeOutputFile, range(len(tasks)), chunksize=1)
+            while not result.ready():
+                updateGUI("Writing merged output files...")
+                result.wait(0.1)
+            result.get()
+    finally:
+        _OutputTasks = None
+
+
 def writeFiducials(fid, drawcode, OriginX, OriginY, MaxXExtent, MaxYExtent):
     """Place fiducials at arbitrary points. The FiducialPoints list in the config specifies
     sets of X,Y co-ordinates. Positive values of X/Y represent offsets from the lower left
@@ -254,11 +296,14 @@ Any other key will exit the program.
     sys.exit(0)
 
 
-def tile_jobs(Jobs):
-    """Take a list of raw Job objects and find best tiling by calling tile_search"""
+def tile_jobs(Jobs, state=None):
+    """Take a list of raw Job objects and find best tiling by calling tile_search.
+    With a ProjectState 'state', the tiling found for the same jobs and search by
+    the last run is used if there is one, and a new tiling is stored in it."""
 
     # We must take the raw jobs and construct a list of 4-tuples (Xdim,Ydim,job,rjob).
-    # This means we must construct a rotated job for each entry. We first sort all
+    # The rotated job 'rjob' is a jobs.RotatedJob that only knows its dimensions;
+    # the job is actually rotated only if the final tiling uses it. We first sort all
     # jobs from largest to smallest. This should give us the best tilings first so
     # we can interrupt the tiling process and get a decent layout.
     L = []
@@ -272,16 +317,34 @@ def tile_jobs(Jobs):
         # NOTE: This will only try 90 degree rotations though 180 & 270 are
         # available
 
-        rjob = jobs.rotateJob(job, 90)
+        rjob = jobs.RotatedJob(job, 90)
 
         for count in range(job.Repeat):
             L.append((Xdim, Ydim, job, rjob))
 
     PX, PY = config.Config['panelwidth'], config.Config['panelheight']
-    if config.AutoSearchType == RANDOM_SEARCH:
-        tile = tilesearch2.tile_search2(L, PX, PY)
+
+    # A resumed search is carried on rather than replaced by the last tiling
+    searchName = 'search%d' % config.AutoSearchType
+    if state is not None and not config.ResumeSearch:
+        tile = state.restoreTiling(searchName, L, PX, PY)
+        if tile:
+            print("Using placement from project state file '%s'. Remove the file to search again." % state.fname)
+            return tile
+
+    if config.AutoSearchType == PACK_SEARCH:
+        tile = tilepack.tile_pack(L, PX, PY)
     else:
-        tile = tilesearch1.tile_search1(L, PX, PY)
+        # Bin packing is quick and gives the searches a good placement to
+        # start from, which they then only replace with a better one.
+        best = tilepack.pack(L, PX, PY)
+
+        if config.AutoSearchType == RANDOM_SEARCH:
+            tile = tilesearch2.tile_search2(L, PX, PY, best)
+        elif config.AutoSearchType == ANNEAL_SEARCH:
+            tile = tilesearch3.tile_search3(L, PX, PY, best)
+        else:
+            tile = tilesearch1.tile_search1(L, PX, PY, best)
 
     if not tile:
         # add metric support (1/1000 mm vs. 1/100,000 inch)
@@ -292,6 +355,9 @@ def tile_jobs(Jobs):
             raise RuntimeError(
                 'Panel size %.2fmmx%.2fmm is too small to hold jobs' % (PX, PY))
 
+    if state is not None:
+        state.saveTiling(tile, searchName, L, PX, PY)
+
     return tile
 
 
@@ -312,14 +378,31 @@ def merge(args, gui=None):
         config.AutoSearchType = RANDOM_SEARCH
     elif args.full_search:
         config.AutoSearchType = EXHAUSTIVE_SEARCH
+    elif args.anneal_search:
+        config.AutoSearchType = ANNEAL_SEARCH
+    elif args.pack:
+        config.AutoSearchType = PACK_SEARCH
 
     config.RandomSearchExhaustiveJobs = args.rs_fsjobs
     config.SearchTimeout = args.search_timeout
+    config.Workers = max(args.jobs, 1)
+
+    if args.resume and not args.checkpoint:
+        raise RuntimeError("--resume needs the checkpoint file given with --checkpoint")
+    config.CheckpointFile = args.checkpoint
+    config.ResumeSearch = args.resume
+    config.StateFile = args.state
 
     if args.place_file:
         config.AutoSearchType = FROM_FILE
         config.PlacementFile = args.place_file
 
+    if args.no_cache:
+        config.ParseCache = 0
+    if args.cache_dir:
+        config.ParseCacheDir = args.cache_dir
+    config.ParseCacheSize = args.cache_size * 1024 * 1024
+
     if args.no_trim_gerber:
         config.TrimGerber = 0
 
@@ -332,10 +415,19 @@ def merge(args, gui=None):
     if (skipDisclaimer == 0):
         disclaimer()
 
+    # Jobs and placements that have not changed since the last run are taken
+    # from the project state file, if there is one
+    state = None
+    if config.StateFile:
+        state = projectstate.ProjectState(config.StateFile)
+
     # Load up the Jobs global dictionary, also filling out GAT, the
     # global aperture table and GAMT, the global aperture macro table.
     updateGUI("Reading job files...")
-    config.parseConfigFile(args.configfile)
+    config.parseConfigFile(args.configfile, state=state)
+
+    # Jobs from the project state file are already trimmed
+    restored = state is not None and state.jobsRestored
 
     # Force all X and Y coordinates positive by adding absolute value of
     # minimum X and Y
@@ -367,18 +459,23 @@ def merge(args, gui=None):
         print("\n")
 
     # Trim drill locations and flash data to board extents
-    if config.TrimExcellon:
+    if config.TrimExcellon and not restored:
         updateGUI("Trimming Excellon data...")
         print('Trimming Excellon data to board outlines ...')
         for job in config.Jobs.values():
             job.trimExcellon()
 
-    if config.TrimGerber:
+    if config.TrimGerber and not restored:
         updateGUI("Trimming Gerber data...")
         print('Trimming Gerber data to board outlines ...')
         for job in config.Jobs.values():
             job.trimGerber()
 
+    # Keep the jobs as they are now for the next run. Everything done to them
+    # from here on depends on the placement and output options.
+    if state is not None and not restored:
+        state.saveJobs(config.Jobs)
+
     # We start origin at (0.1", 0.1") just so we don't get numbers close to 0
     # which could trip up Excellon leading-0 elimination.
     # I don't want to change the origin. If this a code bug, then it should be
@@ -412,7 +509,7 @@ def merge(args, gui=None):
         Place.addFromFile(config.PlacementFile, config.Jobs)
     else:
         # Do an automatic layout based on our tiling algorithm.
-        tile = tile_jobs(config.Jobs.values())
+        tile = tile_jobs(config.Jobs.values(), state)
 
         Place.addFromTiling(
             tile, OriginX + config.Config['leftmargin'], OriginY + config.Config['bottommargin'])
@@ -469,6 +566,58 @@ def merge(args, gui=None):
     updateGUI("Writing merged files...")
     print('Writing merged output files ...')
 
+    # Each output file is written by one of these functions, so that the files
+    # can be written in parallel
+    tasks = []
+
+    def writeLayer(fullname, layername, apUsedDict, apmUsedDict):
+        fid = open(fullname, 'wt', buffering=OutputBufferSize)
+        writeGerberHeader(fid)
+
+        # Write only necessary macro and aperture definitions to Gerber file
+        writeApertureMacros(fid, apmUsedDict)
+        writeApertures(fid, apUsedDict)
+
+        # for row in Layout:
+        #  row.writeGerber(fid, layername)
+
+        #  # Do cut lines
+        #  if config.Config['cutlinelayers'] and (layername in config.Config['cutlinelayers']):
+        #    fid.write('%s*\n' % drawing_code_cut)    # Choose drawing aperture
+        #    row.writeCutLines(fid, drawing_code_cut, OriginX, OriginY, MaxXExtent, MaxYExtent)
+
+        # Finally, write actual flash data
+        for job in Place.jobs:
+
+            updateGUI("Writing merged output files...")
+            job.writeGerber(fid, layername)
+
+            if config.Config['cutlinelayers'] and (
+                    layername in config.Config['cutlinelayers']):
+                # Choose drawing aperture
+                fid.write('%s*\n' % drawing_code_cut)
+                # print("writing drawcode_cut: %s" % drawing_code_cut)
+                job.writeCutLines(fid, drawing_code_cut, OriginX,
+                                  OriginY, MaxXExtent, MaxYExtent)
+
+        if config.Config['cropmarklayers']:
+            if layername in config.Config['cropmarklayers']:
+                writeCropMarks(fid, drawing_code_crop, OriginX,
+                               OriginY, MaxXExtent, MaxYExtent)
+
+        if config.Config['fiducialpoints']:
+            if ((layername == '*toplayer') or (layername == '*bottomlayer')):
+                writeFiducials(fid, drawing_code_fiducial_copper,
+                               OriginX, OriginY, MaxXExtent, MaxYExtent)
+            elif ((layername == '*topsoldermask') or (layername == '*bottomsoldermask')):
+                writeFiducials(fid, drawing_code_fiducial_soldermask,
+                               OriginX, OriginY, MaxXExtent, MaxYExtent)
+
+        writeGerberFooter(fid)
+        fid.close()
+
+    # The apertures of every layer are worked out before any layer is written,
+    # as thickening features adds apertures to the global aperture table.
     for layername in config.LayerList.keys():
         lname = layername
         if lname[0] == '*':
@@ -480,8 +629,6 @@ def merge(args, gui=None):
             fullname = 'merged.%s.ger' % lname
         OutputFiles.append(fullname)
         # print('Writing %s ...' % fullname)
-        fid = open(fullname, 'wt')
-        writeGerberHeader(fid)
 
         # Determine which apertures and macros are truly needed
         apUsedDict = {}
@@ -497,7 +644,9 @@ def merge(args, gui=None):
 
             print('  Thickening', lname, 'feature dimensions ...')
 
-            # Fix each aperture used in this layer
+            # Fix each aperture used in this layer, noting which aperture
+            # replaces it
+            remap = {}
             for ap in list(apUsedDict.keys()):
                 new = config.GAT[ap].getAdjusted(
                     config.MinimumFeatureDimension[layername])
@@ -506,24 +655,21 @@ def merge(args, gui=None):
                 else:  # new aperture was created
                     # get name of existing aperture or create new one if needed
                     new_code = aptable.findOrAddAperture(new)
+                    remap[ap] = new_code
                     # the old aperture is no longer used in this layer
                     del apUsedDict[ap]
                     # the new aperture will be used in this layer
                     apUsedDict[new_code] = None
 
-                    # Replace all references to the old aperture with the new
-                    # one
-                    for joblayout in Place.jobs:
-                        job = joblayout.job  # access job inside job layout
-                        temp = []
-                        if job.hasLayer(layername):
-                            for x in job.gerbers[layername].commands:
-                                if x == ap:
-                                    # replace old aperture with new one
-                                    temp.append(new_code)
-                                else:
-                                    temp.append(x)  # keep old command
-                            job.gerbers[layername].commands = temp
+            # Replace all references to the old apertures with the new ones,
+            # once for each job however many times it is placed
+            if remap:
+                remapped = set()
+                for joblayout in Place.jobs:
+                    job = joblayout.job  # access job inside job layout
+                    if job.hasLayer(layername) and id(job) not in remapped:
+                        remapped.add(id(job))
+                        job.gerbers[layername].remapApertures(remap)
 
         if config.Config['cutlinelayers'] and (
                 layername in config.Config['cutlinelayers']):
@@ -539,54 +685,11 @@ def merge(args, gui=None):
             elif ((layername == '*topsoldermask') or (layername == '*bottomsoldermask')):
                 apUsedDict[drawing_code_fiducial_soldermask] = None
 
-        # Write only necessary macro and aperture definitions to Gerber file
-        writeApertureMacros(fid, apmUsedDict)
-        writeApertures(fid, apUsedDict)
-
-        # for row in Layout:
-        #  row.writeGerber(fid, layername)
-
-        #  # Do cut lines
-        #  if config.Config['cutlinelayers'] and (layername in config.Config['cutlinelayers']):
-        #    fid.write('%s*\n' % drawing_code_cut)    # Choose drawing aperture
-        #    row.writeCutLines(fid, drawing_code_cut, OriginX, OriginY, MaxXExtent, MaxYExtent)
-
-        # Finally, write actual flash data
-        for job in Place.jobs:
-
-            updateGUI("Writing merged output files...")
-            job.writeGerber(fid, layername)
-
-            if config.Config['cutlinelayers'] and (
-                    layername in config.Config['cutlinelayers']):
-                # Choose drawing aperture
-                fid.write('%s*\n' % drawing_code_cut)
-                # print("writing drawcode_cut: %s" % drawing_code_cut)
-                job.writeCutLines(fid, drawing_code_cut, OriginX,
-                                  OriginY, MaxXExtent, MaxYExtent)
-
-        if config.Config['cropmarklayers']:
-            if layername in config.Config['cropmarklayers']:
-                writeCropMarks(fid, drawing_code_crop, OriginX,
-                               OriginY, MaxXExtent, MaxYExtent)
-
-        if config.Config['fiducialpoints']:
-            if ((layername == '*toplayer') or (layername == '*bottomlayer')):
-                writeFiducials(fid, drawing_code_fiducial_copper,
-                               OriginX, OriginY, MaxXExtent, MaxYExtent)
-            elif ((layername == '*topsoldermask') or (layername == '*bottomsoldermask')):
-                writeFiducials(fid, drawing_code_fiducial_soldermask,
-                               OriginX, OriginY, MaxXExtent, MaxYExtent)
-
-        writeGerberFooter(fid)
-        fid.close()
+        tasks.append(functools.partial(writeLayer, fullname, layername, apUsedDict, apmUsedDict))
 
     # Write board outline layer if selected
-    fullname = config.Config['outlinelayerfile']
-    if fullname and fullname.lower() != "none":
-        OutputFiles.append(fullname)
-        # print('Writing %s ...' % fullname)
-        fid = open(fullname, 'wt')
+    def writeOutline(fullname):
+        fid = open(fullname, 'wt', buffering=OutputBufferSize)
         writeGerberHeader(fid)
 
         # Write width-1 aperture to file
@@ -616,12 +719,15 @@ def merge(args, gui=None):
         writeGerberFooter(fid)
         fid.close()
 
-    # Write scoring layer if selected
-    fullname = config.Config['scoringfile']
+    fullname = config.Config['outlinelayerfile']
     if fullname and fullname.lower() != "none":
         OutputFiles.append(fullname)
         # print('Writing %s ...' % fullname)
-        fid = open(fullname, 'wt')
+        tasks.append(functools.partial(writeOutline, fullname))
+
+    # Write scoring layer if selected
+    def writeScoringLayer(fullname):
+        fid = open(fullname, 'wt', buffering=OutputBufferSize)
         writeGerberHeader(fid)
 
         # Write width-1 aperture to file
@@ -638,6 +744,12 @@ def merge(args, gui=None):
         writeGerberFooter(fid)
         fid.close()
 
+    fullname = config.Config['scoringfile']
+    if fullname and fullname.lower() != "none":
+        OutputFiles.append(fullname)
+        # print('Writing %s ...' % fullname)
+        tasks.append(functools.partial(writeScoringLayer, fullname))
+
     # Get a list of all tools used by merging keys from each job's dictionary
     # of tools.
     if 0:
@@ -674,15 +786,8 @@ def merge(args, gui=None):
         # Tools is just a list of tool names
         Tools = sorted(config.GlobalToolMap.keys())
 
-    fullname = config.Config['fabricationdrawingfile']
-    if fullname and fullname.lower() != 'none':
-        if len(Tools) > strokes.MaxNumDrillTools:
-            raise RuntimeError(
-                "Only %d different tool sizes supported for fabrication drawing." % strokes.MaxNumDrillTools)
-
-        OutputFiles.append(fullname)
-        # print('Writing %s ...' % fullname)
-        fid = open(fullname, 'wt')
+    def writeFabLayer(fullname):
+        fid = open(fullname, 'wt', buffering=OutputBufferSize)
         writeGerberHeader(fid)
         writeApertures(fid, {drawing_code1: None})
         fid.write('%s*\n' % drawing_code1)    # Choose drawing aperture
@@ -693,44 +798,54 @@ def merge(args, gui=None):
         writeGerberFooter(fid)
         fid.close()
 
-    # Finally, print out the Excellon
-    try:
-        fullname = config.MergeOutputFiles['drills']
-    except KeyError:
-        fullname = 'merged.drills.xln'
-    OutputFiles.append(fullname)
-    # print('Writing %s ...' % fullname)
-    fid = open(fullname, 'wt')
+    fullname = config.Config['fabricationdrawingfile']
+    if fullname and fullname.lower() != 'none':
+        if len(Tools) > strokes.MaxNumDrillTools:
+            raise RuntimeError(
+                "Only %d different tool sizes supported for fabrication drawing." % strokes.MaxNumDrillTools)
+
+        OutputFiles.append(fullname)
+        # print('Writing %s ...' % fullname)
+        tasks.append(functools.partial(writeFabLayer, fullname))
 
-    writeExcellonHeader(fid)
+    # Finally, print out the Excellon
     for tool in Tools:
-        try:
-            size = config.GlobalToolMap[tool]
-        except Exception:
+        if tool not in config.GlobalToolMap:
             raise RuntimeError(
                 "INTERNAL ERROR: Tool code %s not found in global tool map" % tool)
 
-        writeExcellonToolHeader(fid, tool, size)
-    writeExcellonEndHeader(fid)
+    def writeDrills(fullname):
+        fid = open(fullname, 'wt', buffering=OutputBufferSize)
 
-    # Ensure each one of our tools is represented in the tool list specified
-    # by the user.
-    for tool in Tools:
-        try:
+        writeExcellonHeader(fid)
+        for tool in Tools:
+            writeExcellonToolHeader(fid, tool, config.GlobalToolMap[tool])
+        writeExcellonEndHeader(fid)
+
+        # Ensure each one of our tools is represented in the tool list specified
+        # by the user.
+        for tool in Tools:
             size = config.GlobalToolMap[tool]
-        except Exception:
-            raise RuntimeError(
-                "INTERNAL ERROR: Tool code %s not found in global tool map" % tool)
 
-        writeExcellonTool(fid, tool)
+            writeExcellonTool(fid, tool)
 
-        # for row in Layout:
-        #  row.writeExcellon(fid, size)
-        for job in Place.jobs:
-            job.writeExcellon(fid, size)
+            # for row in Layout:
+            #  row.writeExcellon(fid, size)
+            for job in Place.jobs:
+                job.writeExcellon(fid, size)
 
-    writeExcellonFooter(fid)
-    fid.close()
+        writeExcellonFooter(fid)
+        fid.close()
+
+    try:
+        fullname = config.MergeOutputFiles['drills']
+    except KeyError:
+        fullname = 'merged.drills.xln'
+    OutputFiles.append(fullname)
+    # print('Writing %s ...' % fullname)
+    tasks.append(functools.partial(writeDrills, fullname))
+
+    writeOutputFiles(tasks)
 
     updateGUI("Closing files...")
 
@@ -762,7 +877,7 @@ def merge(args, gui=None):
         fullname = 'merged.toollist.drl'
     OutputFiles.append(fullname)
     # print('Writing %s ...' % fullname)
-    fid = open(fullname, 'wt')
+    fid = open(fullname, 'wt', buffering=OutputBufferSize)
 
     print('-' * 50)
     # add metric support (1/1000 mm vs. 1/100,000 inch)
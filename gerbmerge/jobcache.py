@@ -0,0 +1,171 @@
+"""
+Keep parsed Gerber and Excellon files in an on-disk cache so that job
+files that have not changed since the last run do not have to be parsed
+again.
+
+Each cache entry is a compressed pickle of a parser object. Entries are
+named by a hash of the file contents together with every setting that
+affects the result of parsing, so a changed file or a changed setting
+simply misses the cache. When the cache grows beyond its size limit the
+least recently used entries are removed.
+
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+import zlib
+
+from . import config
+
+# Increase this whenever the data stored by the parsers changes so that
+# entries written by older versions are no longer used.
+CACHE_VERSION = 4
+
+# Suffix of cache entry files
+_Suffix = '.gmc'
+
+# Temporary files older than this many seconds were left behind by an
+# interrupted store() and are removed by evict()
+_StaleAge = 3600
+
+# Size in bytes of the entries in each cache directory, as of the last call
+# to evict() plus what has been stored since. store() only looks through the
+# cache directory once this passes the size limit, or on its first call.
+_Sizes = {}
+
+
+def cacheDir():
+    """Return the directory holding the cache, either as given by the
+    ParseCacheDir option or the per-user default (~/.cache/gerbmerge)"""
+    if config.ParseCacheDir:
+        return config.ParseCacheDir
+
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'gerbmerge')
+
+
+def makeKey(filename, settings):
+    """Return the cache key for the given file parsed with the given settings,
+    a tuple of anything that changes the result of parsing the file. Returns None
+    if caching is disabled."""
+    if not config.ParseCache:
+        return None
+
+    h = hashlib.sha1()
+    h.update(repr((CACHE_VERSION, settings)).encode())
+    with open(filename, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load(key):
+    """Return the object stored under the given key, or None if there is no
+    such entry in the cache"""
+    if key is None:
+        return None
+
+    path = os.path.join(cacheDir(), key + _Suffix)
+    try:
+        with open(path, 'rb') as fid:
+            data = fid.read()
+    except OSError:
+        return None
+
+    try:
+        obj = pickle.loads(zlib.decompress(data))
+    except Exception:
+        # Damaged or written by an incompatible version. Get rid of it.
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    # Mark this entry as recently used so eviction removes it last
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return obj
+
+
+def store(key, obj):
+    """Store an object under the given key, then trim the cache to its size limit.
+    Failure to write to the cache is not an error, the entry is simply not stored."""
+    if key is None:
+        return
+
+    directory = cacheDir()
+    data = zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), 1)
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first so that a concurrent run never sees
+        # a partially written entry.
+        fd, tmpname = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fid:
+            fid.write(data)
+        os.replace(tmpname, os.path.join(directory, key + _Suffix))
+    except OSError:
+        return
+
+    # An entry that replaced another is counted twice, which at worst makes
+    # evict() look through the directory a little early
+    if directory in _Sizes:
+        _Sizes[directory] += len(data)
+    if _Sizes.get(directory, config.ParseCacheSize + 1) > config.ParseCacheSize:
+        evict(config.ParseCacheSize)
+
+
+def evict(limit):
+    """Remove least recently used entries until the cache holds at most 'limit' bytes,
+    and temporary files left behind by interrupted stores"""
+    directory = cacheDir()
+
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+
+    stale = time.time() - _StaleAge
+    for name in names:
+        isTemp = name.endswith('.tmp')
+        if not (name.endswith(_Suffix) or isTemp):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+            if isTemp:
+                # Younger ones may still be being written by another run
+                if st.st_mtime < stale:
+                    os.remove(path)
+                continue
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+
+    if total > limit:
+        entries.sort()
+        for mtime, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= limit:
+                break
+
+    _Sizes[directory] = total
@@ -12,10 +12,14 @@ Rugged Circuits LLC
 http://ruggedcircuits.com/gerbmerge
 """
 
-import builtins
 import copy
 
-from . import (aptable, config, util)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import (aptable, config, jobcache, util)
 from .gerber import GerberParser
 
 # Parsing Gerber/Excellon files is currently very brittle. A more robust
@@ -93,10 +97,12 @@ class Job(object):
 
         return self.minx, self.miny
 
+    def materialize(self):
+        "Return the Job itself (see RotatedJob)"
+        return self
+
     def parseExcellon(self, fullname, decimals):
-        from .excellon import ExcellonParser
-        self.drills = ExcellonParser(fullname, decimals)
-        self.drills.parse()
+        self.drills = loadExcellon(fullname, decimals)
 
     def hasLayer(self, layername):
         return layername in self.gerbers
@@ -120,15 +126,7 @@ class Job(object):
 
         # Shift all commands
         for layer in self.gerbers:
-            for index, command in enumerate(self.gerbers[layer].commands):
-                # Shift X and Y coordinate of command
-                if isinstance(command, tuple):  # ensure that command is of type tuple
-                    command_list = list(command)  # convert tuple to list
-                    if isinstance(command_list[0], int) and isinstance(command_list[1], int):  # ensure that first two elemenst are integers
-                        command_list[0] += x_shift
-                        command_list[1] += y_shift
-                    # convert list back to tuple
-                    self.gerbers[layer].commands[index] = tuple(command_list)
+            self.gerbers[layer].commands.shift(x_shift, y_shift)
 
         # Shift all excellon commands
         for tool, command in self.drills.xcommands.items():
@@ -166,10 +164,13 @@ class Job(object):
             return apdict, apmdict
 
     def parseGerber(self, filename, layername, updateExtents=0):
-        self.gerbers[layername] = GerberParser()
-        self.gerbers[layername].parse(filename, updateExtents)
+        self.addGerber(layername, loadGerber(filename, updateExtents), updateExtents)
+
+    def addGerber(self, layername, gerber, updateExtents=0):
+        "Add an already parsed Gerber layer to this job"
+        self.gerbers[layername] = gerber
         if updateExtents:
-            self.updateExtents(self.gerbers[layername].extents)
+            self.updateExtents(gerber.extents)
 
     def updateExtents(self, extents):
         self.minx, self.miny, self.maxx, self.maxy = extents
@@ -184,6 +185,77 @@ class Job(object):
         for layername in self.gerbers.keys():
             self.gerbers[layername].trim()
 
+
+def loadGerber(filename, updateExtents=0):
+    "Return a GerberParser for the given file, taken from the parse cache if possible"
+
+    # Parsed commands still use the file's own aperture codes, so the entry
+    # does not depend on the global aperture tables.
+    settings = ('gerber', updateExtents, config.Config['measurementunits'])
+    key = jobcache.makeKey(filename, settings)
+
+    gerber = jobcache.load(key)
+    if gerber is None:
+        gerber = GerberParser()
+        gerber.parse(filename, updateExtents)
+        jobcache.store(key, gerber)
+    return gerber
+
+
+def loadExcellon(fullname, decimals):
+    "Return an ExcellonParser for the given file, taken from the parse cache if possible"
+    from .excellon import ExcellonParser
+
+    # Everything the parser looks at besides the file itself
+    settings = ('excellon', decimals, config.Config['excellondecimals'],
+                config.Config['measurementunits'], sorted(config.DefaultToolList.items()))
+    key = jobcache.makeKey(fullname, settings)
+
+    drills = jobcache.load(key)
+    if drills is None:
+        drills = ExcellonParser(fullname, decimals)
+        drills.parse()
+        jobcache.store(key, drills)
+    return drills
+
+# This class stands in for a rotated copy of a Job during automatic placement.
+# The search only needs the dimensions of the rotated job, so the commands and
+# drill hits are only rotated if the final placement actually uses the job
+# rotated.
+
+
+class RotatedJob(object):
+    def __init__(self, job, degrees=90):
+        self.job = job
+        self.degrees = degrees
+        self.name = job.name + '*rotated%d' % degrees
+        self.Repeat = job.Repeat
+        self.rotated = None
+
+    @property
+    def width(self):
+        if self.degrees == 180:
+            return self.job.width
+        return self.job.height
+
+    @property
+    def height(self):
+        if self.degrees == 180:
+            return self.job.height
+        return self.job.width
+
+    def jobarea(self):
+        return self.job.jobarea()
+
+    def maxdimension(self):
+        return self.job.maxdimension()
+
+    def materialize(self):
+        "Return the rotated Job, creating it the first time it is needed"
+        if self.rotated is None:
+            self.rotated = rotateJob(self.job, self.degrees)
+        return self.rotated
+
 # This class encapsulates a Job object, providing absolute
 # positioning information.
 
@@ -231,14 +303,12 @@ class JobLayout(object):
             # all usages of that code to our new one. As a side effect, it will make
             # the merged boardoutline file invalid, but we aren't using it with
             # this method.
-            temp = []
-            for x in self.job.gerbers[outline_layer].commands:
-                if x[0] == 'D':
+            def replace(cmd):
+                if cmd[0] == 'D':
                     # replace old aperture with new one
-                    temp.append(drawing_code)
-                else:
-                    temp.append(x)  # keep old command
-            self.job.gerbers[outline_layer].commands = temp
+                    return drawing_code
+                return cmd  # keep old command
+            self.job.gerbers[outline_layer].commands.mapStrings(replace)
 
             # self.job.writeGerber(fid, outline_layer, X1, Y1)
             self.writeGerber(fid, outline_layer)
@@ -330,35 +400,52 @@ class JobLayout(object):
 
 
 def rotateJob(job, degrees=90, firstpass=True):
-    """Create a new job from an existing one, rotating by specified degrees in 90 degree passes"""
+    """Create a new job from an existing one, rotated counterclockwise by 90, 180
+    or 270 degrees. All coordinates are transformed in a single pass."""
     GAT = config.GAT
-    GAMT = config.GAMT
     # print("rotating job:", job.name, degrees, firstpass)
+    turns = degrees // 90
+    if turns not in (1, 2, 3):
+        raise RuntimeError("Jobs can only be rotated by 90, 180 or 270 degrees, not %s" % degrees)
+
     if firstpass:
-        if degrees == 270:
-            J = Job(job.name + '*rotated270')
-        elif degrees == 180:
-            J = Job(job.name + '*rotated180')
-        else:
-            J = Job(job.name + '*rotated90')
+        J = Job(job.name + '*rotated%d' % degrees)
     else:
         J = Job(job.name)
 
-    # Keep the origin (lower-left) in the same place.
-    # The new maxx and maxy are due to a 90 degree
-    # rotation (adding the extents along the other axis)
-    J.maxx = job.minx + job.maxy - job.miny
-    J.maxy = job.miny + job.maxx - job.minx
+    # Keep the origin (lower-left) in the same place. For 90 and 270
+    # degree rotations the new maxx and maxy are found by adding the
+    # extents along the other axis.
     J.minx = job.minx
     J.miny = job.miny
+    if turns == 2:
+        J.maxx = job.maxx
+        J.maxy = job.maxy
+    else:
+        J.maxx = job.minx + job.maxy - job.miny
+        J.maxy = job.miny + job.maxx - job.minx
 
-    RevGAT = config.buildRevDict(GAT)   # RevGAT[hash] = aperturename
-    RevGAMT = config.buildRevDict(GAMT)  # RevGAMT[hash] = aperturemacroname
-
-    # Keep list of tool diameters and default tool list
-    J.drills = copy.deepcopy(job.drills)
-    # J.xdiam = job.xdiam
-    # J.ToolList = job.ToolList
+    # Rotations occur counterclockwise about the point (minx,miny), then
+    # the result is shifted so that the lower-left point of the rotated job
+    # continues to be (minx,miny). The transform is
+    #
+    #    X' = a*X + b*Y + e
+    #    Y' = c*X + d*Y + f
+    #
+    # so 90 degrees, for example, maps (X,Y) --> (-Y,X) plus an offset.
+    if turns == 1:
+        xform = (0, -1, 1, 0, job.minx + job.maxy, job.miny - job.minx)
+    elif turns == 2:
+        xform = (-1, 0, 0, -1, job.minx + job.maxx, job.miny + job.maxy)
+    else:
+        xform = (0, 1, -1, 0, job.minx - job.miny, job.miny + job.maxx)
+
+    # Keep list of tool diameters and default tool list. Only the drill
+    # commands are replaced, so there is no need for a deep copy.
+    J.drills = copy.copy(job.drills)
+    J.drills.xdiam = dict(job.drills.xdiam)
+    J.drills.ToolList = dict(job.drills.ToolList)
+    J.drills.xcommands = {}
     J.Repeat = job.Repeat
 
     # D-code translation table is the same, except we have to rotate
@@ -378,26 +465,21 @@ def rotateJob(job, degrees=90, firstpass=True):
             code = job.gerbers[layername].apxlat[ap]
             A = GAT[code]
 
-            if A.apname in ('Circle', 'Octagon'):
+            # Rectangles and ovals turned upside down are unchanged, too
+            if A.apname in ('Circle', 'Octagon') or (A.apname != 'Macro' and turns == 2):
                 # This aperture is fine. Copy it over.
                 J.gerbers[layername].apxlat[ap] = code
                 continue
 
-            # Must rotate the aperture
-            APR = A.rotated(RevGAMT)
-
-            # Does it already exist in the GAT?
-            hash = APR.hash()
-            try:
-                # Yup...add it to apxlat
-                newcode = RevGAT[hash]
-            except KeyError:
-                # Must add new aperture to GAT
-                newcode = aptable.addToApertureTable(APR)
+            # Must rotate the aperture. Macros have to be rotated once for each
+            # 90 degrees, for rectangles and ovals once is enough.
+            APR = A.rotated()
+            if A.apname == 'Macro':
+                for i in range(turns - 1):
+                    APR = APR.rotated()
 
-                # Rebuild RevGAT
-                # RevGAT = config.buildRevDict(GAT)
-                RevGAT[hash] = newcode
+            # Does it already exist in the GAT? If not, add it.
+            newcode = aptable.findOrAddAperture(APR)
 
             J.gerbers[layername].apxlat[ap] = newcode
 
@@ -405,104 +487,47 @@ def rotateJob(job, degrees=90, firstpass=True):
             # old code to new command.
             ToolChangeReplace[code] = newcode
 
-    # Now we copy commands, rotating X,Y positions.
-    # Rotations will occur counterclockwise about the
-    # point (minx,miny). Then, we shift to the right
-    # by the height so that the lower-left point of
-    # the rotated job continues to be (minx,miny).
+    # Now we transform the commands of each layer. G-codes and RS274-X
+    # commands are not affected by rotation, but aperture changes are
+    # replaced with the rotated aperture's code where there is one.
     #
-    # We also have to take aperture change commands and
-    # replace them with the new aperture code if we have
-    # a rotation.
-    offset = job.maxy - job.miny
+    # For circular interpolation commands, (I,J) components are always relative
+    # so we do not worry about offsets. For 90 and 270 degrees, unsigned (I,J)
+    # just reverse their sense, i.e., I becomes J and J becomes I. For 360-degree
+    # circular interpolation, I/J are signed and are rotated like (X,Y).
     for layername in job.gerbers:
-        J.gerbers[layername].commands = []
-        J.gerbers[layername].apertures = []
-
-        for cmd in job.gerbers[layername].commands:
-            # Is it a drawing command?
-            if isinstance(cmd, tuple):
-                if len(cmd) == 3:
-                    x, y, d = map(builtins.int, cmd)
-                    II = JJ = None
-                else:
-                    # J is already used as Job object
-                    x, y, II, JJ, d, signed = map(builtins.int, cmd)
-            else:
-                # No, must be a string indicating aperture change, G-code, or
-                # RS274-X command.
-                if cmd[0] in ('G', '%'):
-                    # G-codes and RS274-X commands are just copied verbatim and
-                    # not affected by rotation
-                    J.gerbers[layername].commands.append(cmd)
-                    continue
-
-                # It's a D-code. See if we need to replace aperture changes with a rotated aperture.
-                # But only for D-codes >= 10.
-                if int(cmd[1:]) < 10:
-                    J.gerbers[layername].commands.append(cmd)
-                    continue
-
-                try:
-                    newcmd = ToolChangeReplace[cmd]
-                    J.gerbers[layername].commands.append(newcmd)
-                    J.gerbers[layername].apertures.append(newcmd)
-                except KeyError:
-                    J.gerbers[layername].commands.append(cmd)
-                    J.gerbers[layername].apertures.append(cmd)
-                continue
+        commands = job.gerbers[layername].commands.transformed(*xform)
+        commands.mapStrings(lambda cmd: ToolChangeReplace.get(cmd, cmd))
 
-            # (X,Y) --> (-Y,X) effects a 90-degree counterclockwise shift
-            # Adding 'offset' to -Y maintains the lower-left origin of
-            # (minx,miny).
-            newx = -(y - job.miny) + job.minx + offset
-            newy = (x - job.minx) + job.miny
-
-            # For circular interpolation commands, (I,J) components are always relative
-            # so we do not worry about offsets, just reverse their sense, i.e., I becomes J
-            # and J becomes I. For 360-degree circular interpolation, I/J are signed and we
-            # must map (I,J) --> (-J,I).
-            if II is not None:
-                if signed:
-                    J.gerbers[layername].commands.append(
-                        (newx, newy, -JJ, II, d, signed))
-                else:
-                    J.gerbers[layername].commands.append(
-                        (newx, newy, JJ, II, d, signed))
-            else:
-                J.gerbers[layername].commands.append((newx, newy, d))
-
-        if 0:
-            print(job.minx, job.miny, offset)
-            print(layername)
-            print(J.gerbers[layername].commands)
-
-    # Finally, rotate drills. Offset is in hundred-thousandths (2.5) while Excellon
+        J.gerbers[layername].commands = commands
+        J.gerbers[layername].apertures = commands.apertureChanges()
+
+    # Finally, rotate drills. Offsets are in hundred-thousandths (2.5) while Excellon
     # data is in 2.4 format.
+    # add metric support (1/1000 mm vs. 1/100,000 inch)
+    # NOTE: There don't appear to be any need for a change. The usual
+    # x10 factor seems to apply
     for tool in job.drills.xcommands.keys():
-        J.drills.xcommands[tool] = []
+        J.drills.xcommands[tool] = rotateDrills(job.drills.xcommands[tool], xform)
 
-        for x, y in job.drills.xcommands[tool]:
-            # add metric support (1/1000 mm vs. 1/100,000 inch)
-            # NOTE: There don't appear to be any need for a change. The usual
-            # x10 factor seems to apply
+    # print("rotated:", J.name)
+    # The Next line is important - now that each gerber layer
+    # is an object and the extents are on the Job,
+    # this propagates the extents down
+    J.updateExtents((J.minx, J.miny, J.maxx, J.maxy))
+    return J
 
-            newx = -(10 * y - job.miny) + job.minx + offset
-            newy = (10 * x - job.minx) + job.miny
 
-            newx = int(round(newx / 10.0))
-            newy = int(round(newy / 10.0))
+def rotateDrills(xcommands, xform):
+    """Apply a transform as used by rotateJob() to a list of (X,Y) drill hits in
+    Excellon 2.4 format, returning a new list"""
+    a, b, c, d, e, f = xform
 
-            J.drills.xcommands[tool].append((newx, newy))
+    if numpy is not None and xcommands:
+        xy = 10 * numpy.array(xcommands, dtype=numpy.float64)
+        newx = numpy.round((a * xy[:, 0] + b * xy[:, 1] + e) / 10.0).astype(numpy.int64)
+        newy = numpy.round((c * xy[:, 0] + d * xy[:, 1] + f) / 10.0).astype(numpy.int64)
+        return list(zip(newx.tolist(), newy.tolist()))
 
-    # Rotate some more if required
-    degrees -= 90
-    if degrees > 0:
-        return rotateJob(J, degrees, False)
-    else:
-        # print("rotated:", J.name)
-        # The Next line is important - now that each gerber layer 
-        # is an object and the extents are on the Job,
-        # this propagates the extents down
-        J.updateExtents((J.minx, J.miny, J.maxx, J.maxy))
-        return J
+    return [(int(round((a * 10 * x + b * 10 * y + e) / 10.0)),
+             int(round((c * 10 * x + d * 10 * y + f) / 10.0))) for x, y in xcommands]
@@ -0,0 +1,166 @@
+"""
+Keep the intermediate results of a merge in a project state file, so that
+running GerbMerge again after a small change only redoes the stages whose
+inputs have changed.
+
+The state file holds the result of two stages. The first is the jobs as they
+are after reading, shifting and trimming them, together with the global
+aperture tables. The second is the tiling found by the last automatic
+placement search. Each result is stored with a key describing everything it
+was computed from:
+
+    jobs   -- the contents of every job file, the job settings in the
+              configuration file and the options that affect reading and
+              trimming the files
+    tiling -- the dimensions of the jobs, the panel size, the spacing and the
+              search options
+
+A stage whose key has not changed since the last run is taken from the state
+file instead of being computed again. Margins, fiducials, cut lines, crop
+marks, minimum feature sizes and the output file names are applied after
+both stages, so changing them only writes the output files again. The merged
+output files are always written.
+
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+"""
+
+import hashlib
+import os
+import pickle
+
+from . import checkpoint, config
+
+# Increase this whenever the data stored in state files changes so that files
+# written by older versions are no longer used.
+STATE_VERSION = 1
+
+
+def fileDigest(fname):
+    "Return a hash of the contents of the given file"
+    h = hashlib.sha1()
+    with open(fname, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def jobsKey(tasks, cfg=config.Config):
+    """Return the key of the jobs stage for the job files in tasks, a list of
+    (Job, layername, kind, filename, argument) as collected by parseConfigFile()"""
+    return (cfg['measurementunits'], cfg['excellondecimals'], sorted(config.DefaultToolList.items()),
+            config.TrimGerber, config.TrimExcellon,
+            [(J.name, sorted(getattr(J, 'ToolList', {}).items()), layername, kind, fileDigest(fname), arg)
+             for J, layername, kind, fname, arg in tasks])
+
+
+def tilingKey(name, Jobs, X, Y, cfg=config.Config):
+    """Return the key of the tiling stage for the named search of Jobs, a list of
+    4-tuples (Xdim,Ydim,job,rjob), on an X-by-Y panel"""
+    return (checkpoint.searchKey(name, Jobs, X, Y, cfg),
+            config.RandomSearchExhaustiveJobs, config.SearchTimeout, cfg['searchtimeout'])
+
+
+class ProjectState(object):
+    """Project state file fname. A file that does not exist yet, or that cannot
+    be used, is treated as if it held no stages."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.stages = {}
+
+        # Key of the jobs stage of this run, and whether the jobs were taken
+        # from the state file. Set by restoreJobs().
+        self.jobsKey = None
+        self.jobsRestored = False
+
+        try:
+            with open(fname, 'rb') as fid:
+                data = pickle.load(fid)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print("Ignoring project state file '%s' that cannot be read: %s" % (fname, e))
+            return
+
+        if isinstance(data, dict) and data.get('version') == STATE_VERSION:
+            self.stages = data['stages']
+
+    def get(self, stage, key):
+        """Return the result stored for the given stage, or None if there is none
+        or it was computed from inputs with a different key"""
+        try:
+            savedKey, data = self.stages[stage]
+        except KeyError:
+            return None
+
+        if savedKey != key:
+            return None
+
+        try:
+            return pickle.loads(data)
+        except Exception:
+            # Stored by an incompatible version of the code
+            return None
+
+    def put(self, stage, key, result):
+        """Store the result of a stage computed from inputs with the given key.
+        The result is pickled right away, so later changes to it are not stored."""
+        self.stages[stage] = (key, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        self.save()
+
+    def save(self):
+        """Write all stages to the state file. Failure to write it is not an
+        error, the next run simply computes everything again."""
+        data = {'version': STATE_VERSION, 'stages': self.stages}
+
+        # Write a new file and move it over the old one, so that an interruption
+        # while writing never leaves a damaged state file behind
+        tmpname = self.fname + '.tmp'
+        try:
+            with open(tmpname, 'wb') as fid:
+                pickle.dump(data, fid, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self.fname)
+        except OSError as e:
+            print("Cannot write project state file '%s': %s" % (self.fname, e))
+
+    def restoreJobs(self, tasks, Jobs):
+        """Replace the jobs in the Jobs dictionary, and the global aperture tables,
+        with the trimmed jobs and tables stored by saveJobs() if they were computed
+        from the same job files and settings. Returns True if they were."""
+        self.jobsKey = jobsKey(tasks)
+        saved = self.get('jobs', self.jobsKey)
+        if saved is None:
+            return False
+
+        savedJobs, GAT, GAMT = saved
+
+        # The number of instances of each job is only used for placement, so it
+        # is taken from the configuration file rather than the state file
+        for name, J in savedJobs.items():
+            J.Repeat = Jobs[name].Repeat
+
+        Jobs.clear()
+        Jobs.update(savedJobs)
+        for table, saved in ((config.GAT, GAT), (config.GAMT, GAMT)):
+            table.clear()
+            table.update(saved)
+
+        self.jobsRestored = True
+        return True
+
+    def saveJobs(self, Jobs):
+        "Store the jobs, once trimmed, and the global aperture tables"
+        self.put('jobs', self.jobsKey, (Jobs, config.GAT, config.GAMT))
+
+    def restoreTiling(self, name, Jobs, X, Y):
+        """Return the tiling stored by saveTiling() for the same search of Jobs on
+        an X-by-Y panel, or None"""
+        saved = self.get('tiling', tilingKey(name, Jobs, X, Y))
+        return checkpoint.makeTiling(saved, Jobs, X, Y)
+
+    def saveTiling(self, T, name, Jobs, X, Y):
+        "Store tiling T found by the named search of Jobs on an X-by-Y panel"
+        self.put('tiling', tilingKey(name, Jobs, X, Y), checkpoint.tilingState(T, Jobs))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Fast deterministic placement using guillotine bin packing
+--------------------------------------------------------------------
+
+Jobs are packed, largest first, into a rectangular bin. The bin starts as a
+single free rectangle; each job goes into the free rectangle that it fits
+best along its shorter leftover side (best short side fit), in whichever
+orientation fits best, and the rest of that free rectangle is cut into two
+smaller free rectangles. This is repeated for bins of a few different shapes
+and sizes and the smallest resulting arrangement is kept.
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+"""
+
+import math
+import time
+
+from . import config, tiling
+
+# Bin shapes to try, as ratio of width to height, and the number of bin
+# sizes to try for each shape while looking for the smallest bin that
+# holds all jobs.
+PackAspects = (0.5, 0.75, 1.0, 1.5, 2.0, 3.0)
+PackSteps = 6
+
+
+def packBin(cells, W, H):
+    """Pack cells, a list of (width, height, index) in packing order, into a
+    W-by-H bin. Returns a list of (x, y, width, height, rotated, index), where
+    width and height are those of the cell as placed, or None if some cell does
+    not fit."""
+    free = [(0.0, 0.0, W, H)]
+    placed = []
+
+    for w, h, index in cells:
+        best = None
+        for fx, fy, fw, fh in free:
+            for rotated, cw, ch in ((0, w, h), (1, h, w)):
+                if cw > fw or ch > fh:
+                    continue
+                leftw = fw - cw
+                lefth = fh - ch
+                key = (min(leftw, lefth), max(leftw, lefth), fy, fx)
+                if best is None or key < best[0]:
+                    best = (key, (fx, fy, fw, fh), rotated, cw, ch)
+
+        if best is None:
+            return None
+
+        key, rect, rotated, cw, ch = best
+        fx, fy, fw, fh = rect
+        free.remove(rect)
+
+        # Split the rest of the free rectangle along the shorter leftover
+        # side, leaving the bigger of the two new rectangles as large as possible
+        leftw = fw - cw
+        lefth = fh - ch
+        if leftw < lefth:
+            right = (fx + cw, fy, leftw, ch)
+            top = (fx, fy + ch, fw, lefth)
+        else:
+            right = (fx + cw, fy, leftw, fh)
+            top = (fx, fy + ch, cw, lefth)
+        for rect in (right, top):
+            if rect[2] > 0 and rect[3] > 0:
+                free.append(rect)
+
+        placed.append((fx, fy, cw, ch, rotated, index))
+
+    return placed
+
+
+def packedArea(placed, xspacing, yspacing):
+    "Return the area of the bounding box of cells placed by packBin()"
+    right = max([x + w for x, y, w, h, rotated, ix in placed] + [0])
+    top = max([y + h for x, y, w, h, rotated, ix in placed] + [0])
+    return (right - xspacing) * (top - yspacing)
+
+
+def pack(Jobs, X, Y, cfg=config.Config):
+    """Place the jobs of Jobs, a list of 4-tuples (Xdim,Ydim,job,rjob), on an
+    X-by-Y panel. Returns a Tiling holding the smallest arrangement found, or
+    None if the jobs do not fit on the panel. The outline (points) of the
+    returned tiling is just its bounding box, so no jobs can be added to it."""
+    xspacing = cfg['xspacing']
+    yspacing = cfg['yspacing']
+
+    # Like Tiling, allow the spacing of the last job to stick out of the panel
+    panelW = X + xspacing
+    panelH = Y + yspacing
+
+    # Largest jobs first. Sorting is stable, so the order is deterministic.
+    cells = [(Xdim + xspacing, Ydim + yspacing, ix) for ix, (Xdim, Ydim, job, rjob) in enumerate(Jobs)]
+    cells.sort(key=lambda cell: (-max(cell[0], cell[1]), -cell[0] * cell[1]))
+
+    cellArea = sum([w * h for w, h, ix in cells])
+    minSide = max([min(w, h) for w, h, ix in cells] + [0])
+
+    best = None
+    for aspect in PackAspects:
+        # Look for the smallest bin of this shape that holds all jobs,
+        # starting from one with the total area of the jobs.
+        lo = 1.0
+        hi = None
+        scale = 1.0
+        for step in range(PackSteps):
+            W = min(math.sqrt(cellArea * aspect) * scale, panelW)
+            H = min(math.sqrt(cellArea / aspect) * scale, panelH)
+            if W < minSide or H < minSide:
+                placed = None
+            else:
+                placed = packBin(cells, W, H)
+
+            if placed is not None:
+                area = packedArea(placed, xspacing, yspacing)
+                if best is None or area < best[0]:
+                    best = (area, placed)
+                hi = scale
+            else:
+                lo = scale
+
+            if hi is None:
+                scale *= 1.25
+            else:
+                scale = (lo + hi) / 2
+
+    # Bins of these shapes never grow to the whole panel, which long thin
+    # jobs may need
+    if best is None:
+        placed = packBin(cells, panelW, panelH)
+        if placed is None:
+            return None
+        best = (packedArea(placed, xspacing, yspacing), placed)
+
+    T = tiling.Tiling(X, Y)
+    for x, y, w, h, rotated, ix in best[1]:
+        Xdim, Ydim, job, rjob = Jobs[ix]
+        T.jobs.append(((x, y), (x + w, y + h), rjob if rotated else job))
+
+    right = max([tr[0] for bl, tr, job in T.jobs] + [0])
+    top = max([tr[1] for bl, tr, job in T.jobs] + [0])
+    T.points = [(0, top), (right, top), (right, 0)]
+    return T
+
+
+def tile_pack(Jobs, X, Y):
+    """Wrapper around pack() to print statistics"""
+    startTime = time.time()
+
+    print('=' * 70)
+    print("Starting placement using bin packing.")
+
+    T = pack(Jobs, X, Y)
+    if T:
+        area = T.area()
+        # add metric support (1/1000 mm vs. 1/100,000 inch)
+        if config.Config['measurementunits'] == 'inch':
+            print("  Smallest area: %.1f sq. in. / Utilization: %.1f%%" %
+                  (area, T.usedArea() / area * 100.0))
+        else:
+            print("  Smallest area: %.1f sq. mm / Utilization: %.1f%%" %
+                  (area, T.usedArea() / area * 100.0))
+
+    print("Packed %d jobs in %.2f seconds" % (len(Jobs), time.time() - startTime))
+    print('=' * 70)
+
+    return T
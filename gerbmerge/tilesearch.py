@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Common parts of the automatic placement searches
+--------------------------------------------------------------------
+
+Each search is an object holding all of its own state, so several searches
+can run at the same time, for example in the threads of a thread pool. A
+search reports its progress by calling a function every few seconds, and can
+be stopped from another thread by calling its cancel() method or by setting
+the cancellation token it was given. From asyncio, run the search in an
+executor (loop.run_in_executor(None, search.run)) and cancel it the same way.
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+"""
+
+import abc
+import sys
+import threading
+import time
+
+from . import checkpoint, config
+
+# Seconds between progress reports
+ReportInterval = 3
+
+
+class TileSearch(abc.ABC):
+    """Base class of the searches for a tiling of Jobs, a list of 4-tuples
+    (Xdim,Ydim,job,rjob), on an X-by-Y panel.
+
+    progress is called with the search as argument every ReportInterval seconds.
+    cancel is the cancellation token, an object with an is_set() method such as
+    a threading.Event, and the search stops soon after it is set. The search also
+    stops after timeout seconds if that is more than 0, by default after the
+    SearchTimeout of the configuration. With a checkpointFile the state of the
+    search is saved to it at every progress report, and with resume a search
+    saved there is carried on."""
+
+    # Name of the search in checkpoint files
+    name = None
+
+    def __init__(self, Jobs, X, Y, cfg=config.Config, timeout=None, progress=None,
+                 cancel=None, checkpointFile=None, resume=0):
+        self.Jobs = Jobs
+        self.X = X
+        self.Y = Y
+        self.cfg = cfg
+        if timeout is None:
+            timeout = cfg['searchtimeout']
+        self.timeout = timeout
+        self.progress = progress
+        if cancel is None:
+            cancel = threading.Event()
+        self.cancelled = cancel
+        self.checkpoint = None
+        if checkpointFile:
+            self.checkpoint = checkpoint.Checkpoint(checkpointFile, self.name, Jobs, X, Y, cfg)
+        self.resume = resume
+
+        self.startTime = 0.0       # Start time of tiling
+        self.nextReport = 0.0      # Next time to report progress
+        self.placements = 0        # Number of placements attempted
+        self.bestTiling = None     # Best tiling so far
+        self.bestScore = float(sys.maxsize)  # Smallest area so far
+        self.interrupted = False   # Whether the search was stopped before it was done
+        self.updateGUI = None      # Function to keep the GUI responsive while searching
+
+    def cancel(self):
+        """Stop the search. This may be called from any thread."""
+        self.cancelled.set()
+
+    def run(self, best=None):
+        """Search until done, cancelled or timed out, and return the best tiling
+        found or None if the jobs do not fit. If best is a Tiling, it is returned
+        unless a better one is found."""
+        # Imported here as gerbmerge imports the searches
+        from . import gerbmerge
+        self.updateGUI = gerbmerge.updateGUI
+
+        self.startTime = time.time()
+        self.nextReport = self.startTime + ReportInterval
+        self.interrupted = False
+        if best:
+            self.offer(best)
+
+        state = None
+        if self.checkpoint and self.resume:
+            saved, state = self.checkpoint.load()
+            if saved:
+                self.offer(saved)
+
+        try:
+            self.search(state)
+        except KeyboardInterrupt:
+            self.interrupted = True
+
+        return self.bestTiling
+
+    @abc.abstractmethod
+    def search(self, state):
+        """Look for tilings, offering each one found, until done. state is the
+        search state from the checkpoint to carry on from, or None to start from
+        scratch. Implemented by the searches."""
+
+    def offer(self, T):
+        """Make tiling T the best so far if it has a smaller area than the best one
+        so far, or the same area and fewer corners. Returns True if it does."""
+        score = T.area()
+        if score < self.bestScore or (score == self.bestScore and T.corners() < self.bestTiling.corners()):
+            self.bestTiling, self.bestScore = T, score
+            return True
+        return False
+
+    def stats(self):
+        """Return the area and utilization (in percent) of the best tiling so far"""
+        if self.bestTiling:
+            area = self.bestTiling.area()
+            return area, self.bestTiling.usedArea() / area * 100.0
+        return 999999.0, 0.0
+
+    def poll(self, state=None):
+        """Called often while searching. Reports progress every ReportInterval
+        seconds, then also saving the checkpoint state returned by calling state,
+        and raises KeyboardInterrupt once the search is cancelled or timed out."""
+        if self.cancelled.is_set():
+            raise KeyboardInterrupt
+
+        if time.time() > self.nextReport:
+            self.nextReport = time.time() + ReportInterval
+            if self.progress:
+                self.progress(self)
+            if state:
+                self.save(state())
+
+            if self.timeout > 0 and (time.time() - self.startTime) > self.timeout:
+                raise KeyboardInterrupt
+
+        self.updateGUI("Performing automatic layout...")
+
+    def save(self, state):
+        """Save the best tiling so far and the given search state to the checkpoint
+        file, if there is one"""
+        if self.checkpoint:
+            self.checkpoint.save(self.bestTiling, state)
@@ -9,183 +9,252 @@ Rugged Circuits LLC
 http://ruggedcircuits.com/gerbmerge
 """
 
+import collections
 import sys
 import time
 
-from . import config, gerbmerge, tiling
+from . import config, gerbmerge, tiling, tilesearch
 
-_StartTime = 0.0           # Start time of tiling
-_CkpointTime = 0.0         # Next time to print stats
-_Placements = 0            # Number of placements attempted
-_PossiblePermutations = 0  # Number of different ways of ordering jobs
-_Permutations = 0          # Number of different job orderings already computed
-_TBestTiling = None        # Best tiling so far
-_TBestScore = float(sys.maxsize)  # Smallest area so far
-_PrintStats = 1            # Print statistics every 3 seconds
+_MemoSize = 200000         # Maximum number of search states to remember
 
 
-def printTilingStats():
-    global _CkpointTime
-    _CkpointTime = time.time() + 3
+def printTilingStats(search):
+    area, utilization = search.stats()
 
-    if _TBestTiling:
-        area = _TBestTiling.area()
-        utilization = _TBestTiling.usedArea() / area * 100.0
-    else:
-        area = 999999.0
-        utilization = 0.0
+    percent = 100.0 * search.permutations / search.possiblePermutations
 
-    percent = 100.0 * _Permutations / _PossiblePermutations
+    if search.memoLookups:
+        hitrate = 100.0 * search.memoHits / search.memoLookups
+    else:
+        hitrate = 0.0
 
     # add metric support (1/1000 mm vs. 1/100,000 inch)
     if config.Config['measurementunits'] == 'inch':
-        print("\r  %5.2f%% complete / %ld/%ld Perm/Place / Smallest area: %.1f sq. in. / Best utilization: %.1f%%" %
-              (percent, _Permutations, _Placements, area, utilization), "\n")
+        print("\r  %5.2f%% complete / %ld/%ld Perm/Place / Smallest area: %.1f sq. in. / Best utilization: %.1f%% / Repeated states: %.1f%%" %
+              (percent, search.permutations, search.placements, area, utilization, hitrate), "\n")
     else:
-        print("\r  %5.2f%% complete / %ld/%ld Perm/Place / Smallest area: %.1f sq. mm / Best utilization: %.1f%%" %
-              (percent, _Permutations, _Placements, area, utilization), "\n")
+        print("\r  %5.2f%% complete / %ld/%ld Perm/Place / Smallest area: %.1f sq. mm / Best utilization: %.1f%% / Repeated states: %.1f%%" %
+              (percent, search.permutations, search.placements, area, utilization, hitrate), "\n")
 
     if gerbmerge.GUI is not None:
         sys.stdout.flush()
 
 
-def bestTiling():
-    return _TBestTiling
-
-
-def _tile_search1(Jobs, TSoFar, firstAddPoint, cfg=config.Config):
-    """This recursive function does the following with an existing tiling TSoFar:
-
-       * For each 4-tuple (Xdim,Ydim,job,rjob) in Jobs, the non-rotated 'job' is selected
-
-       * For the non-rotated job, the list of valid add-points is found
-
-       * For each valid add-point, the job is placed at this point in a new,
-         cloned tiling.
-
-       * The function then calls its recursively with the remaining list of
-         jobs.
-
-       * The rotated job is then selected and the list of valid add-points is
-         found. Again, for each valid add-point the job is placed there in
-         a new, cloned tiling.
-
-       * Once again, the function calls itself recursively with the remaining
-         list of jobs.
-
-       * The best tiling encountered from all recursive calls is returned.
-
-       If TSoFar is None it means this combination of jobs is not tileable.
-
-       The side-effect of this function is to set _TBestTiling and _TBestScore
-       to the best tiling encountered so far. _TBestTiling could be None if
-       no valid tilings have been found so far.
-    """
-    global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore, _Permutations, _PrintStats
-
-    if not TSoFar:
-        return (None, float(sys.maxsize))
-
-    if not Jobs:
-        # Update the best tiling and score. If the new tiling matches
-        # the best score so far, compare on number of corners, trying to
-        # minimize them.
-        score = TSoFar.area()
-
-        if score < _TBestScore:
-            _TBestTiling, _TBestScore = TSoFar, score
-        elif score == _TBestScore:
-            if TSoFar.corners() < _TBestTiling.corners():
-                _TBestTiling, _TBestScore = TSoFar, score
-
-        _Placements += 1
-        if firstAddPoint:
-            _Permutations += 1
-        return
-
-    xspacing = cfg['xspacing']
-    yspacing = cfg['yspacing']
-
-    minInletSize = tiling.minDimension(Jobs)
-    TSoFar.removeInlets(minInletSize)
-
-    for job_ix in range(len(Jobs)):
-        # Pop off the next job and construct remaining_jobs, a sub-list
-        # of Jobs with the job we've just popped off excluded.
-        Xdim, Ydim, job, rjob = Jobs[job_ix]
-        remaining_jobs = Jobs[:job_ix] + Jobs[job_ix + 1:]
-
-        if 0:
-            print("Job: {}".format(job.name))
-            TSoFar.joblist()
-            for J in remaining_jobs:
-                print(J[2].name, ", ", "\n")
-            print("\n")
-            print('-' * 75)
-
-        # Construct add-points for the non-rotated and rotated job.
-        # As an optimization, do not construct add-points for the rotated
-        # job if the job is a square (duh).
-        addpoints1 = TSoFar.validAddPoints(
-            Xdim + xspacing, Ydim + yspacing)     # unrotated job
-        if Xdim != Ydim:
-            addpoints2 = TSoFar.validAddPoints(
-                Ydim + xspacing, Xdim + yspacing)   # rotated job
-        else:
-            addpoints2 = []
-
-        # Recursively construct tilings for the non-rotated job and
-        # update the best-tiling-so-far as we do so.
-        if addpoints1:
-            for ix in addpoints1:
-                # Clone the tiling we're starting with and add the job at this
-                # add-point.
-                T = TSoFar.clone()
-                T.addJob(ix, Xdim + xspacing, Ydim + yspacing, job)
-
-                # Recursive call with the remaining jobs and this new tiling. The
-                # point behind the last parameter is simply so that _Permutations is
-                # only updated once for each permutation, not once per add-point.
-                # A permutation is some ordering of jobs (N! choices) and some
-                # ordering of non-rotated and rotated within that ordering (2**N
-                # possibilities per ordering).
-                _tile_search1(remaining_jobs, T,
-                              firstAddPoint and ix == addpoints1[0])
-        elif firstAddPoint:
-            # Premature prune due to not being able to put this job anywhere. We
-            # have pruned off 2^M permutations where M is the length of the remaining
-            # jobs.
-            _Permutations += 2**len(remaining_jobs)
-
-        if addpoints2:
-            for ix in addpoints2:
-                # Clone the tiling we're starting with and add the job at this
-                # add-point. Remember that the job is rotated so swap X and Y
-                # dimensions.
-                T = TSoFar.clone()
-                T.addJob(ix, Ydim + xspacing, Xdim + yspacing, rjob)
-
-                # Recursive call with the remaining jobs and this new tiling.
-                _tile_search1(remaining_jobs, T,
-                              firstAddPoint and ix == addpoints2[0])
-        elif firstAddPoint:
-            # Premature prune due to not being able to put this job anywhere. We
-            # have pruned off 2^M permutations where M is the length of the remaining
-            # jobs.
-            _Permutations += 2**len(remaining_jobs)
-
-        # If we've been at this for 3 seconds, print some status information
-        if _PrintStats and time.time() > _CkpointTime:
-            printTilingStats()
-
-            # Check for timeout - changed to file config
-            if (config.Config['searchtimeout'] > 0) and (
-                    (time.time() - _StartTime) > config.Config['searchtimeout']):
-                raise KeyboardInterrupt
-
-        gerbmerge.updateGUI("Performing automatic layout...")
-
-    # end for each job in job list
+def _resumeBranch(branch, resume):
+    """Return None if the given branch, a (job index, rotated, add-point index)
+    tuple, was finished before the checkpoint cursor resume was saved. Otherwise
+    return the rest of resume to search the branch with."""
+    if not resume or branch > resume[0]:
+        return ()
+    if branch < resume[0]:
+        return None
+    return resume[1:]
+
+
+class ExhaustiveSearch(tilesearch.TileSearch):
+    """Exhaustive search for the best tiling. The jobs are added to the tiling
+    start, or to an empty tiling if it is None. See tilesearch.TileSearch for
+    the other arguments."""
+
+    name = 'exhaustive'
+
+    def __init__(self, Jobs, X, Y, cfg=config.Config, start=None, **kwargs):
+        tilesearch.TileSearch.__init__(self, Jobs, X, Y, cfg, **kwargs)
+        self.start = start
+
+        # There are (2**N)*(N!) possible permutations where N is the number of jobs,
+        # divided by M! for each job that is repeated M times. This is assuming each
+        # job has a rotation (i.e., is not square).
+        self.possiblePermutations = possiblePermutations(Jobs)
+        self.permutations = 0              # Number of different job orderings already computed
+        self.memo = collections.OrderedDict()  # Search states already explored
+        self.memoLookups = 0               # Number of search states looked up in memo
+        self.memoHits = 0                  # Number of search states found in memo
+        self.path = []                     # Branches taken to reach the tiling being searched
+
+    def search(self, state):
+        resume = ()
+        if state:
+            resume = state['cursor']
+            self.permutations = state['permutations']
+
+        TSoFar = self.start
+        if TSoFar is None:
+            TSoFar = tiling.Tiling(self.X, self.Y)
+        self._search(self.Jobs, TSoFar, 1, resume)
+
+        # Past the last branch, so that resuming finds nothing left to search
+        self.save({'cursor': [(len(self.Jobs), 0, 0)], 'permutations': self.permutations})
+
+    def _search(self, Jobs, TSoFar, firstAddPoint, resume=()):
+        """This recursive function does the following with an existing tiling TSoFar:
+
+           * For each 4-tuple (Xdim,Ydim,job,rjob) in Jobs, the non-rotated 'job' is selected
+
+           * For the non-rotated job, the list of valid add-points is found
+
+           * For each valid add-point, the job is placed at this point in a new,
+             cloned tiling.
+
+           * The function then calls its recursively with the remaining list of
+             jobs.
+
+           * The rotated job is then selected and the list of valid add-points is
+             found. Again, for each valid add-point the job is placed there in
+             a new, cloned tiling.
+
+           * Once again, the function calls itself recursively with the remaining
+             list of jobs.
+
+           * The best tiling encountered from all recursive calls is offered to
+             the search.
+
+           The side-effect of this function is to set bestTiling and bestScore
+           to the best tiling encountered so far. bestTiling could be None if
+           no valid tilings have been found so far.
+
+           The branches taken are numbered and if resume is given, it is the list of
+           branches taken when a checkpoint was saved. Branches before them were all
+           searched before the checkpoint and are skipped.
+        """
+        if not Jobs:
+            # Update the best tiling and score. If the new tiling matches
+            # the best score so far, compare on number of corners, trying to
+            # minimize them.
+            self.offer(TSoFar)
+
+            self.placements += 1
+            if firstAddPoint:
+                self.permutations += 1
+            return
+
+        # Stop if no way of adding the remaining jobs can beat the best tiling so
+        # far. The bound is allowed a little rounding error so that tilings which
+        # tie with the best one, and might have fewer corners, are still tried.
+        if TSoFar.minArea(Jobs) > self.bestScore * (1 + 1e-9):
+            if firstAddPoint:
+                self.permutations += possiblePermutations(Jobs)
+            return
+
+        xspacing = self.cfg['xspacing']
+        yspacing = self.cfg['yspacing']
+
+        minInletSize = tiling.minDimension(Jobs)
+        TSoFar.removeInlets(minInletSize)
+
+        # Different orderings of jobs often lead to the same outline with the same
+        # jobs left to place. Everything that can follow only depends on the outline,
+        # the extents of the tiling and the sizes of the remaining jobs, so if this
+        # state has been seen before all of its tilings have already been tried.
+        state = (tuple(TSoFar.points), TSoFar.bounds()[1],
+                 tuple(sorted((J[0], J[1]) for J in Jobs)))
+        self.memoLookups += 1
+        if state in self.memo:
+            self.memoHits += 1
+            self.memo.move_to_end(state)
+            if firstAddPoint:
+                self.permutations += possiblePermutations(Jobs)
+            return
+
+        self.memo[state] = None
+        if len(self.memo) > _MemoSize:
+            self.memo.popitem(last=False)
+
+        # Repeated instances of a job are interchangeable. Placing one of them
+        # next gives exactly the same tilings as placing any other, so only
+        # the first instance is tried at this level.
+        tried = set()
+
+        for job_ix in range(len(Jobs)):
+            if Jobs[job_ix] in tried:
+                continue
+            tried.add(Jobs[job_ix])
+
+            if resume and job_ix < resume[0][0]:
+                continue
+
+            # Pop off the next job and construct remaining_jobs, a sub-list
+            # of Jobs with the job we've just popped off excluded.
+            Xdim, Ydim, job, rjob = Jobs[job_ix]
+            remaining_jobs = Jobs[:job_ix] + Jobs[job_ix + 1:]
+
+            if 0:
+                print("Job: {}".format(job.name))
+                TSoFar.joblist()
+                for J in remaining_jobs:
+                    print(J[2].name, ", ", "\n")
+                print("\n")
+                print('-' * 75)
+
+            # Construct add-points for the non-rotated and rotated job.
+            # As an optimization, do not construct add-points for the rotated
+            # job if the job is a square (duh).
+            addpoints1 = TSoFar.validAddPoints(
+                Xdim + xspacing, Ydim + yspacing)     # unrotated job
+            if Xdim != Ydim:
+                addpoints2 = TSoFar.validAddPoints(
+                    Ydim + xspacing, Xdim + yspacing)   # rotated job
+            else:
+                addpoints2 = []
+
+            # Recursively construct tilings for the non-rotated job and
+            # update the best-tiling-so-far as we do so.
+            if addpoints1:
+                for k, ix in enumerate(addpoints1):
+                    branch = (job_ix, 0, k)
+                    rest = _resumeBranch(branch, resume)
+                    if rest is None:
+                        continue
+
+                    # Clone the tiling we're starting with and add the job at this
+                    # add-point.
+                    T = TSoFar.clone()
+                    T.addJob(ix, Xdim + xspacing, Ydim + yspacing, job)
+
+                    # Recursive call with the remaining jobs and this new tiling. The
+                    # point behind the third parameter is simply so that permutations
+                    # is only updated once for each permutation, not once per add-point.
+                    # A permutation is some ordering of jobs (N! choices) and some
+                    # ordering of non-rotated and rotated within that ordering (2**N
+                    # possibilities per ordering).
+                    self.path.append(branch)
+                    self._search(remaining_jobs, T,
+                                 firstAddPoint and ix == addpoints1[0], rest)
+                    self.path.pop()
+            elif firstAddPoint and _resumeBranch((job_ix, 0, 0), resume) is not None:
+                # Premature prune due to not being able to put this job anywhere. We
+                # have pruned off all permutations of the remaining jobs.
+                self.permutations += possiblePermutations(remaining_jobs)
+
+            if addpoints2:
+                for k, ix in enumerate(addpoints2):
+                    branch = (job_ix, 1, k)
+                    rest = _resumeBranch(branch, resume)
+                    if rest is None:
+                        continue
+
+                    # Clone the tiling we're starting with and add the job at this
+                    # add-point. Remember that the job is rotated so swap X and Y
+                    # dimensions.
+                    T = TSoFar.clone()
+                    T.addJob(ix, Ydim + xspacing, Xdim + yspacing, rjob)
+
+                    # Recursive call with the remaining jobs and this new tiling.
+                    self.path.append(branch)
+                    self._search(remaining_jobs, T,
+                                 firstAddPoint and ix == addpoints2[0], rest)
+                    self.path.pop()
+            elif firstAddPoint and _resumeBranch((job_ix, 1, 0), resume) is not None:
+                # Premature prune due to not being able to put this job anywhere. We
+                # have pruned off all permutations of the remaining jobs.
+                self.permutations += possiblePermutations(remaining_jobs)
+
+            # Report progress every few seconds. Everything up to and including
+            # this job has been searched when the checkpoint is saved.
+            self.poll(lambda: {'cursor': self.path + [(job_ix, 2, 0)],
+                               'permutations': self.permutations})
+
+        # end for each job in job list
 
 
 def factorial(N):
@@ -200,42 +269,38 @@ def factorial(N):
     return prod
 
 
-def initialize(printStats=1):
-    global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore, _Permutations, _PossiblePermutations, _PrintStats
-
-    _PrintStats = printStats
-    _Placements = 0
-    _Permutations = 0
-    _TBestTiling = None
-    _TBestScore = float(sys.maxsize)
+def possiblePermutations(Jobs):
+    """Return the number of different ways of ordering the jobs in Jobs and
+    choosing whether each one is rotated. Repeated instances of a job are
+    interchangeable, so for M instances of a job there are M! fewer orderings."""
+    counts = {}
+    for J in Jobs:
+        counts[J] = counts.get(J, 0) + 1
 
+    orderings = factorial(len(Jobs))
+    for count in counts.values():
+        orderings //= factorial(count)
 
-def tile_search1(Jobs, X, Y):
-    """Wrapper around _tile_search1 to handle keyboard interrupt, etc."""
-    global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore, _Permutations, _PossiblePermutations
+    return orderings * 2**len(Jobs)
 
-    initialize()
 
-    _StartTime = time.time()
-    _CkpointTime = _StartTime + 3
-    # There are (2**N)*(N!) possible permutations where N is the number of jobs.
-    # This is assuming all jobs are unique and each job has a rotation (i.e., is not
-    # square). Practically, these assumptions make no difference because the software
-    # currently doesn't optimize for cases of repeated jobs.
-    _PossiblePermutations = (2**len(Jobs)) * factorial(len(Jobs))
-    # print("Possible permutations:", _PossiblePermutations)
+def tile_search1(Jobs, X, Y, best=None):
+    """Run an ExhaustiveSearch, printing statistics. If best is a Tiling, only
+    tilings at least as good are searched for."""
+    search = ExhaustiveSearch(Jobs, X, Y, progress=printTilingStats,
+                              checkpointFile=config.CheckpointFile, resume=config.ResumeSearch)
 
     print('=' * 70)
     print("Starting placement using exhaustive search.")
     print("There are %ld possible permutations..." %
-          _PossiblePermutations, "\n")
-    if _PossiblePermutations < 1e4:
+          search.possiblePermutations, "\n")
+    if search.possiblePermutations < 1e4:
         print("this'll take no time at all.")
-    elif _PossiblePermutations < 1e5:
+    elif search.possiblePermutations < 1e5:
         print("surf the web for a few minutes.")
-    elif _PossiblePermutations < 1e6:
+    elif search.possiblePermutations < 1e6:
         print("take a long lunch.")
-    elif _PossiblePermutations < 1e7:
+    elif search.possiblePermutations < 1e7:
         print("come back tomorrow.")
     else:
         print("don't hold your breath.")
@@ -243,18 +308,17 @@ def tile_search1(Jobs, X, Y):
     print("Estimated maximum possible utilization is %.1f%%." %
           (tiling.maxUtilization(Jobs) * 100))
 
-    try:
-        _tile_search1(Jobs, tiling.Tiling(X, Y), 1)
-        printTilingStats()
-        print("")
-    except KeyboardInterrupt:
-        printTilingStats()
+    T = search.run(best)
+    printTilingStats(search)
+    if search.interrupted:
         print("\n")
         print("Interrupted.")
+    else:
+        print("")
 
-    computeTime = time.time() - _StartTime
+    computeTime = time.time() - search.startTime
     print("Computed %ld placements in %d seconds / %.1f placements/second" %
-          (_Placements, computeTime, _Placements / computeTime))
+          (search.placements, computeTime, search.placements / computeTime))
     print('=' * 70)
 
-    return _TBestTiling
+    return T
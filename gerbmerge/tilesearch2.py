@@ -12,124 +12,257 @@ http://ruggedcircuits.com/gerbmerge
 import sys
 import time
 import random
+import multiprocessing
+import queue
 
-from . import config, gerbmerge, tiling, tilesearch1
+from . import config, gerbmerge, tiling, tilesearch, tilesearch1
 
-_StartTime = 0.0           # Start time of tiling
-_CkpointTime = 0.0         # Next time to print stats
-_Placements = 0            # Number of placements attempted
-_TBestTiling = None        # Best tiling so far
-_TBestScore = float()  # Smallest area so far
 
+def printTilingStats(search):
+    area, utilization = search.stats()
+    _printStats(search.placements, area, utilization)
 
-def printTilingStats():
-    global _CkpointTime
-    _CkpointTime = time.time() + 3
-
-    if _TBestTiling:
-        area = _TBestTiling.area()
-        utilization = _TBestTiling.usedArea() / area * 100.0
-    else:
-        area = 999999.0
-        utilization = 0.0
 
+def _printStats(placements, area, utilization):
     # add metric support (1/1000 mm vs. 1/100,000 inch)
     if config.Config['measurementunits'] == 'inch':
         print("\r  %ld placements / Smallest area: %.1f sq. in. / Best utilization: %.1f%%" %
-              (_Placements, area, utilization), "\n")
+              (placements, area, utilization), "\n")
     else:
         print("\r  %ld placements / Smallest area: %.1f sq. mm / Best utilization: %.0f%%" %
-              (_Placements, area, utilization), "\n")
+              (placements, area, utilization), "\n")
 
     if gerbmerge.GUI is not None:
         sys.stdout.flush()
 
 
-def _tile_search2(Jobs, X, Y, cfg=config.Config):
-    global _CkpointTime, _Placements, _TBestTiling, _TBestScore
-
-    r = random.Random()
-    N = len(Jobs)
+class RandomSearch(tilesearch.TileSearch):
+    """Random search for the best tiling. Each trial places all but exhaustiveJobs
+    jobs (by default config.RandomSearchExhaustiveJobs) at random, then searches
+    exhaustively for the best way of adding the rest. With more than one worker,
+    trials are run in that many processes in parallel, each seeded at random;
+    otherwise the search uses the given seed. See tilesearch.TileSearch for the
+    other arguments."""
+
+    name = 'random'
+
+    def __init__(self, Jobs, X, Y, cfg=config.Config, exhaustiveJobs=None, workers=1, seed=None, **kwargs):
+        tilesearch.TileSearch.__init__(self, Jobs, X, Y, cfg, **kwargs)
+        if exhaustiveJobs is None:
+            exhaustiveJobs = config.RandomSearchExhaustiveJobs
+        self.exhaustiveJobs = exhaustiveJobs
+        self.workers = workers
+        self.seed = seed
+        self.random = None                      # Random number generator of the search
+        self.workerScore = float(sys.maxsize)   # Smallest area found by the workers so far
+
+    def stats(self):
+        if self.workerScore < self.bestScore:
+            usedArea = sum([job.jobarea() for Xdim, Ydim, job, rjob in self.Jobs])
+            return self.workerScore, usedArea / self.workerScore * 100.0
+        return tilesearch.TileSearch.stats(self)
+
+    def search(self, state):
+        try:
+            if self.workers > 1:
+                self._searchParallel()
+            else:
+                self.random = random.Random(self.seed)
+                if state and state['random']:
+                    self.random.setstate(state['random'])
+                self._search()
+        finally:
+            # Parallel workers each have their own random number generator, so
+            # only the best tiling is saved for them
+            self.save({'random': self.random and self.random.getstate()})
+
+    def _search(self):
+        r = self.random
+        Jobs = self.Jobs
+        N = len(Jobs)
+
+        # M is the number of jobs that will be placed randomly.
+        # N-M is the number of jobs that will be searched exhaustively.
+        M = N - self.exhaustiveJobs
+        M = max(M, 0)
+
+        xspacing = self.cfg['xspacing']
+        yspacing = self.cfg['yspacing']
+
+        # Must escape with Ctrl-C
+        while True:
+            T = tiling.Tiling(self.X, self.Y)
+            joborder = r.sample(range(N), N)
+
+            minInletSize = tiling.minDimension(Jobs)
+
+            for ix in joborder[:M]:
+                Xdim, Ydim, job, rjob = Jobs[ix]
+
+                T.removeInlets(minInletSize)
+
+                if r.choice([0, 1]):
+                    addpoints = T.validAddPoints(Xdim + xspacing, Ydim + yspacing)
+                    if not addpoints:
+                        break
+
+                    pt = r.choice(addpoints)
+                    T.addJob(pt, Xdim + xspacing, Ydim + yspacing, job)
+                else:
+                    addpoints = T.validAddPoints(Ydim + xspacing, Xdim + yspacing)
+                    if not addpoints:
+                        break
+
+                    pt = r.choice(addpoints)
+                    T.addJob(pt, Ydim + xspacing, Xdim + yspacing, rjob)
+            else:
+                # Do exhaustive search on remaining jobs
+                interrupted = False
+                if N - M:
+                    remainingJobs = []
+                    for ix in joborder[M:]:
+                        remainingJobs.append(Jobs[ix])
 
-    # M is the number of jobs that will be placed randomly.
-    # N-M is the number of jobs that will be searched exhaustively.
-    M = N - config.RandomSearchExhaustiveJobs
-    M = max(M, 0)
+                    search = tilesearch1.ExhaustiveSearch(remainingJobs, self.X, self.Y, self.cfg, start=T,
+                                                          timeout=0, cancel=self.cancelled)
+                    T = search.run()
+                    interrupted = search.interrupted
 
-    xspacing = cfg['xspacing']
-    yspacing = cfg['yspacing']
+                if T:
+                    self.offer(T)
 
-    # Must escape with Ctrl-C
-    while True:
-        T = tiling.Tiling(X, Y)
-        joborder = r.sample(range(N), N)
+                # Ctrl-C during the exhaustive search stops the random search too
+                if interrupted:
+                    raise KeyboardInterrupt
 
-        minInletSize = tiling.minDimension(Jobs)
+            self.placements += 1
 
-        for ix in joborder[:M]:
-            Xdim, Ydim, job, rjob = Jobs[ix]
+            # Report progress every few seconds
+            self.poll(lambda: {'random': r.getstate()})
 
-            T.removeInlets(minInletSize)
+        # end while 1
 
-            if r.choice([0, 1]):
-                addpoints = T.validAddPoints(Xdim + xspacing, Ydim + yspacing)
-                if not addpoints:
-                    break
+    def _searchParallel(self):
+        """Run independent random searches in several worker processes and make
+        the best tiling over all of them the best one"""
+        Jobs = self.Jobs
+        Keys = jobKeys(Jobs)
 
-                pt = r.choice(addpoints)
-                T.addJob(pt, Xdim + xspacing, Ydim + yspacing, job)
-            else:
-                addpoints = T.validAddPoints(Ydim + xspacing, Xdim + yspacing)
-                if not addpoints:
+        # Workers stop by themselves on timeout, or when the stop event is set
+        if self.timeout > 0:
+            timeout = max(self.timeout - (time.time() - self.startTime), 1e-3)
+        else:
+            timeout = 0
+
+        progress = (multiprocessing.Value('l', 0), multiprocessing.Value('d', float(sys.maxsize)))
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        seeds = random.SystemRandom().sample(range(2**31), self.workers)
+
+        procs = [multiprocessing.Process(target=_worker,
+                                         args=(Keys, self.X, self.Y, seed, dict(self.cfg),
+                                               self.exhaustiveJobs, timeout, progress, stop, results))
+                 for seed in seeds]
+        for proc in procs:
+            proc.start()
+
+        # Ctrl-C is delivered to the workers as well, so just keep collecting
+        # results until every worker has reported.
+        found = []
+        interrupted = False
+        while len(found) < len(procs):
+            if self.cancelled.is_set():
+                stop.set()
+                interrupted = True
+            try:
+                found.append(results.get(timeout=tilesearch.ReportInterval))
+            except queue.Empty:
+                if not any([proc.is_alive() for proc in procs]):
                     break
-
-                pt = r.choice(addpoints)
-                T.addJob(pt, Ydim + xspacing, Xdim + yspacing, rjob)
+                self.placements = progress[0].value
+                self.workerScore = progress[1].value
+                if self.progress:
+                    self.progress(self)
+                gerbmerge.updateGUI("Performing automatic layout...")
+            except KeyboardInterrupt:
+                interrupted = True
+
+        for proc in procs:
+            proc.join()
+
+        if len(found) < len(procs):
+            raise RuntimeError(
+                "%d of %d random search workers exited without a result" % (len(procs) - len(found), len(procs)))
+
+        # Reduce the worker results by area, then by number of corners
+        self.placements = 0
+        for placements, score, corners, points, placed in found:
+            self.placements += placements
+            if points is None:
+                continue
+            T = tiling.Tiling(self.X, self.Y)
+            T.points = points
+            T.jobs = [(bl, tr, Jobs[ix][2 + rotated]) for bl, tr, (ix, rotated) in placed]
+            self.offer(T)
+
+        if interrupted:
+            raise KeyboardInterrupt
+
+
+def jobKeys(Jobs):
+    """Return Jobs with each job and rotated job replaced by an (index, rotated)
+    key into Jobs. Copies of a job share the key of its first entry, so that the
+    exhaustive step still finds them interchangeable."""
+    first = {}
+    Keys = []
+    for ix, J in enumerate(Jobs):
+        ix = first.setdefault(J, ix)
+        Keys.append((J[0], J[1], (ix, 0), (ix, 1)))
+    return Keys
+
+
+def _worker(Keys, X, Y, seed, cfg, exhaustiveJobs, timeout, progress, stop, results):
+    """Entry point of a random search worker process. Keys is the job list with
+    each job and rotated job replaced by an (index, rotated) key so that no Gerber
+    data needs to be sent to the worker. The best tiling found is sent back through
+    the results queue when the search times out or is stopped."""
+
+    # Workers may have been spawned rather than forked, so bring the
+    # configuration over from the parent process.
+    config.Config.update(cfg)
+    gerbmerge.GUI = None
+
+    reported = [0]
+
+    def reportProgress(search):
+        """Add the placements made since the last report to the shared counters
+        and lower the shared best area if we have beaten it."""
+        placements, bestArea = progress
+        with placements.get_lock():
+            placements.value += search.placements - reported[0]
+        if search.bestTiling:
+            with bestArea.get_lock():
+                bestArea.value = min(bestArea.value, search.bestScore)
+        reported[0] = search.placements
+
+    search = RandomSearch(Keys, X, Y, config.Config, exhaustiveJobs=exhaustiveJobs, seed=seed,
+                          timeout=timeout, progress=reportProgress, cancel=stop)
+    try:
+        search.run()
+    finally:
+        reportProgress(search)
+        if search.bestTiling:
+            results.put((search.placements, search.bestScore, search.bestTiling.corners(),
+                         search.bestTiling.points, search.bestTiling.jobs))
         else:
-            # Do exhaustive search on remaining jobs
-            if N - M:
-                remainingJobs = []
-                for ix in joborder[M:]:
-                    remainingJobs.append(Jobs[ix])
+            results.put((search.placements, search.bestScore, 0, None, None))
 
-                tilesearch1.initialize(0)
-                tilesearch1._tile_search1(remainingJobs, T, 1)
-                T = tilesearch1.bestTiling()
 
-            if T:
-                score = T.area()
-
-                if score < _TBestScore:
-                    _TBestTiling, _TBestScore = T, score
-                elif score == _TBestScore:
-                    if T.corners() < _TBestTiling.corners():
-                        _TBestTiling, _TBestScore = T, score
-
-        _Placements += 1
-
-        # If we've been at this for 3 seconds, print some status information
-        if time.time() > _CkpointTime:
-            printTilingStats()
-
-            # Check for timeout - changed to file config
-            if (config.Config['searchtimeout'] > 0) and (
-                    (time.time() - _StartTime) > config.Config['searchtimeout']):
-                raise KeyboardInterrupt
-
-        gerbmerge.updateGUI("Performing automatic layout...")
-
-    # end while 1
-
-
-def tile_search2(Jobs, X, Y):
-    """Wrapper around _tile_search2 to handle keyboard interrupt, etc."""
-    global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore
-
-    _StartTime = time.time()
-    _CkpointTime = _StartTime + 3
-    _Placements = 0
-    _TBestTiling = None
-    _TBestScore = float(sys.maxsize)
+def tile_search2(Jobs, X, Y, best=None):
+    """Run a RandomSearch, printing statistics. If best is a Tiling, it is
+    returned unless a better one is found."""
+    search = RandomSearch(Jobs, X, Y, workers=config.Workers, progress=printTilingStats,
+                          checkpointFile=config.CheckpointFile, resume=config.ResumeSearch)
 
     print('=' * 70)
     if (config.Config['searchtimeout'] > 0):
@@ -143,19 +276,18 @@ def tile_search2(Jobs, X, Y):
         print("You can specify a timeout by setting 'SearchTimeout' in  Layout.cfg")
     print("Estimated maximum possible utilization is %.1f%%." %
           (tiling.maxUtilization(Jobs) * 100))
+    if search.workers > 1:
+        print("Running %d random placement workers in parallel." % search.workers)
 
-    try:
-        _tile_search2(Jobs, X, Y)
-        printTilingStats()
-        print("\n")
-    except KeyboardInterrupt:
-        printTilingStats()
-        print("\n")
+    T = search.run(best)
+    printTilingStats(search)
+    print("\n")
+    if search.interrupted:
         print("Interrupted.")
 
-    computeTime = time.time() - _StartTime
+    computeTime = time.time() - search.startTime
     print("Computed %ld placements in %d seconds / %.1f placements/second" %
-          (_Placements, computeTime, _Placements / computeTime))
+          (search.placements, computeTime, search.placements / computeTime))
     print('=' * 70)
 
-    return _TBestTiling
+    return T
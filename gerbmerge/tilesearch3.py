@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""Tile search using simulated annealing over the order and rotation of jobs
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+"""
+
+import math
+import random
+import sys
+import time
+
+from . import config, tiling, tilesearch, tilesearch2
+
+# Each annealing run makes AnnealSteps placements per job, while the
+# temperature falls from AnnealStartTemperature times the total job area
+# to AnnealEndTemperature times the total job area. After each run the
+# search starts again from the best placement so far.
+AnnealSteps = 100
+AnnealStartTemperature = 0.02
+AnnealEndTemperature = 0.00002
+
+
+def decode(Jobs, order, rotated, X, Y, cfg=config.Config):
+    """Place the jobs of Jobs, a list of 4-tuples (Xdim,Ydim,job,rjob), on a new
+    X-by-Y tiling in the given order of indices into Jobs. rotated[ix] says whether
+    Jobs[ix] is placed rotated; a job that only fits the other way round is placed
+    that way. Each job goes where it least increases the area of the tiling, the
+    lowest and then left-most such place. Returns None if some job does not fit."""
+    xspacing = cfg['xspacing']
+    yspacing = cfg['yspacing']
+
+    T = tiling.Tiling(X, Y)
+    minInletSize = tiling.minDimension(Jobs)
+    right = top = 0.0
+
+    for ix in order:
+        Xdim, Ydim, job, rjob = Jobs[ix]
+
+        T.removeInlets(minInletSize)
+
+        for rotate in (rotated[ix], not rotated[ix]):
+            if rotate:
+                W, H, J = Ydim + xspacing, Xdim + yspacing, rjob
+            else:
+                W, H, J = Xdim + xspacing, Ydim + yspacing, job
+
+            addpoints = T.validAddPoints(W, H)
+            if addpoints:
+                break
+        else:
+            return None
+
+        best = None
+        for pt in addpoints:
+            x, y = T.points[pt]
+            if T.isL(pt):
+                key = (max(right, x + W) * max(top, y + H), y, x)
+            else:
+                key = (max(right, x) * max(top, y + H), y, x)
+            if best is None or key < best[0]:
+                best = (key, pt)
+
+        T.addJob(best[1], W, H, J)
+        bl, tr, J = T.jobs[-1]
+        right = max(right, tr[0])
+        top = max(top, tr[1])
+
+    return T
+
+
+def neighbour(order, rotated, r):
+    """Return a copy of the (order, rotated) solution with a small random change:
+    two jobs swapped, one job moved elsewhere in the order, or one job turned."""
+    order = order[:]
+    rotated = rotated[:]
+    N = len(order)
+
+    move = r.randrange(3)
+    if move == 0 and N > 1:
+        i, j = r.sample(range(N), 2)
+        order[i], order[j] = order[j], order[i]
+    elif move == 1 and N > 1:
+        i, j = r.sample(range(N), 2)
+        order.insert(j, order.pop(i))
+    else:
+        ix = r.randrange(N)
+        rotated[ix] = not rotated[ix]
+
+    return order, rotated
+
+
+class AnnealSearch(tilesearch.TileSearch):
+    """Simulated annealing search for the best tiling, using the given seed for
+    its random number generator. See tilesearch.TileSearch for the other
+    arguments."""
+
+    name = 'anneal'
+
+    def __init__(self, Jobs, X, Y, cfg=config.Config, seed=None, **kwargs):
+        tilesearch.TileSearch.__init__(self, Jobs, X, Y, cfg, **kwargs)
+        self.seed = seed
+
+    def search(self, state):
+        Jobs = self.Jobs
+        r = random.Random(self.seed)
+        N = len(Jobs)
+
+        # Jobs of no area at all still need a temperature to divide by
+        usedArea = max(sum([job.jobarea() for Xdim, Ydim, job, rjob in Jobs]), 1e-9)
+        steps = max(AnnealSteps * N, 1)
+        cooling = (AnnealEndTemperature / AnnealStartTemperature) ** (1.0 / steps)
+
+        # Start from the order the jobs were given in (largest first), unrotated
+        bestOrder = list(range(N))
+        bestRotated = [False] * N
+        if state:
+            r.setstate(state['random'])
+            bestOrder, bestRotated = state['order'], state['rotated']
+
+        def checkpoint():
+            return {'random': r.getstate(), 'order': bestOrder, 'rotated': bestRotated}
+
+        try:
+            # Must escape with Ctrl-C
+            while True:
+                order, rotated = bestOrder, bestRotated
+                T = decode(Jobs, order, rotated, self.X, self.Y, self.cfg)
+                self.placements += 1
+                if T:
+                    score = T.area()
+                    self.offer(T)
+                else:
+                    score = float(sys.maxsize)
+
+                temperature = AnnealStartTemperature * usedArea
+                for step in range(steps):
+                    newOrder, newRotated = neighbour(order, rotated, r)
+                    T = decode(Jobs, newOrder, newRotated, self.X, self.Y, self.cfg)
+                    self.placements += 1
+
+                    if T:
+                        newScore = T.area()
+
+                        # Always accept a placement at least as good, and a worse one
+                        # with a probability that falls with the temperature
+                        if newScore <= score or r.random() < math.exp((score - newScore) / temperature):
+                            order, rotated, score = newOrder, newRotated, newScore
+
+                            if self.offer(T):
+                                bestOrder, bestRotated = order, rotated
+
+                    temperature *= cooling
+
+                    # Report progress every few seconds
+                    self.poll(checkpoint)
+
+                # Nothing fits yet, so try again from a random order
+                if self.bestTiling is None:
+                    bestOrder = r.sample(range(N), N)
+                    bestRotated = [r.choice([False, True]) for ix in range(N)]
+
+            # end while 1
+        finally:
+            self.save(checkpoint())
+
+
+def tile_search3(Jobs, X, Y, best=None):
+    """Run an AnnealSearch, printing statistics. If best is a Tiling, it is
+    returned unless a better one is found."""
+    search = AnnealSearch(Jobs, X, Y, progress=tilesearch2.printTilingStats,
+                          checkpointFile=config.CheckpointFile, resume=config.ResumeSearch)
+
+    print('=' * 70)
+    if (config.Config['searchtimeout'] > 0):
+        print("Starting simulated annealing placement. You can press Ctrl-C")
+        print("to stop the process and use the best placement so far, or wait")
+        print("for the automatic timeout in %i seconds." %
+              config.Config['searchtimeout'])
+    else:
+        print("Starting simulated annealing placement. You must press Ctrl-C")
+        print("to stop the process and use the best placement so far.")
+        print("You can specify a timeout by setting 'SearchTimeout' in  Layout.cfg")
+    print("Estimated maximum possible utilization is %.1f%%." %
+          (tiling.maxUtilization(Jobs) * 100))
+
+    T = search.run(best)
+    tilesearch2.printTilingStats(search)
+    print("\n")
+    if search.interrupted:
+        print("Interrupted.")
+
+    computeTime = time.time() - search.startTime
+    print("Computed %ld placements in %d seconds / %.1f placements/second" %
+          (search.placements, computeTime, search.placements / computeTime))
+    print('=' * 70)
+
+    return T
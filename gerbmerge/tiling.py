@@ -27,7 +27,6 @@ of two things:
 # You should have received a copy of the GNU General Public License
 # along with Foobar.  If not, see <https://www.gnu.org/licenses/>.
 
-import copy
 import sys
 import math
 
@@ -58,6 +57,56 @@ def below(p1, p2):
     return p1[1] < p2[1] and p1[0] == p2[0]
 
 
+def collapseInlet(pt, ix, minSize):
+    """If the points pt[ix] to pt[ix+3] form an inlet narrower than minSize (see
+    Tiling.removeInlets), remove it from the list pt and return 1, else return 0."""
+
+    # Check for horizontal left-going inlet
+    if right_of(pt[ix], pt[ix + 1]) and above(pt[ix + 1],
+                                              pt[ix + 2]) and left_of(pt[ix + 2], pt[ix + 3]):
+        # Make sure minSize requirement is met
+        if pt[ix][1] - pt[ix + 3][1] < minSize:
+            # Get rid of middle two points, extend Y-value of
+            # highest point down to lowest point
+            pt[ix] = (pt[ix][0], pt[ix + 3][1])
+            del pt[ix + 1: ix + 3]
+            return 1
+
+    # Check for horizontal right-going inlet
+    if left_of(pt[ix], pt[ix + 1]) and below(pt[ix + 1],
+                                             pt[ix + 2]) and right_of(pt[ix + 2], pt[ix + 3]):
+        # Make sure minSize requirement is met
+        if pt[ix + 3][1] - pt[ix][1] < minSize:
+            # Get rid of middle two points, exten Y-value of
+            # highest point down to lowest point
+            pt[ix + 3] = (pt[ix + 3][0], pt[ix][1])
+            del pt[ix + 1: ix + 3]
+            return 1
+
+    # Check for vertical inlets
+    if above(pt[ix], pt[ix + 1]) and left_of(pt[ix + 1],
+                                             pt[ix + 2]) and below(pt[ix + 2], pt[ix + 3]):
+        # Make sure minSize requirement is met
+        if pt[ix + 3][0] - pt[ix][0] < minSize:
+            # Is right side lower or higher?
+            if pt[ix + 3][1] >= pt[ix][1]:   # higher?
+                # Move first point to the right
+                pt[ix] = (pt[ix + 3][0], pt[ix][1])
+            else:                        # lower?
+                # Move last point to the left
+                pt[ix + 3] = (pt[ix][0], pt[ix + 3][1])
+            del pt[ix + 1: ix + 3]
+            return 1
+
+    return 0
+
+
+# Number of squares along each side of the panel in the spatial index used to
+# find overlapping jobs, and the number of jobs from which on it is used
+GridSize = 16
+GridMinJobs = 64
+
+
 class Tiling(object):
     def __init__(self, Xmax, Ymax):
         # Make maximum dimensions bigger by inter-job spacing so that
@@ -75,11 +124,24 @@ class Tiling(object):
         # The actual job has dimensions (Xtr-Xbl-Config['xspacing'],Ytr-Ybl-Config['yspacing'])
         # and is located at the lower-left of the cell.
 
+        # Spatial index of self.jobs, so that isOverlap() only has to look at
+        # jobs near the new job. The panel is divided into GridSize-by-GridSize
+        # squares and the dictionary maps (column,row) of a square to a tuple
+        # of the entries of self.jobs whose cells touch it. Tuples are replaced
+        # rather than modified so clones can share them. The index is only
+        # built once there are GridMinJobs jobs and is brought up to date
+        # with the jobs added since then when it is next used.
+        self.gridx = self.xmax / GridSize
+        self.gridy = self.ymax / GridSize
+        self.grid = {}
+        self.gridJobs = 0    # Number of entries of self.jobs in self.grid
+
     def canonicalize(self, OriginX, OriginY):
         """Return a list of JobLayout objects, after setting each job's (X,Y) origin"""
         L = []
         for job in self.jobs:
-            J = jobs.JobLayout(job[2])
+            # Rotated jobs are only created now that they are known to be needed
+            J = jobs.JobLayout(job[2].materialize())
             J.setPosition(job[0][0] + OriginX, job[0][1] + OriginY)
             L.append(J)
 
@@ -89,14 +151,19 @@ class Tiling(object):
         return len(self.points) - 2
 
     def clone(self):
-        T = Tiling(
-            self.xmax - config.Config['xspacing'],
-            self.ymax - config.Config['yspacing'])
+        """Return a copy of this tiling that can have jobs added to it without
+        affecting the original. Entries in self.jobs are tuples and the Job objects
+        in them are never modified during a search, so they are shared rather than
+        copied. Only the two lists are duplicated."""
+        T = Tiling.__new__(Tiling)
+        T.xmax = self.xmax
+        T.ymax = self.ymax
         T.points = self.points[:]
-
-        # TODO: revert the stuff below
-        # T.jobs = self.jobs[:]
-        T.jobs = copy.deepcopy(self.jobs)
+        T.jobs = self.jobs[:]
+        T.gridx = self.gridx
+        T.gridy = self.gridy
+        T.grid = self.grid.copy()
+        T.gridJobs = self.gridJobs
         return T
 
     def dump(self, fid=sys.stdout):
@@ -157,13 +224,47 @@ class Tiling(object):
             if p_bl[0] < 0 or p_tr[1] > self.ymax:
                 return 1
 
-        for t_bl, t_tr, Job in self.jobs:
-            if p_bl[0] < t_tr[0] and p_tr[0] > t_bl[0] and \
-               p_bl[1] < t_tr[1] and p_tr[1] > t_bl[1]:
-                return 1
+        # For a few jobs it is quickest to just check all of them
+        if len(self.jobs) < GridMinJobs:
+            for t_bl, t_tr, Job in self.jobs:
+                if p_bl[0] < t_tr[0] and p_tr[0] > t_bl[0] and \
+                   p_bl[1] < t_tr[1] and p_tr[1] > t_bl[1]:
+                    return 1
+            return 0
+
+        # Otherwise only the jobs in the squares of the spatial index touched
+        # by the new job need to be checked
+        if self.gridJobs < len(self.jobs):
+            self.updateGrid()
+
+        grid = self.grid
+        x0, x1, y0, y1 = self.gridSquares(p_bl, p_tr)
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                for t_bl, t_tr, Job in grid.get((x, y), ()):
+                    if p_bl[0] < t_tr[0] and p_tr[0] > t_bl[0] and \
+                       p_bl[1] < t_tr[1] and p_tr[1] > t_bl[1]:
+                        return 1
 
         return 0
 
+    def gridSquares(self, bl, tr):
+        """Return (x0, x1, y0, y1) such that the squares of the spatial index
+        touched by the rectangle with bottom-left bl and top-right tr, which
+        must lie within the panel, are in columns x0 to x1-1 and rows y0 to y1-1"""
+        return (int(bl[0] / self.gridx), min(int(tr[0] / self.gridx), GridSize - 1) + 1,
+                int(bl[1] / self.gridy), min(int(tr[1] / self.gridy), GridSize - 1) + 1)
+
+    def updateGrid(self):
+        """Add the jobs not yet in the spatial index to it"""
+        grid = self.grid
+        for job in self.jobs[self.gridJobs:]:
+            x0, x1, y0, y1 = self.gridSquares(job[0], job[1])
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    grid[x, y] = grid.get((x, y), ()) + (job,)
+        self.gridJobs = len(self.jobs)
+
     def isL(self, ix):
         """True if self.points[ix] represents an L-shaped corner where there
         is free space above and to the right, like this:
@@ -265,52 +366,24 @@ mirrored-L corner __  |      |
        that are too small for any job to fit in (as defined by minSize). These inlets
        can be deleted to form corners where new jobs can be placed.
         """
-        pt = self.points
-        done = 0
-
-        while not done:
-            # Repeat this loop each time there is a change
-            for ix in range(0, len(pt) - 3):
-
-                # Check for horizontal left-going inlet
-                if right_of(pt[ix], pt[ix + 1]) and above(pt[ix + 1],
-                                                          pt[ix + 2]) and left_of(pt[ix + 2], pt[ix + 3]):
-                    # Make sure minSize requirement is met
-                    if pt[ix][1] - pt[ix + 3][1] < minSize:
-                        # Get rid of middle two points, extend Y-value of
-                        # highest point down to lowest point
-                        pt[ix] = (pt[ix][0], pt[ix + 3][1])
-                        del pt[ix + 1: ix + 3]
-                        break
-
-                # Check for horizontal right-going inlet
-                if left_of(pt[ix], pt[ix + 1]) and below(pt[ix + 1],
-                                                         pt[ix + 2]) and right_of(pt[ix + 2], pt[ix + 3]):
-                    # Make sure minSize requirement is met
-                    if pt[ix + 3][1] - pt[ix][1] < minSize:
-                        # Get rid of middle two points, exten Y-value of
-                        # highest point down to lowest point
-                        pt[ix + 3] = (pt[ix + 3][0], pt[ix][1])
-                        del pt[ix + 1: ix + 3]
-                        break
-
-                # Check for vertical inlets
-                if above(pt[ix], pt[ix + 1]) and left_of(pt[ix + 1],
-                                                         pt[ix + 2]) and below(pt[ix + 2], pt[ix + 3]):
-                    # Make sure minSize requirement is met
-                    if pt[ix + 3][0] - pt[ix][0] < minSize:
-                        # Is right side lower or higher?
-                        if pt[ix + 3][1] >= pt[ix][1]:   # higher?
-                            # Move first point to the right
-                            pt[ix] = (pt[ix + 3][0], pt[ix][1])
-                        else:                        # lower?
-                            # Move last point to the left
-                            pt[ix + 3] = (pt[ix][0], pt[ix + 3][1])
-                        del pt[ix + 1: ix + 3]
-                        break
-
-            else:
-                done = 1
+        # The points are swept once from left to right, collapsing inlets as
+        # soon as their last point is reached. Since every inlet to the left
+        # has already been collapsed, this collapses the same inlets, in the
+        # same order, as rescanning from the first point after each change.
+        pt = []
+        for point in self.points:
+            pt.append(point)
+
+            ix = len(pt) - 4
+            while 0 <= ix <= len(pt) - 4:
+                if collapseInlet(pt, ix, minSize):
+                    # The last two points have changed, so the inlets ending
+                    # at either of them have to be checked again
+                    ix = max(len(pt) - 5, 0)
+                else:
+                    ix += 1
+
+        self.points = pt
 
     def addLJob(self, ix, X, Y, Job, cfg=config.Config):
         """Add a job to the tiling at L-point self.points[ix] with actual dimensions X-by-Y.
@@ -373,6 +446,43 @@ mirrored-L corner __  |      |
         DY = tr[1] - bl[1]
         return DX * DY
 
+    def minArea(self, Jobs):
+        """Return a lower bound on the area of any tiling made by adding the jobs
+        in Jobs to this one. Jobs list is 4-tuple (Xdim,Ydim,job,rjob)."""
+        xspacing = config.Config['xspacing']
+        yspacing = config.Config['yspacing']
+
+        # The final tiling contains every cell (a job plus its spacing) and
+        # is at least as wide and as tall as this one. Each remaining job,
+        # rotated or not, needs at least its smaller dimension along both axes.
+        cells = 0.0
+        X = Y = 0.0
+        for bl, tr, job in self.jobs:
+            cells += (tr[0] - bl[0]) * (tr[1] - bl[1])
+            X = max(X, tr[0])
+            Y = max(Y, tr[1])
+
+        for Xdim, Ydim, job, rjob in Jobs:
+            cells += min((Xdim + xspacing) * (Ydim + yspacing),
+                         (Ydim + xspacing) * (Xdim + yspacing))
+            X = max(X, min(Xdim, Ydim) + xspacing)
+            Y = max(Y, min(Xdim, Ydim) + yspacing)
+
+        bound = (X - xspacing) * (Y - yspacing)
+
+        # A tiling of width W holding all cells has area at least
+        # (W-xspacing)*(cells/W-yspacing). This is concave in W so over the
+        # possible widths it is smallest at one of the ends.
+        def area(W):
+            return (W - xspacing) * (cells / W - yspacing)
+
+        lo = max(X, cells / self.ymax)
+        hi = min(self.xmax, cells / Y)
+        if lo <= hi:
+            bound = max(bound, min(area(lo), area(hi)))
+
+        return bound
+
     def usedArea(self):
         """Return total area of just jobs, not spaces in-between."""
         area = 0.0
@@ -392,7 +502,7 @@ def maxUtilization(Jobs):
     for Xdim, Ydim, job, rjob in Jobs:
         usedArea += job.jobarea()
         totalArea += job.jobarea()
-        totalArea += job.width_in() * xspacing + job.height_in() * \
+        totalArea += job.width * xspacing + job.height * \
             yspacing + xspacing * yspacing
 
     # Reduce total area by strip of unused spacing around top and side. Assume
@@ -0,0 +1,52 @@
+"""Benchmark for placing many small jobs on a panel.
+
+Places N jobs of a few small sizes at random add-points of a tiling, the
+same way the random search does, and prints the number of placements per
+second. Run from the top-level directory:
+
+    python -m tests.benchmark_tiling [N [seconds]]
+"""
+
+import random
+import sys
+import time
+
+from gerbmerge import config, tiling
+
+
+def benchmark(N, seconds, X=12.6, Y=7.8, seed=1):
+    config.Config['xspacing'] = config.Config['yspacing'] = 0.1
+
+    r = random.Random(seed)
+    sizes = [(r.choice([0.3, 0.4, 0.5]), r.choice([0.2, 0.3, 0.4])) for ix in range(N)]
+    minInletSize = min(min(size) for size in sizes)
+
+    trials = placements = 0
+    startTime = time.time()
+    while time.time() - startTime < seconds:
+        T = tiling.Tiling(X, Y)
+        for ix in r.sample(range(N), N):
+            Xdim, Ydim = sizes[ix]
+            if r.choice([0, 1]):
+                Xdim, Ydim = Ydim, Xdim
+
+            T.removeInlets(minInletSize)
+            addpoints = T.validAddPoints(Xdim + 0.1, Ydim + 0.1)
+            if not addpoints:
+                break
+
+            T = T.clone()
+            T.addJob(r.choice(addpoints), Xdim + 0.1, Ydim + 0.1, None)
+            placements += 1
+        trials += 1
+
+    return trials, placements / (time.time() - startTime)
+
+
+if __name__ == "__main__":
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    for jobs in ([N] if N else [10, 50, 100, 200]):
+        trials, rate = benchmark(jobs, seconds)
+        print("%4d jobs: %6d panels / %8.0f placements/second" % (jobs, trials, rate))
@@ -0,0 +1,106 @@
+import pytest
+
+from gerbmerge import aptable, config
+from gerbmerge.gerber import GerberParser
+
+
+HEADER = '%FSLAX25Y25*%\n%MOIN*%\n'
+
+
+@pytest.fixture(autouse=True)
+def units():
+    config.Config['measurementunits'] = 'inch'
+
+
+def parseGerber(path, data):
+    with open(path, 'w') as fid:
+        fid.write(HEADER + data)
+    G = GerberParser()
+    G.parse(str(path))
+    return G
+
+
+def test_merge_shares_global_codes(tmp_path):
+    A = parseGerber(tmp_path / 'a.gbr',
+                    '%ADD10C,0.01000*%\n%ADD11R,0.02000X0.03000*%\n'
+                    'D11*\nX100Y100D03*\nD10*\nX200Y200D02*\nX300Y200D01*\nM02*\n')
+    B = parseGerber(tmp_path / 'b.gbr',
+                    '%ADD10R,0.02000X0.03000*%\n%ADD12C,0.05000*%\n'
+                    'D10*\nX100Y100D03*\nD12*\nX100Y100D03*\nM02*\n')
+
+    # Before merging, aperture changes use the codes local to each file
+    assert A.apertures == ['D11', 'D10']
+    assert B.apertures == ['D10', 'D12']
+
+    aptable.mergeApertureTables([A, B])
+
+    assert [config.GAT[code].hash() for code in ('D10', 'D11', 'D12')] == \
+        ['Circle (0.01000)', 'Rectangle (0.02000 x 0.03000)', 'Circle (0.05000)']
+    assert A.apertures == ['D11', 'D10']
+    assert B.apertures == ['D11', 'D12']
+    assert [c for c in B.commands if isinstance(c, str)] == ['D11', 'D12']
+
+
+def test_merge_macros(tmp_path):
+    A = parseGerber(tmp_path / 'a.gbr',
+                    '%AMSQ*\n21,1,0.05,0.05,0.0,0.0,0.0*\n%\n%ADD10SQ*%\n'
+                    'D10*\nX100Y100D03*\nM02*\n')
+    B = parseGerber(tmp_path / 'b.gbr',
+                    '%AMBOX*\n21,1,0.05,0.05,0.0,0.0,0.0*\n%\n%ADD20C,0.01000*%\n%ADD21BOX*%\n'
+                    'D21*\nX100Y100D03*\nM02*\n')
+
+    aptable.mergeApertureTables([A, B])
+
+    # Both files define the same macro under different names
+    assert list(config.GAMT.keys()) == ['M1']
+    assert A.apmxlat == {'SQ': 'M1'}
+    assert B.apmxlat == {'BOX': 'M1'}
+    assert B.apxlat == {'D20': 'D11', 'D21': 'D10'}
+    assert config.GAT['D10'].dimx == 'M1'
+    assert A.macroDefs[0].name == 'SQ'
+
+
+def test_find_and_add_apertures(tmp_path):
+    A = parseGerber(tmp_path / 'a.gbr',
+                    '%ADD10C,0.01000*%\n%ADD11R,0.02000X0.03000*%\n'
+                    'D11*\nX100Y100D03*\nD10*\nX200Y200D02*\nM02*\n')
+    aptable.mergeApertureTables([A])
+
+    assert aptable.findInApertureTable(aptable.Aperture('Circle', 'D??', 0.01)) == 'D10'
+    assert aptable.findInApertureTable(aptable.Aperture('Circle', 'D??', 0.02)) is None
+
+    # New apertures get the next code, and are found from then on
+    AP = aptable.Aperture('Rectangle', 'D??', 0.01, 0.03)
+    assert aptable.findOrAddAperture(AP) == 'D12'
+    assert AP.code == 'D12'
+    assert aptable.findOrAddAperture(aptable.Aperture('Rectangle', 'D??', 0.01, 0.03)) == 'D12'
+    assert aptable.addToApertureTable(aptable.Aperture('Circle', 'D??', 0.5)) == 'D13'
+    assert config.GAT['D13'].hash() == 'Circle (0.50000)'
+
+    # Merging again starts the table over
+    aptable.mergeApertureTables([A])
+    assert sorted(config.GAT) == ['D10', 'D11']
+    assert aptable.findInApertureTable(AP) is None
+    assert aptable.addToApertureTable(AP) == 'D12'
+
+
+def test_aperture_registry():
+    R = config.ApertureRegistry('D', 10)
+    small = aptable.Aperture('Circle', 'D??', 0.01)
+    large = aptable.Aperture('Circle', 'D??', 0.05)
+
+    assert R.add(small) == 'D10'
+    R['D20'] = large
+    assert R.find(aptable.Aperture('Circle', 'D??', 0.05)) == 'D20'
+    assert R.add(aptable.Aperture('Oval', 'D??', 0.01, 0.02)) == 'D21'
+
+    # The reverse table follows entries that are replaced or removed
+    R['D20'] = aptable.Aperture('Circle', 'D??', 0.06)
+    assert R.find(large) is None
+    del R['D10']
+    assert R.find(small) is None
+    assert sorted(R) == ['D20', 'D21']
+
+    R.clear()
+    assert len(R) == 0
+    assert R.add(large) == 'D10'
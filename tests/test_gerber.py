@@ -0,0 +1,116 @@
+from gerbmerge import config  # noqa: F401 -- must be imported before gerber
+from gerbmerge.gerber import tokenize
+
+
+def test_tokenize_line():
+    line = 'G54D11*X22400Y22300D02*X22500D01*Y-5I10J-20D01*G04 note*%LNTOP*%'
+    tokens = [(kind, groups) for kind, groups, pos in tokenize(line)]
+    assert tokens == [
+        ('gcode', ('54',)),
+        ('tool', ('D11',)),
+        ('drawXY', ('22400', '22300', '2')),
+        ('drawX', ('22500', '1')),
+        ('cdrawY', ('-5', '10', '-20', '1')),
+        ('comment', ()),
+        ('ignore', ()),
+    ]
+
+
+def test_tokenize_stops_at_garbage():
+    tokens = list(tokenize('X1Y1D03*bogus'))
+    assert tokens[-1] == (None, None, 8)
+    assert len(tokens) == 2
+
+
+def test_command_list():
+    from gerbmerge.gerber import CommandList
+
+    commands = ['G75', 'D10', (1.5, 2.5, 2), (3.0, 4.0, 1), (5.0, 6.0, 0.5, -0.5, 1, True),
+                'D10', (7.0, 8.0, 1.0, 2.0, 2, False), '%LPD*%']
+    C = CommandList(commands)
+    assert list(C) == commands
+    assert len(C) == len(commands)
+    assert C[4] == commands[4]
+
+    C.mapStrings(lambda cmd: 'D12' if cmd == 'D10' else cmd)
+    C.shift(1, 2)
+    C.append('D10')
+    assert list(C) == ['G75', 'D12', (2.5, 4.5, 2), (4.0, 6.0, 1), (6.0, 8.0, 0.5, -0.5, 1, True),
+                       'D12', (8.0, 10.0, 1.0, 2.0, 2, False), '%LPD*%', 'D10']
+
+
+def test_transformed(monkeypatch):
+    from gerbmerge import gerber
+    from gerbmerge.gerber import CommandList
+
+    C = CommandList(['D10', (1.0, 2.0, 2), (3.0, 4.0, 0.5, -0.25, 1, True),
+                     (5.0, 6.0, 0.5, 0.25, 1, False)])
+    expected = ['D10', (8.0, 1.0, 2), (6.0, 3.0, 0.25, 0.5, 1, True),
+                (4.0, 5.0, 0.25, 0.5, 1, False)]
+
+    # 90 degrees counterclockwise, then shifted right by 10
+    assert list(C.transformed(0, -1, 1, 0, 10, 0)) == expected
+
+    monkeypatch.setattr(gerber, 'numpy', None)
+    assert list(C.transformed(0, -1, 1, 0, 10, 0)) == expected
+
+
+def test_render(monkeypatch):
+    import io
+
+    from gerbmerge import gerber
+    from gerbmerge.gerber import CommandList, GerberParser
+
+    G = GerberParser()
+    G.x_div = G.y_div = 0.00001
+    G.minx, G.miny = 100, 200
+    G.commands = CommandList(['G75', 'D10', (100.0, 200.0, 2), (350.0, 450.5, 1), (600.0, 200.0, 3),
+                              (700.0, 300.0, 50.0, -50.0, 1, True), '%LPD*%', (150.0, 250.0, 1)])
+    expected = ('X0100000Y0200000D02*\nG75*\nD10*\n'
+                'X0100000Y0200000D02*\nX0100250Y0200250D01*\nX0100500Y0200000D03*\n'
+                'X0100600Y0200100I0000050J-000050D01*\n%LPD*%\nX0100050Y0200050D01*\n')
+    assert G.render(1.0, 2.0) == expected
+
+    fid = io.StringIO()
+    G.write(fid, 1.0, 2.0)
+    assert fid.getvalue() == expected
+
+    # Coordinates that do not fit the format are written like %d does
+    assert G.render(-0.01, 2.0).startswith('X-001000Y0200000D02*\nG75*\nD10*\nX-001000Y0200000D02*\n')
+
+    monkeypatch.setattr(gerber, 'numpy', None)
+    assert G.render(1.0, 2.0) == expected
+
+
+def test_render_template():
+    from gerbmerge.gerber import CommandList, GerberParser
+
+    G = GerberParser()
+    G.x_div = G.y_div = 0.00001
+    G.minx, G.miny = 0, 0
+    G.commands = CommandList(['D10', (100.0, 200.0, 3)])
+    assert G.render(0.0, 0.0) == 'X0000000Y0000000D02*\nD10*\nX0000100Y0000200D03*\n'
+    assert G.render(1.0, 0.0) == 'X0100000Y0000000D02*\nD10*\nX0100100Y0000200D03*\n'
+
+    # The template is compiled once, and again when the commands change
+    template = G.commands.template()
+    assert G.commands.template() is template
+    G.commands.mapStrings(lambda cmd: 'D11')
+    assert G.commands.template() is not template
+    template = G.commands.template()
+    G.commands.mapStrings(lambda cmd: 'D11')
+    assert G.commands.template() is template
+    assert G.render(0.0, 0.0) == 'X0000000Y0000000D02*\nD11*\nX0000100Y0000200D03*\n'
+    G.commands.append((5.0, 5.0, 1))
+    assert G.render(0.0, 0.0).endswith('X0000005Y0000005D01*\n')
+
+
+def test_remap_apertures():
+    from gerbmerge.gerber import CommandList, GerberParser
+
+    G = GerberParser()
+    G.commands = CommandList(['D10', (1.0, 2.0, 3), 'D11', (3.0, 4.0, 3), 'D10', 'G75'])
+    G.apertures = ['D10', 'D11']
+    G.remapApertures({'D10': 'D12'})
+    assert [cmd for cmd in G.commands if isinstance(cmd, str)] == ['D12', 'D11', 'D12', 'G75']
+    assert G.apertures == ['D12', 'D11']
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+from gerbmerge import config, jobcache
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'ParseCache', 1)
+    monkeypatch.setattr(config, 'ParseCacheDir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(config, 'ParseCacheSize', 1024 * 1024)
+    monkeypatch.setattr(jobcache, '_Sizes', {})
+    return tmp_path
+
+
+def writeFile(path, data):
+    with open(path, 'w') as fid:
+        fid.write(data)
+    return str(path)
+
+
+def test_store_and_load(cache):
+    name = writeFile(cache / 'a.gbr', 'X1Y1D03*\n')
+    key = jobcache.makeKey(name, ('gerber', 0))
+    assert jobcache.load(key) is None
+
+    jobcache.store(key, {'commands': [(1, 1, 3)]})
+    assert jobcache.load(key) == {'commands': [(1, 1, 3)]}
+
+
+def test_key_depends_on_contents_and_settings(cache):
+    name = writeFile(cache / 'a.gbr', 'X1Y1D03*\n')
+    key = jobcache.makeKey(name, ('gerber', 0))
+
+    assert jobcache.makeKey(name, ('gerber', 1)) != key
+    writeFile(cache / 'a.gbr', 'X2Y1D03*\n')
+    assert jobcache.makeKey(name, ('gerber', 0)) != key
+
+
+def test_disabled(cache, monkeypatch):
+    name = writeFile(cache / 'a.gbr', 'X1Y1D03*\n')
+    monkeypatch.setattr(config, 'ParseCache', 0)
+
+    key = jobcache.makeKey(name, ('gerber', 0))
+    assert key is None
+    jobcache.store(key, 'data')
+    assert not os.path.exists(config.ParseCacheDir)
+
+
+def test_damaged_entry_is_removed(cache):
+    name = writeFile(cache / 'a.gbr', 'X1Y1D03*\n')
+    key = jobcache.makeKey(name, ('gerber', 0))
+    jobcache.store(key, 'data')
+
+    path = os.path.join(config.ParseCacheDir, key + '.gmc')
+    writeFile(path, 'garbage')
+    assert jobcache.load(key) is None
+    assert not os.path.exists(path)
+
+
+def test_evict_least_recently_used(cache):
+    keys = []
+    for i in range(3):
+        name = writeFile(cache / ('%d.gbr' % i), 'X%dY1D03*\n' % i)
+        keys.append(jobcache.makeKey(name, ('gerber', 0)))
+        jobcache.store(keys[-1], os.urandom(1000))
+        path = os.path.join(config.ParseCacheDir, keys[-1] + '.gmc')
+        os.utime(path, (i, i))
+
+    # Room for two entries only, the oldest one goes
+    size = os.path.getsize(os.path.join(config.ParseCacheDir, keys[0] + '.gmc'))
+    jobcache.evict(2 * size + 100)
+
+    assert jobcache.load(keys[0]) is None
+    assert jobcache.load(keys[1]) is not None
+    assert jobcache.load(keys[2]) is not None
+
+
+def test_evict_only_when_full(cache, monkeypatch):
+    scans = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda path: scans.append(path) or listdir(path))
+
+    # The first store finds out how full the cache is, later ones keep count
+    for i in range(3):
+        name = writeFile(cache / ('%d.gbr' % i), 'X%dY1D03*\n' % i)
+        jobcache.store(jobcache.makeKey(name, ('gerber', 0)), 'data')
+    assert len(scans) == 1
+
+    monkeypatch.setattr(config, 'ParseCacheSize', 100)
+    name = writeFile(cache / 'big.gbr', 'X9Y1D03*\n')
+    jobcache.store(jobcache.makeKey(name, ('gerber', 0)), os.urandom(1000))
+    assert len(scans) == 2
+    assert os.listdir(config.ParseCacheDir) == []
+
+
+def test_evict_removes_stale_temporary_files(cache):
+    os.makedirs(config.ParseCacheDir)
+    stale = writeFile(os.path.join(config.ParseCacheDir, 'a.tmp'), 'partial')
+    os.utime(stale, (0, 0))
+    fresh = writeFile(os.path.join(config.ParseCacheDir, 'b.tmp'), 'partial')
+
+    jobcache.evict(config.ParseCacheSize)
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
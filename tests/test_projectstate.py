@@ -0,0 +1,87 @@
+import pytest
+
+from gerbmerge import aptable, config, projectstate
+from gerbmerge.jobs import Job
+
+
+@pytest.fixture(autouse=True)
+def tables():
+    config.GAT.clear()
+    config.GAMT.clear()
+    yield
+    config.GAT.clear()
+    config.GAMT.clear()
+
+
+def writeFile(path, data):
+    with open(path, 'w') as fid:
+        fid.write(data)
+    return str(path)
+
+
+def makeTasks(tmp_path, data='X1Y1D03*\n'):
+    J = Job('a')
+    name = writeFile(tmp_path / 'a.gbr', data)
+    return [(J, '*toplayer', 'gerber', name, 1)]
+
+
+def test_store_and_load(tmp_path):
+    fname = str(tmp_path / 'state')
+    state = projectstate.ProjectState(fname)
+    assert state.get('tiling', 'key') is None
+
+    result = [(0, False)]
+    state.put('tiling', 'key', result)
+    result.append((1, True))
+
+    # Results are stored as they were when put() was called
+    state = projectstate.ProjectState(fname)
+    assert state.get('tiling', 'key') == [(0, False)]
+    assert state.get('tiling', 'other') is None
+    assert state.get('jobs', 'key') is None
+
+
+def test_damaged_file(tmp_path):
+    fname = writeFile(tmp_path / 'state', 'garbage')
+    state = projectstate.ProjectState(fname)
+    assert state.get('tiling', 'key') is None
+
+    state.put('tiling', 'key', 1)
+    assert projectstate.ProjectState(fname).get('tiling', 'key') == 1
+
+
+def test_jobs_key_depends_on_contents_and_settings(tmp_path, monkeypatch):
+    tasks = makeTasks(tmp_path)
+    key = projectstate.jobsKey(tasks)
+
+    monkeypatch.setattr(config, 'TrimGerber', 0)
+    assert projectstate.jobsKey(tasks) != key
+    monkeypatch.undo()
+
+    assert projectstate.jobsKey(tasks) == key
+    makeTasks(tmp_path, 'X2Y1D03*\n')
+    assert projectstate.jobsKey(tasks) != key
+
+
+def test_restore_jobs(tmp_path):
+    fname = str(tmp_path / 'state')
+    tasks = makeTasks(tmp_path)
+    Jobs = {'a': tasks[0][0]}
+
+    state = projectstate.ProjectState(fname)
+    assert not state.restoreJobs(tasks, Jobs)
+    aptable.addToApertureTable(aptable.Aperture('Circle', 'D??', 0.01))
+    Jobs['a'].minx = 5
+    state.saveJobs(Jobs)
+
+    config.GAT.clear()
+    Jobs = {'a': Job('a')}
+    Jobs['a'].Repeat = 3
+
+    state = projectstate.ProjectState(fname)
+    assert state.restoreJobs(tasks, Jobs)
+    assert state.jobsRestored
+    assert Jobs['a'].minx == 5
+    assert Jobs['a'].Repeat == 3
+    assert list(config.GAT) == ['D10']
+    assert config.GAT.find(aptable.Aperture('Circle', 'D??', 0.01)) == 'D10'
@@ -0,0 +1,302 @@
+import random
+
+import pytest
+
+from gerbmerge import checkpoint, config, tiling, tilesearch, tilesearch1
+
+
+class StubJob(object):
+    def __init__(self, name, width, height):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.Repeat = 1
+
+    def jobarea(self):
+        return self.width * self.height
+
+    def maxdimension(self):
+        return max(self.width, self.height)
+
+
+def makeJobs(spec):
+    L = []
+    for name, width, height, repeat in spec:
+        job = StubJob(name, width, height)
+        rjob = StubJob(name + '*rotated90', height, width)
+        L.extend([(width, height, job, rjob)] * repeat)
+    return L
+
+
+@pytest.fixture(autouse=True)
+def searchConfig(monkeypatch):
+    monkeypatch.setitem(config.Config, 'xspacing', 0.1)
+    monkeypatch.setitem(config.Config, 'yspacing', 0.1)
+    monkeypatch.setitem(config.Config, 'searchtimeout', 0)
+    monkeypatch.setattr(config, 'CheckpointFile', None)
+    monkeypatch.setattr(config, 'ResumeSearch', 0)
+
+
+def test_possible_permutations():
+    Jobs = makeJobs([('a', 1, 2, 3), ('b', 2, 3, 1)])
+    assert tilesearch1.possiblePermutations(Jobs) == 4 * 2**4
+    assert tilesearch1.possiblePermutations(makeJobs([('a', 1, 2, 12)])) == 2**12
+
+
+def test_repeated_jobs_are_interchangeable(monkeypatch):
+    # Jobs of the same size would otherwise be found in the memo
+    monkeypatch.setattr(tilesearch1, '_MemoSize', 0)
+
+    Jobs = makeJobs([('a', 1, 2, 3), ('b', 1.5, 1, 1)])
+    search = tilesearch1.ExhaustiveSearch(Jobs, 10, 10)
+    best = search.run()
+
+    # Every distinct ordering is visited exactly once
+    assert search.permutations == search.possiblePermutations
+
+    # Distinct jobs of the same size give the same best area, but each
+    # ordering of them is searched
+    distinct = makeJobs([('a', 1, 2, 1), ('c', 1, 2, 1), ('d', 1, 2, 1), ('b', 1.5, 1, 1)])
+    unique = tilesearch1.ExhaustiveSearch(distinct, 10, 10)
+    assert best.area() == unique.run().area()
+    assert unique.placements == 6 * search.placements
+
+
+def test_bound_does_not_change_best_tiling(monkeypatch):
+    Jobs = makeJobs([('a', 0.7, 1.9, 1), ('b', 1.07, 1.69, 1), ('c', 1.44, 1.48, 1), ('d', 1.81, 1.27, 1)])
+    search = tilesearch1.ExhaustiveSearch(Jobs, 8, 8)
+    best = search.run()
+    assert search.permutations == search.possiblePermutations
+
+    monkeypatch.setattr(tiling.Tiling, 'minArea', lambda self, Jobs: 0)
+    unbounded = tilesearch1.ExhaustiveSearch(Jobs, 8, 8)
+    T = unbounded.run()
+    assert (best.area(), best.corners()) == (T.area(), T.corners())
+    assert search.placements < unbounded.placements
+
+
+def test_min_area_is_a_lower_bound():
+    Jobs = makeJobs([('a', 0.7, 1.9, 1), ('b', 1.07, 1.69, 2)])
+    best = tilesearch1.tile_search1(Jobs, 8, 8)
+    assert tiling.Tiling(8, 8).minArea(Jobs) <= best.area()
+
+
+def test_memo_skips_repeated_states(monkeypatch):
+    Jobs = makeJobs([('a', 0.7, 1.9, 1), ('b', 1.07, 1.69, 1), ('c', 1.44, 1.48, 1), ('d', 1.81, 1.27, 1)])
+    search = tilesearch1.ExhaustiveSearch(Jobs, 8, 8)
+    best = search.run()
+    assert search.memoHits > 0
+    assert search.permutations == search.possiblePermutations
+
+    monkeypatch.setattr(tilesearch1, '_MemoSize', 0)
+    nomemo = tilesearch1.ExhaustiveSearch(Jobs, 8, 8)
+    T = nomemo.run()
+    assert nomemo.memoHits == 0
+    assert (best.area(), best.corners()) == (T.area(), T.corners())
+    assert search.placements < nomemo.placements
+
+
+def test_anneal_decode_places_every_job():
+    from gerbmerge import tilesearch3
+
+    Jobs = makeJobs([('a', 0.7, 1.9, 3), ('b', 1.07, 1.69, 2), ('c', 2.5, 0.5, 1)])
+    order = list(range(len(Jobs)))
+    rotated = [False] * len(Jobs)
+
+    T = tilesearch3.decode(Jobs, order, rotated, 8, 8)
+    assert len(T.jobs) == len(Jobs)
+    assert T.area() >= tiling.Tiling(8, 8).minArea(Jobs)
+
+    order, rotated = tilesearch3.neighbour(order, rotated, random.Random(1))
+    assert sorted(order) == list(range(len(Jobs)))
+    assert len(tilesearch3.decode(Jobs, order, rotated, 8, 8).jobs) == len(Jobs)
+
+    # Nothing fits on a tiny panel
+    assert tilesearch3.decode(Jobs, order, rotated, 1, 1) is None
+
+
+def test_pack():
+    from gerbmerge import tilepack
+
+    Jobs = makeJobs([('a', 0.7, 1.9, 5), ('b', 1.07, 1.69, 4), ('c', 2.5, 0.5, 3)])
+    T = tilepack.pack(Jobs, 8, 8)
+    assert len(T.jobs) == len(Jobs)
+    assert [job.name for bl, tr, job in T.jobs] == [job.name for bl, tr, job in tilepack.pack(Jobs, 8, 8).jobs]
+
+    for ix, (bl, tr, job) in enumerate(T.jobs):
+        assert (tr[0] - bl[0] - 0.1, tr[1] - bl[1] - 0.1) == pytest.approx((job.width, job.height))
+        assert 0 <= bl[0] and tr[0] <= 8.1 and 0 <= bl[1] and tr[1] <= 8.1
+        for t_bl, t_tr, other in T.jobs[:ix]:
+            assert not (bl[0] < t_tr[0] and tr[0] > t_bl[0] and bl[1] < t_tr[1] and tr[1] > t_bl[1])
+
+    assert tilepack.pack(Jobs, 2, 2) is None
+
+
+def test_pack_elongated_job():
+    from gerbmerge import tilepack
+
+    # Only a bin as wide as the panel holds this job
+    Jobs = makeJobs([('a', 12.0, 0.2, 1)])
+    assert tiling.Tiling(12.6, 7.8).validAddPoints(12.1, 0.3)
+    T = tilepack.pack(Jobs, 12.6, 7.8)
+    assert len(T.jobs) == 1
+    assert tilepack.pack(Jobs, 11.5, 7.8) is None
+
+
+def test_search_starts_from_packing():
+    from gerbmerge import tilepack
+
+    Jobs = makeJobs([('a', 0.7, 1.9, 2), ('b', 1.07, 1.69, 1), ('c', 2.5, 0.5, 1)])
+    packed = tilepack.pack(Jobs, 8, 8)
+    best = tilesearch1.tile_search1(Jobs, 8, 8, packed)
+    assert best.area() <= packed.area()
+    assert best.area() == pytest.approx(tilesearch1.tile_search1(Jobs, 8, 8).area())
+
+
+def test_resume_exhaustive_search(monkeypatch, tmp_path):
+    Jobs = makeJobs([('a', 1, 2, 2), ('b', 1.5, 1, 1), ('c', 0.5, 2.5, 1)])
+    full = tilesearch1.tile_search1(Jobs, 10, 10)
+    fname = str(tmp_path / 'search.ckpt')
+
+    # Report progress at every chance and interrupt the search after a few
+    # checkpoints
+    def progress(search):
+        if search.placements > 20:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(tilesearch, 'ReportInterval', -1)
+    search = tilesearch1.ExhaustiveSearch(Jobs, 10, 10, progress=progress, checkpointFile=fname)
+    search.run()
+    assert search.interrupted
+    monkeypatch.undo()
+
+    monkeypatch.setitem(config.Config, 'xspacing', 0.1)
+    monkeypatch.setitem(config.Config, 'yspacing', 0.1)
+    resumed = tilesearch1.ExhaustiveSearch(Jobs, 10, 10, checkpointFile=fname, resume=1)
+    T = resumed.run()
+
+    # Every ordering is accounted for exactly once over both runs
+    assert resumed.permutations == resumed.possiblePermutations
+    assert T.area() == full.area()
+    assert sorted(job.name for bl, tr, job in T.jobs) == sorted(job.name for bl, tr, job in full.jobs)
+
+    # A checkpoint only fits the search it was saved for
+    with pytest.raises(RuntimeError):
+        checkpoint.Checkpoint(fname, 'exhaustive', Jobs[1:], 10, 10).load()
+
+
+def test_resume_anneal_search(monkeypatch, tmp_path):
+    from gerbmerge import tilesearch3
+
+    Jobs = makeJobs([('a', 0.7, 1.9, 3), ('b', 1.07, 1.69, 2), ('c', 2.5, 0.5, 1)])
+    fname = str(tmp_path / 'search.ckpt')
+
+    def progress(search):
+        if search.placements > 50:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(tilesearch, 'ReportInterval', -1)
+    search = tilesearch3.AnnealSearch(Jobs, 8, 8, seed=1, progress=progress, checkpointFile=fname)
+    search.run()
+    assert search.interrupted
+
+    saved, state = checkpoint.Checkpoint(fname, 'anneal', Jobs, 8, 8).load()
+    assert saved.area() == search.bestScore
+    assert sorted(state['order']) == list(range(len(Jobs)))
+
+    # The resumed search carries on from the best placement so far
+    resumed = tilesearch3.AnnealSearch(Jobs, 8, 8, seed=1, progress=lambda search: search.cancel(),
+                                       checkpointFile=fname, resume=1)
+    resumed.run()
+    assert resumed.bestScore <= search.bestScore
+
+
+def test_searches_run_concurrently():
+    import threading
+
+    from gerbmerge import tilesearch2, tilesearch3
+
+    Jobs = makeJobs([('a', 0.7, 1.9, 3), ('b', 1.07, 1.69, 2), ('c', 2.5, 0.5, 1)])
+    searches = [tilesearch2.RandomSearch(Jobs, 8, 8, seed=1, timeout=0),
+                tilesearch3.AnnealSearch(Jobs, 8, 8, seed=1, timeout=0),
+                tilesearch1.ExhaustiveSearch(Jobs, 8, 8, timeout=0)]
+    threads = [threading.Thread(target=search.run) for search in searches]
+    for thread in threads:
+        thread.start()
+
+    # The random and annealing searches never finish by themselves
+    for search in searches:
+        search.cancel()
+    for thread in threads:
+        thread.join()
+
+    for search in searches[:2]:
+        assert search.interrupted
+    for search in searches:
+        if search.bestTiling:
+            assert len(search.bestTiling.jobs) == len(Jobs)
+
+
+def test_interrupt_random_search(monkeypatch):
+    from gerbmerge import tilesearch2
+
+    # Ctrl-C arrives while the jobs left over by the random placement are
+    # searched exhaustively
+    calls = []
+
+    def interrupt(self, *args):
+        calls.append(self)
+        if len(calls) > 1:
+            raise RuntimeError("random search carried on after Ctrl-C")
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(tilesearch1.ExhaustiveSearch, '_search', interrupt)
+
+    Jobs = makeJobs([('a', 0.7, 1.9, 3), ('b', 1.07, 1.69, 2)])
+    search = tilesearch2.RandomSearch(Jobs, 20, 20, exhaustiveJobs=2, seed=1, timeout=0)
+    search.run()
+    assert search.interrupted
+    assert len(calls) == 1
+
+
+def test_worker_keys_keep_copies_interchangeable():
+    from gerbmerge import tilesearch2
+
+    Jobs = makeJobs([('a', 1, 2, 3), ('b', 2, 3, 1)])
+    Keys = tilesearch2.jobKeys(Jobs)
+    assert [key[2] for key in Keys] == [(0, 0), (0, 0), (0, 0), (3, 0)]
+    assert tilesearch1.possiblePermutations(Keys) == tilesearch1.possiblePermutations(Jobs)
+
+
+def stopAfter(placements):
+    "Return a progress function that stops the search after the given placements"
+    def progress(search):
+        if search.placements >= placements:
+            search.cancel()
+    return progress
+
+
+def test_anneal_beats_random_search(monkeypatch):
+    from gerbmerge import tilesearch2, tilesearch3
+
+    monkeypatch.setattr(tilesearch, 'ReportInterval', -1)
+    Jobs = makeJobs([('a', 0.7, 1.9, 4), ('b', 1.07, 1.69, 3), ('c', 2.5, 0.5, 2), ('d', 1.2, 1.2, 2)])
+
+    # Each random trial also searches its last jobs exhaustively, so it gets
+    # five times as many trials as annealing gets placements
+    anneal = tilesearch3.AnnealSearch(Jobs, 12, 12, seed=1, progress=stopAfter(200))
+    anneal.run()
+    rand = tilesearch2.RandomSearch(Jobs, 12, 12, seed=1, progress=stopAfter(1000))
+    rand.run()
+    assert anneal.bestScore <= rand.bestScore
+
+
+def test_anneal_jobs_without_area(monkeypatch):
+    from gerbmerge import tilesearch3
+
+    monkeypatch.setattr(tilesearch, 'ReportInterval', -1)
+    Jobs = makeJobs([('a', 0, 1.5, 3), ('b', 0, 0.5, 2)])
+    search = tilesearch3.AnnealSearch(Jobs, 8, 8, seed=1, progress=stopAfter(200))
+    search.run()
+    assert search.interrupted
+    assert len(search.bestTiling.jobs) == len(Jobs)
@@ -0,0 +1,95 @@
+import pytest
+
+from gerbmerge import config
+from gerbmerge.tiling import Tiling
+
+
+class FakeJob(object):
+    def __init__(self, name):
+        self.name = name
+
+
+@pytest.fixture(autouse=True)
+def spacing(monkeypatch):
+    monkeypatch.setitem(config.Config, 'xspacing', 0)
+    monkeypatch.setitem(config.Config, 'yspacing', 0)
+
+
+def test_clone_shares_jobs():
+    job = FakeJob('a')
+    T = Tiling(10, 10)
+    T.addJob(1, 2, 3, job)
+
+    C = T.clone()
+    assert C.points == T.points
+    assert C.jobs == T.jobs
+    assert C.jobs[0][2] is job
+    assert (C.xmax, C.ymax) == (T.xmax, T.ymax)
+
+
+def test_clone_is_independent():
+    T = Tiling(10, 10)
+    T.addJob(1, 2, 3, FakeJob('a'))
+    points = T.points[:]
+
+    C = T.clone()
+    ix = C.validAddPoints(4, 4)[0]
+    C.addJob(ix, 4, 4, FakeJob('b'))
+
+    assert T.points == points
+    assert len(T.jobs) == 1
+    assert len(C.jobs) == 2
+
+
+def test_rotated_job_is_lazy(monkeypatch):
+    from gerbmerge import jobs
+
+    rotations = []
+    monkeypatch.setattr(jobs, 'rotateJob', lambda job, degrees: rotations.append(job) or FakeJob('r'))
+
+    job = jobs.Job('a')
+    job.minx, job.miny, job.maxx, job.maxy = 0, 0, 200000, 100000
+    R = jobs.RotatedJob(job, 90)
+    assert (R.width, R.height) == (job.height, job.width)
+    assert R.name == 'a*rotated90'
+
+    T = Tiling(10, 10)
+    T.addJob(1, R.width, R.height, R)
+    T.addJob(T.validAddPoints(1, 1)[0], 1, 1, R)
+    assert rotations == []
+
+    L = T.canonicalize(0, 0)
+    assert rotations == [job]
+    assert L[0].job is L[1].job
+
+
+def test_spatial_index_matches_full_scan(monkeypatch):
+    import random
+    from gerbmerge import tiling
+
+    r = random.Random(1)
+    T = Tiling(12, 8)
+    while True:
+        X, Y = r.choice([0.3, 0.5]), r.choice([0.2, 0.4])
+        points = T.validAddPoints(X, Y)
+
+        monkeypatch.setattr(tiling, 'GridMinJobs', 1000)
+        assert points == T.validAddPoints(X, Y)
+        monkeypatch.undo()
+
+        if not points:
+            break
+        T = T.clone()
+        T.addJob(r.choice(points), X, Y, FakeJob('a'))
+
+    assert len(T.jobs) > tiling.GridMinJobs
+    assert T.gridJobs > 0
+
+
+def test_remove_inlets():
+    T = Tiling(10, 10)
+    T.points = [(0, 10), (0, 4), (2, 4), (2, 1), (2.5, 1), (2.5, 4), (3, 4), (3, 3),
+                (3.5, 3), (3.5, 3.5), (7, 3.5), (7, 0), (10, 0)]
+    T.removeInlets(1)
+    assert T.points == [(0, 10), (0, 4), (2.5, 4), (2.5, 4), (3, 4), (3, 3.5),
+                        (7, 3.5), (7, 0), (10, 0)]